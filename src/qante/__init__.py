@@ -11,4 +11,5 @@ __all__ = [
     "utilities",
     "query",
     "table",
+    "resultset",
 ]
@@ -30,6 +30,7 @@ def handle_error(code, msg, error_loc=None):
                    06 for query
                    07 for table
                    09 for loclist
+                   10 for resultset
           dd is error code within module
       msg (string) -- error message
       error_loc (dict) -- unused                                   
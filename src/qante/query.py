@@ -5,18 +5,680 @@
    Class Query methods:
       __init__(string/literal list, string, Tagger object, int list, boolean)
       execute() -> list of Loc tuples
-      UDP(string, lambda)
+      count() -> int
+      exists() -> boolean
+      UDP(string, lambda, function, float, string list)
+      nearest(string, int, string, boolean)
+      chain(string, string, int/int list)
+      clear_parse_cache()
+
+   Class QueryBatch methods:
+      __init__(Tagger object)
+      add(string/literal list, string, int list) -> Query object
+      execute() -> list of lists of Loc tuples
 
 """
 import regex as re
 import math
+from itertools import product, chain
+import heapq
+import pickle
+import tempfile
+import sys
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
 
 from .extracterror import handle_error
+from .utilities import LINE, PAGE
+from .resultset import ResultSet, from_tuples
+from .tagger import CancelToken
+from array import array
 from .loctuple import subinterval, seq_before, meets, starts
 from .loctuple import before, seq_meets, equal, intersects, disjoint
 from .loctuple import overlaps, seq_before_meets, during, finishes
 
+def dist_ranges(relop, n):
+   """
+      relop : relational operator of dist predicate ('<', '>', '=', '<=', '>=', '!=')
+      n :     int bound of dist predicate
+
+      Returns list of (lo, hi) pairs with the ranges of distances that satisfy
+      dist(i,j) relop n, hi is None if range has no upper bound
+   """
+   ranges = {'<':  [(0, n-1)],
+             '<=': [(0, n)],
+             '=':  [(n, n)],
+             '>':  [(n+1, None)],
+             '>=': [(n, None)],
+             '!=': [(0, n-1), (n+1, None)]}
+   return [(lo, hi) for lo, hi in ranges[relop] if hi == None or lo <= hi]
+class DistPred:
+   """
+      relop : relational operator of dist predicate ('<', '>', '=', '<=', '>=', '!=')
+      n :     int bound of dist predicate
+
+      predicate dist(i,j) relop n on a pair of locations: they have the same
+      offset, the second one starts after the end of the first one and the 
+      number of characters between them satisfies relop n. Attribute ranges
+      has the ranges of distances that satisfy it (see dist_ranges), which are
+      evaluated with range scans on sorted locations (see Tagger.proximity)
+   """
+   NAMES = {'<': 'lt', '<=': 'le', '=': 'eq', '>': 'gt', '>=': 'ge', '!=': 'ne'}
+   def __init__(self, relop, n):
+      self.relop = relop
+      self.n = n
+      self.ranges = dist_ranges(relop, n)
+      self.__name__ = 'dist_pred_{}_{}'.format(DistPred.NAMES[relop], n)
+   def __call__(self, t):
+      if t[0].offset != t[1].offset:
+         return False
+      d = t[1].start() - t[0].end()
+      return any([lo <= d and (hi == None or d <= hi) for lo, hi in self.ranges])
+   def __eq__(self, other):
+      return isinstance(other, DistPred) and self.relop == other.relop and \
+             self.n == other.n and self.__name__ == other.__name__
+   def __hash__(self):
+      return hash(('dist', self.relop, self.n, self.__name__))
+   def __repr__(self):
+      return 'dist {} {}'.format(self.relop, self.n)
+# ---------------semi-joins on location lists------------------------
+# each function returns the locations in locs1 that satisfy the predicate with
+# some location in locs2, and the locations in locs2 that satisfy it with some
+# location in locs1
+def semijoin_before(locs1, locs2, meets=False):
+   """
+      semi-join on before, or on before or meets if <meets> is True
+   """
+   if len(locs1) == 0 or len(locs2) == 0:
+      return [], []
+   max_start = max([loc.intrval[0] for loc in locs2])
+   min_end = min([loc.intrval[1] for loc in locs1])
+   if meets:
+      return [loc for loc in locs1 if loc.intrval[1] <= max_start], \
+             [loc for loc in locs2 if loc.intrval[0] >= min_end]
+   return [loc for loc in locs1 if loc.intrval[1] < max_start], \
+          [loc for loc in locs2 if loc.intrval[0] > min_end]
+def semijoin_meets(locs1, locs2):
+   """
+      semi-join on meets
+   """
+   starts = set([loc.intrval[0] for loc in locs2])
+   ends = set([loc.intrval[1] for loc in locs1])
+   return [loc for loc in locs1 if loc.intrval[1] in starts], \
+          [loc for loc in locs2 if loc.intrval[0] in ends]
+def semijoin_equal(locs1, locs2):
+   """
+      semi-join on equal
+   """
+   intrvals1 = set([loc.intrval for loc in locs1])
+   intrvals2 = set([loc.intrval for loc in locs2])
+   return [loc for loc in locs1 if loc.intrval in intrvals2], \
+          [loc for loc in locs2 if loc.intrval in intrvals1]
+def semijoin_subinterval(locs1, locs2):
+   """
+      semi-join on subinterval: a location in locs1 is kept if a location in locs2
+      that starts at or before it has the maximum end at or after its end. A
+      location in locs2 is kept if a location in locs1 that starts at or after it
+      has the minimum end at or before its end
+   """
+   if len(locs1) == 0 or len(locs2) == 0:
+      return [], []
+   sorted1 = sorted([loc.intrval for loc in locs1])
+   sorted2 = sorted([loc.intrval for loc in locs2])
+   starts1 = [s for s, e in sorted1]
+   starts2 = [s for s, e in sorted2]
+   # max_end[i]: maximum end of sorted2[:i+1]
+   max_end = []
+   for s, e in sorted2:
+      max_end.append(e if len(max_end) == 0 else max(e, max_end[-1]))
+   # min_end[i]: minimum end of sorted1[i:]
+   min_end = [0]*len(sorted1)
+   for i in range(len(sorted1)-1, -1, -1):
+      e = sorted1[i][1]
+      min_end[i] = e if i == len(sorted1)-1 else min(e, min_end[i+1])
+   res1 = []
+   for loc in locs1:
+      indx = bisect_right(starts2, loc.intrval[0])
+      if indx > 0 and max_end[indx-1] >= loc.intrval[1]:
+         res1.append(loc)
+   res2 = []
+   for loc in locs2:
+      indx = bisect_left(starts1, loc.intrval[0])
+      if indx < len(sorted1) and min_end[indx] <= loc.intrval[1]:
+         res2.append(loc)
+   return res1, res2
+def semijoin_window(locs1, locs2, lo, hi):
+   """
+      semi-join on pairs whose start of the second location minus end of the 
+      first one is in [lo, hi], hi is None if there is no upper bound
+   """
+   starts = sorted([loc.intrval[0] for loc in locs2])
+   ends = sorted([loc.intrval[1] for loc in locs1])
+   res1 = []
+   for loc in locs1:
+      e = loc.intrval[1]
+      indx = bisect_left(starts, e+lo)
+      if indx < len(starts) and (hi == None or starts[indx] <= e+hi):
+         res1.append(loc)
+   res2 = []
+   for loc in locs2:
+      s = loc.intrval[0]
+      indx = bisect_right(ends, s-lo)
+      if indx > 0 and (hi == None or ends[indx-1] >= s-hi):
+         res2.append(loc)
+   return res1, res2
+def semijoin_offset(locs1, locs2):
+   """
+      semi-join on locations with the same offset
+   """
+   offsets1 = set([loc.offset for loc in locs1])
+   offsets2 = set([loc.offset for loc in locs2])
+   return [loc for loc in locs1 if loc.offset in offsets2], \
+          [loc for loc in locs2 if loc.offset in offsets1]
+def semijoin_dist(locs1, locs2, ranges):
+   """
+      semi-join on dist predicate with list of distance ranges <ranges>
+      (see dist_ranges)
+   """
+   def in_range(values, lo, hi):
+      # whether there is a value in sorted list <values> in [lo, hi]
+      indx = bisect_left(values, lo)
+      return indx < len(values) and (hi == None or values[indx] <= hi)
+   starts = {}
+   ends = {}
+   for loc in locs2:
+      starts.setdefault(loc.offset, []).append(loc.intrval[0])
+   for loc in locs1:
+      ends.setdefault(loc.offset, []).append(loc.intrval[1])
+   for values in list(starts.values()) + list(ends.values()):
+      values.sort()
+   res1 = []
+   for loc in locs1:
+      values = starts.get(loc.offset, [])
+      e = loc.intrval[1]
+      if any([in_range(values, e+lo, None if hi == None else e+hi) for lo, hi in ranges]):
+         res1.append(loc)
+   res2 = []
+   for loc in locs2:
+      values = ends.get(loc.offset, [])
+      s = loc.intrval[0]
+      if any([in_range(values, 0 if hi == None else s-hi, s-lo) for lo, hi in ranges]):
+         res2.append(loc)
+   return res1, res2
+def step_window(step, gap=None):
+   """
+      step : 'before', 'meets' or 'before_meets', relation between consecutive
+             locations of a chain
+      gap :  maximum number of characters between the locations, None for no
+             maximum (ignored for 'meets')
+
+      Returns (lo, hi) range of the start of the next location minus the end 
+      of the previous one, hi is None if range has no upper bound
+   """
+   if step == 'meets':
+      return (0, 0)
+   return (1 if step == 'before' else 0, gap)
+def seq_chain(locs, windows, token=None):
+   """
+      locs :    list of location lists, one for each position of the chain
+      windows : list of (lo, hi) ranges between consecutive positions, see 
+                step_window
+      token :   CancelToken checked for each location added to a chain
+
+      Returns iterator of tuples (l1, ..., ln), li in locs[i], such that the
+      start of li+1 minus the end of li is in windows[i]. Chains are extended
+      one location at a time, the locations that can follow li are found by 
+      binary search on the sorted starts of locs[i+1]. Locations that cannot
+      be extended up to the last position are discarded first, from the last
+      position backwards, so every partial chain leads to a result
+   """
+   n = len(locs)
+   slocs = [None] * n
+   starts = [None] * n
+   slocs[n-1] = sorted(locs[n-1], key=lambda loc: loc.intrval[0])
+   starts[n-1] = [loc.intrval[0] for loc in slocs[n-1]]
+   for i in range(n-2, -1, -1):
+      lo, hi = windows[i]
+      nxt = starts[i+1]
+      keep = []
+      for loc in locs[i]:
+         e = loc.intrval[1]
+         indx = bisect_left(nxt, e+lo)
+         if indx < len(nxt) and (hi == None or nxt[indx] <= e+hi):
+            keep.append(loc)
+      slocs[i] = sorted(keep, key=lambda loc: loc.intrval[0])
+      starts[i] = [loc.intrval[0] for loc in slocs[i]]
+   chain = []
+   def extend(i):
+      if i == n:
+         yield tuple(chain)
+         return
+      if i == 0:
+         b, e = 0, len(slocs[0])
+      else:
+         lo, hi = windows[i-1]
+         end = chain[-1].intrval[1]
+         b = bisect_left(starts[i], end+lo)
+         e = len(starts[i]) if hi == None else bisect_right(starts[i], end+hi)
+      for indx in range(b, e):
+         if token != None: token.check(1)
+         chain.append(slocs[i][indx])
+         yield from extend(i+1)
+         chain.pop()
+   return extend(0)
+class ChainPred:
+   """
+      name : name of predicate
+      step : 'before', 'meets' or 'before_meets', see step_window
+      gaps : maximum number of characters between consecutive locations, an
+             int for all of them or a list with one int (or None) per pair of 
+             consecutive locations (default None: no maximum)
+
+      predicate on tuples of locations in which consecutive locations satisfy
+      step and gaps, evaluated with seq_chain (see Query.chain)
+   """
+   def __init__(self, name, step='before', gaps=None):
+      self.__name__ = name
+      self.step = step
+      self.gaps = gaps
+   def windows(self, n):
+      """
+         Returns list of (lo, hi) ranges for a chain of n locations
+      """
+      gaps = self.gaps if isinstance(self.gaps, list) else [self.gaps] * (n-1)
+      if len(gaps) != n-1:
+         fmt = "Predicate {} has {} gaps, it requires {} parameters"
+         handle_error(110627, fmt.format(self.__name__, len(gaps), len(gaps)+1))
+      return [step_window(self.step, gap) for gap in gaps]
+   def __call__(self, ltuple):
+      for (lo, hi), i in zip(self.windows(len(ltuple)), range(len(ltuple)-1)):
+         d = ltuple[i+1].intrval[0] - ltuple[i].intrval[1]
+         if d < lo or (hi != None and d > hi):
+            return False
+      return True
+def range_index(locs, by_end=False, same_offset=False):
+   """
+      locs :        list of locations
+      by_end :      whether to sort locations by end instead of start
+      same_offset : whether to group locations by offset
+
+      Returns dictionary from offset (None if not same_offset) to pair 
+      (keys, positions), where positions are the positions in locs sorted by
+      start (end if by_end) and keys their starts (ends), to find by binary
+      search the locations whose start (end) is in a range (see range_bounds)
+   """
+   groups = {}
+   for i, loc in enumerate(locs):
+      key = loc.offset if same_offset else None
+      groups.setdefault(key, []).append((loc.intrval[1 if by_end else 0], i))
+   index = {}
+   for key, items in groups.items():
+      items.sort()
+      index[key] = ([k for k, i in items], [i for k, i in items])
+   return index
+def range_bounds(keys, lo, hi):
+   """
+      keys : sorted list of ints
+      lo :   minimum key, None if there is no minimum
+      hi :   maximum key, None if there is no maximum
+
+      Returns (b, e) such that keys[b:e] are the keys in [lo, hi]
+   """
+   b = 0 if lo == None else bisect_left(keys, lo)
+   e = len(keys) if hi == None else bisect_right(keys, hi)
+   return b, max(b, e)
+def intersect_windows(window1, window2):
+   """
+      window1, window2 : windows on the same pair of columns, see 
+                         Query.leaf_windows
+
+      Returns the window that holds if both windows hold
+   """
+   col1, col2, ranges1, same1 = window1
+   ranges = []
+   for lo1, hi1 in ranges1:
+      for lo2, hi2 in window2[2]:
+         lo = max(lo1, lo2)
+         hi = hi2 if hi1 == None else (hi1 if hi2 == None else min(hi1, hi2))
+         if hi == None or lo <= hi:
+            ranges.append((lo, hi))
+   return (col1, col2, sorted(ranges), same1 or window2[3])
+def band_pairs(locs1, locs2, properties):
+   """
+      locs1, locs2 : location lists
+      properties :   properties of a predicate on pairs of locations, see Query.UDP
+
+      Returns iterator of the pairs of locations of locs1 x locs2 that satisfy 
+      the properties, which are candidates for the predicate: 'before' pairs 
+      are found by binary search on the sorted starts of locs2, 'subinterval'
+      pairs by binary search on the sorted starts of locs1 and 'same_offset' 
+      pairs by grouping locations by offset
+   """
+   same = 'same_offset' in properties
+   if 'before' in properties:
+      slocs2 = sorted(locs2, key=lambda loc: loc.intrval[0])
+      starts = [loc.intrval[0] for loc in slocs2]
+      for loc1 in locs1:
+         for loc2 in slocs2[bisect_right(starts, loc1.intrval[1]):]:
+            if not same or loc1.offset == loc2.offset:
+               yield (loc1, loc2)
+   elif 'subinterval' in properties:
+      slocs1 = sorted(locs1, key=lambda loc: loc.intrval[0])
+      starts = [loc.intrval[0] for loc in slocs1]
+      for loc2 in locs2:
+         s, e = loc2.intrval
+         for loc1 in slocs1[bisect_left(starts, s):bisect_right(starts, e)]:
+            if loc1.intrval[1] <= e and (not same or loc1.offset == loc2.offset):
+               yield (loc1, loc2)
+   else:
+      by_offset = {}
+      for loc2 in locs2:
+         by_offset.setdefault(loc2.offset, []).append(loc2)
+      for loc1 in locs1:
+         for loc2 in by_offset.get(loc1.offset, []):
+            yield (loc1, loc2)
+def is_cyclic(edges):
+   """
+      edges : list of sets of column numbers, one for each predicate of a conjunction
+
+      Returns True if the hypergraph of <edges> is cyclic. It applies the GYO 
+      reduction: removes columns that are in only one edge and edges that are 
+      subsets of other edges until no change. The hypergraph is cyclic if 
+      some edge remains
+   """
+   edges = [set(e) for e in edges]
+   changed = True
+   while changed and len(edges) > 0:
+      changed = False
+      for edge in edges:
+         for col in list(edge):
+            if sum([1 for e in edges if col in e]) == 1:
+               edge.remove(col)
+               changed = True
+      edges = [e for e in edges if len(e) > 0]
+      for i in range(len(edges)):
+         if any([j != i and edges[i] <= edges[j] for j in range(len(edges))]):
+            edges = edges[:i] + edges[i+1:]
+            changed = True
+            break
+   return len(edges) > 0
+def generic_join(relations, cols, filters=[], token=None):
+   """
+      relations : list of (schema, tuples) pairs, where schema is a list of
+                  column numbers and tuples is a list of location tuples
+      cols :      list of column numbers in the order they are bound
+      filters :   list of (schema, pred) pairs, where pred is a boolean function
+                  on a tuple of locations following schema (default [])
+      token :     CancelToken checked for each location bound (default None)
+
+      Computes the natural join of relations with a worst-case optimal multiway
+      join (generic join): columns are bound one at a time, the locations for
+      a column are the intersection of the locations allowed by the relations
+      that include it, given the locations already bound. Relations are indexed
+      by tries following the order in <cols>. Each filter is applied as soon as
+      the columns in its schema are bound. Every column must be in a relation
+      Returns list of location tuples with columns in the order of <cols>
+   """
+   reps = {}    # (column, location order) --> location
+   tries = []   # (columns of relation, trie)
+   for schema, tuples in relations:
+      rcols = [col for col in cols if col in schema]
+      indices = [schema.index(col) for col in rcols]
+      trie = {}
+      for ltuple in tuples:
+         node = trie
+         for col, indx in zip(rcols, indices):
+            key = ltuple[indx].order()
+            reps.setdefault((col, key), ltuple[indx])
+            node = node.setdefault(key, {})
+      tries.append((rcols, trie))
+   # filters to apply once the column at each depth is bound
+   checks = [[] for col in cols]
+   for schema, pred in filters:
+      depth = max([cols.index(col) for col in schema])
+      checks[depth].append(([cols.index(col) for col in schema], pred))
+   result = []
+   binding = []
+   def join(depth, nodes):
+      if depth == len(cols):
+         result.append(tuple(binding))
+         return
+      col = cols[depth]
+      active = [r for r in range(len(tries)) if col in tries[r][0]]
+      smallest = min(active, key=lambda r: len(nodes[r]))
+      for key in nodes[smallest]:
+         if token != None: token.check(len(checks[depth]))
+         if all([key in nodes[r] for r in active]):
+            binding.append(reps[(col, key)])
+            if all([pred(tuple([binding[i] for i in indices])) for indices, pred in checks[depth]]):
+               next_nodes = list(nodes)
+               for r in active:
+                  next_nodes[r] = nodes[r][key]
+               join(depth+1, next_nodes)
+            binding.pop()
+   join(0, [trie for rcols, trie in tries])
+   return result
+def order_facts(op, params):
+   """
+      Returns set of facts (before, col1, col2) and (subinterval, col1, col2)
+      implied by predicate <op> on columns <params>
+   """
+   if op in [subinterval, during, starts, finishes] and len(params) == 2:
+      return set([(subinterval, params[0], params[1])])
+   if op == equal and len(params) == 2:
+      return set([(subinterval, params[0], params[1]), (subinterval, params[1], params[0])])
+   if op in [before, seq_before] or (isinstance(op, ChainPred) and op.step == 'before'):
+      return set([(before, params[i], params[i+1]) for i in range(len(params)-1)])
+   return set()
+def order_closure(facts):
+   """
+      facts : set of (before, col1, col2) and (subinterval, col1, col2) triples
+
+      Returns closure of facts: before and subinterval are transitive,
+      subinterval(a,b) and before(b,c) imply before(a,c), and 
+      before(a,b) and subinterval(c,b) imply before(a,c)
+   """
+   bfr = set([(a, b) for op, a, b in facts if op == before])
+   sub = set([(a, b) for op, a, b in facts if op == subinterval])
+   changed = True
+   while changed:
+      new_bfr = set([(a, d) for a, b in bfr for c, d in bfr if b == c])
+      new_bfr.update([(a, d) for a, b in sub for c, d in bfr if b == c])
+      new_bfr.update([(a, c) for a, b in bfr for c, d in sub if b == d])
+      new_sub = set([(a, d) for a, b in sub for c, d in sub if b == c])
+      changed = not (new_bfr <= bfr and new_sub <= sub)
+      bfr.update(new_bfr)
+      sub.update(new_sub)
+   return set([(before, a, b) for a, b in bfr] + [(subinterval, a, b) for a, b in sub])
+class SpillList:
+   """
+      sch :   column numbers of tuples
+      chunk : maximum number of tuples to keep in memory
+      canon : function that returns, for a column number, a dictionary from
+              location orders (see Loc.order) to locations of the column
+
+      sequence of location tuples kept in temporary files, for results that
+      exceed the budget of tuples of a query (see Query.execute). Tuples are
+      kept as runs of location orders, each one sorted and without
+      duplicates, written in blocks of pickled orders and read back block by
+      block as locations of their columns. Runs are merged FANIN at a time
+      to remove duplicates (see unique), keeping a block of each run in memory
+   """
+   FANIN = 16   # runs merged at a time, a run has blocks of chunk/FANIN tuples
+   def __init__(self, sch, chunk, canon):
+      self.sch = sch
+      self.chunk = chunk
+      self.canon = canon
+      self.file = None
+      self.runs = []   # (file, position in file of each block) of each run
+      self.length = 0
+   def extend(self, tuples):
+      """
+         adds location <tuples> as a run, duplicates within them are dropped
+      """
+      self.extend_keys([tuple([loc.order() for loc in t]) for t in tuples])
+   def extend_keys(self, keys):
+      """
+         adds <keys>, tuples of location orders, as a run
+      """
+      self.write_run(sorted(set(keys)))
+   def extend_stream(self, keys):
+      """
+         adds iterable <keys>, tuples of location orders, as runs of chunk keys
+      """
+      buf = []
+      for key in keys:
+         buf.append(key)
+         if len(buf) == self.chunk:
+            self.extend_keys(buf)
+            buf = []
+      self.extend_keys(buf)
+   def write_run(self, keys):
+      """
+         writes sorted <keys> without duplicates as a run
+      """
+      if self.file == None:
+         self.file = tempfile.TemporaryFile()
+      block = max(1, self.chunk // SpillList.FANIN)
+      blocks = []
+      buf = []
+      for key in keys:
+         buf.append(key)
+         if len(buf) == block:
+            blocks.append(self.write_block(buf))
+            buf = []
+      if len(buf) > 0:
+         blocks.append(self.write_block(buf))
+      if len(blocks) > 0:
+         self.runs.append((self.file, blocks))
+   def write_block(self, keys):
+      """
+         writes <keys> at the end of the file and returns their position
+      """
+      self.file.seek(0, 2)
+      pos = self.file.tell()
+      pickle.dump(keys, self.file)
+      self.length += len(keys)
+      return pos
+   def read_run(self, run):
+      """
+         yields the keys of <run> reading one block at a time
+      """
+      fd, blocks = run
+      for pos in blocks:
+         fd.seek(pos)
+         yield from pickle.load(fd)
+   def keys(self):
+      """
+         yields the keys of the tuples, run after run
+      """
+      for run in self.runs:
+         yield from self.read_run(run)
+   def unique(self):
+      """
+         Returns a SpillList with the tuples of this one without duplicates,
+         sorted by location orders in one run. Groups of FANIN runs are merged 
+         into a run dropping equal neighbours until one run is left
+      """
+      if len(self.runs) <= 1:
+         return self
+      res = self
+      while len(res.runs) > 1:
+         runs = res.runs
+         res = SpillList(self.sch, self.chunk, self.canon)
+         for i in range(0, len(runs), SpillList.FANIN):
+            merged = heapq.merge(*[res.read_run(run) for run in runs[i:i+SpillList.FANIN]])
+            res.write_run(drop_equal(merged))
+      return res
+   def select_columns(self, sch, indices):
+      """
+         Returns SpillList with columns <sch> taken from positions <indices>
+         of the tuples, without duplicates. Location orders are copied without
+         reading back their locations
+      """
+      if indices == list(range(len(self.sch))):
+         return self.unique()
+      res = SpillList(sch, self.chunk, self.canon)
+      res.extend_stream(tuple([key[i] for i in indices]) for key in self.keys())
+      return res.unique()
+   def __len__(self):
+      return self.length
+   def __iter__(self):
+      locs = [self.canon(col) for col in self.sch]
+      for t in self.keys():
+         yield tuple([locs[i][t[i]] for i in range(len(t))])
+def drop_equal(keys):
+   """
+      yields the sorted <keys> that differ from the previous one
+   """
+   prev = None
+   for key in keys:
+      if key != prev:
+         yield key
+      prev = key
+def unique_keys(keys, chunk):
+   """
+      keys :  iterable of tuples of location orders or indices
+      chunk : maximum number of keys to keep in memory
+
+      yields the distinct <keys> in sorted order, sorting them in runs of
+      <chunk> keys spilled to a temporary file that are merged (see SpillList)
+   """
+   spill = SpillList(None, chunk, None)
+   spill.extend_stream(keys)
+   return spill.unique().keys()
+def collect(sch, tuples, max_tuples=None, canon=None):
+   """
+      sch :        column numbers of tuples
+      tuples :     iterable of location tuples
+      max_tuples : maximum number of tuples to keep in memory (default None: 
+                   no maximum)
+      canon :      see SpillList
+
+      Returns list of <tuples>, or a SpillList if there are more than 
+      <max_tuples>
+   """
+   if max_tuples == None:
+      return list(tuples)
+   res = []
+   spill = None
+   for t in tuples:
+      res.append(t)
+      if len(res) > max_tuples:
+         if spill == None:
+            spill = SpillList(sch, max_tuples, canon)
+         spill.extend(res)
+         res = []
+   if spill == None:
+      return res
+   spill.extend(res)
+   return spill
+def concat(tuples1, tuples2):
+   """
+      Returns concatenation of tuples1 and tuples2, lists or SpillLists with
+      the same schema. Runs of SpillLists are shared, not copied
+   """
+   if isinstance(tuples1, list) and isinstance(tuples2, list):
+      return tuples1 + tuples2
+   spill = tuples1 if isinstance(tuples1, SpillList) else tuples2
+   res = SpillList(spill.sch, spill.chunk, spill.canon)
+   for tuples in [tuples1, tuples2]:
+      if isinstance(tuples, SpillList):
+         res.runs = res.runs + tuples.runs
+         res.length += len(tuples)
+      elif len(tuples) > 0:
+         res.extend(tuples)
+   return res
 def rm_dups(tuples):
+   """
+      Returns <tuples>, a list or a SpillList, without duplicates. The runs
+      of a SpillList are merged on disk, see SpillList.unique
+   """
+   if isinstance(tuples, SpillList):
+      return tuples.unique()
    included = set([])
    sresult = []
    for r in tuples:
@@ -24,6 +686,12 @@ def rm_dups(tuples):
       sresult.append(r)
       included.add(r)
    return sresult
+def is_empty(result):
+   """
+      Returns whether result, a list of schema-tuples pairs, has schemas but
+      no tuples
+   """
+   return len(result) > 0 and sum([len(tuples) for sch, tuples in result]) == 0
 def merge_results(prev, new):
    """
       prev : list of schema-tuples pairs
@@ -38,14 +706,15 @@ def merge_results(prev, new):
       for i, (osch, otup) in enumerate(prev):
          if schema == osch:
             found = True
-            prev[i] = (osch, rm_dups(otup + tuples))
+            prev[i] = (osch, rm_dups(concat(otup, tuples)))
             break
       if not found:
           prev.append( (schema, tuples))
-def natural_inner_join(sch_tuples1, sch_tuples2):
+def natural_inner_join(sch_tuples1, sch_tuples2, token=None):
    """
       applies natural inner join to tuples1 and tuples2
       schemas of tuples1 and tuples2 must intersect
+      token (CancelToken) is checked at each step of the join, if not None
 
       sch_tuples1 : pair (sch1,tuples1) where sch1 is a list of integers
                     denoting column number, and tuples1 is a list of location
@@ -88,6 +757,7 @@ def natural_inner_join(sch_tuples1, sch_tuples2):
   
    # compute join
    while t1 < len(stuples1) and t2 < len(stuples2):
+      if token != None: token.check()
       tuple1 = stuples1[t1]
       tuple2 = stuples2[t2]
       key1 = tuple([tuple1[over2sch1[o]].order() for o in overlap])
@@ -106,6 +776,7 @@ def natural_inner_join(sch_tuples1, sch_tuples2):
                k1 = tuple([tuple1[over2sch1[o]].order() for o in overlap])
                k2 = tuple([tuple2[over2sch2[o]].order() for o in overlap])
                if k1 == key1 and k2 == key2:
+                  if token != None: token.check()
                   l2 = [tuple2[col] for col in range(len(sch2)) if sch2[col] not in overlap]   
                   joinres.append(tuple(list(tuple1)+l2))
                   j += 1
@@ -123,7 +794,7 @@ def natural_inner_join(sch_tuples1, sch_tuples2):
       new_t = [t[indx] for indx in colsmap]
       stuples.append(tuple(new_t))
    return (scols, stuples)
-def cartesian_prod(tuples, ptuples, schema):
+def cartesian_prod(tuples, ptuples, schema, token=None):
    """
       tuples :      list of location tuples
       ptuples :     list of location tuples
@@ -132,10 +803,19 @@ def cartesian_prod(tuples, ptuples, schema):
           'tuples': [d1, ..., dt] : column numbers in tuples
           'tags':   unused
 
+      token: CancelToken checked for each tuple of the product (default None)
+
       Computes cartesian product of tuples x ptuples and sorts
       columns in cartesian product by column number
       returns column numbers of result, sorted cartesian product
    """ 
+   soutput, tuples = cartesian_iter(tuples, ptuples, schema, token)
+   return soutput, list(tuples)
+def cartesian_iter(tuples, ptuples, schema, token=None):
+   """
+      same as cartesian_prod, returns an iterator of the cartesian product
+      instead of a list
+   """
    spred = schema['pred']
    stuples = schema['tuples']
    # verify that schema['pred'] and schema['tuples'] are disjoint
@@ -154,18 +834,59 @@ def cartesian_prod(tuples, ptuples, schema):
          src = 't'
          indx = [i for i in range(len(stuples)) if stuples[i] == col][0]
       col2src[col] = (src, indx)  
-   result = []
-   for ttuple in tuples:
-      for ptuple in ptuples:
-         rtuple = []
-         for col in soutput:
-            src,indx = col2src[col]
-            if src == 'p':
-               rtuple.append(ptuple[indx])
-            else:
-               rtuple.append(ttuple[indx])
-         result.append(tuple(rtuple))
-   return soutput,result  
+   def prod():
+      for ttuple in tuples:
+         for ptuple in ptuples:
+            if token != None: token.check()
+            rtuple = []
+            for col in soutput:
+               src,indx = col2src[col]
+               if src == 'p':
+                  rtuple.append(ptuple[indx])
+               else:
+                  rtuple.append(ttuple[indx])
+            yield tuple(rtuple)
+   return soutput, prod()
+def hash_join(sch_tuples1, sch_tuples2, chunk, token=None):
+   """
+      sch_tuples1, sch_tuples2, token : see natural_inner_join
+      chunk : maximum number of tuples of sch_tuples1 to index at once
+
+      applies natural inner join in chunks: each chunk of tuples1 is indexed
+      by its overlapping columns and tuples2 is scanned once per chunk
+      Returns a pair (sch, tuples) as natural_inner_join, where tuples is an 
+      iterator
+   """
+   sch1, tuples1 = sch_tuples1
+   sch2, tuples2 = sch_tuples2
+   overlap = [col for col in sch1 if col in sch2]
+   if len(overlap) == 0:
+      handle_error(110601, 'schemas in natural_inner_join must intersect')
+   over1 = [sch1.index(col) for col in overlap]
+   over2 = [sch2.index(col) for col in overlap]
+   extra2 = [i for i in range(len(sch2)) if sch2[i] not in overlap]
+   joinsch = sch1 + [sch2[i] for i in extra2]
+   scols = sorted(joinsch)
+   colsmap = [joinsch.index(col) for col in scols]
+   def join_chunk(ltuples):
+      index = {}
+      for t1 in ltuples:
+         index.setdefault(tuple([t1[i].order() for i in over1]), []).append(t1)
+      for t2 in tuples2:
+         if token != None: token.check()
+         for t1 in index.get(tuple([t2[i].order() for i in over2]), []):
+            t = t1 + tuple([t2[i] for i in extra2])
+            yield tuple([t[i] for i in colsmap])
+   def join():
+      ltuples = []
+      for t1 in tuples1:
+         ltuples.append(t1)
+         if len(ltuples) == chunk:
+            yield from join_chunk(ltuples)
+            ltuples = []
+      if len(ltuples) > 0:
+         yield from join_chunk(ltuples)
+   return scols, join()
 def project(prev_result, oschema):
     """
         prev_result : a schema-tuples pair, where schema is a list of columns
@@ -182,13 +903,94 @@ def project(prev_result, oschema):
     new_sch = sorted(list(set(prev_sch).intersection(set(oschema))))
     if new_sch == prev_sch:
         return prev_result
-    indices = [i for i in range(len(prev_sch)) if prev_sch[i] in new_sch]
-    new_tuples = []
-    for ptuple in prev_tuples:
-        ltuple = list(ptuple)
-        new_tuple = tuple( [ltuple[i] for i in range(len(ltuple)) if i in indices] )
-        new_tuples.append(new_tuple)
-    return new_sch, new_tuples
+    # first position of each column, columns may be repeated in prev_sch
+    indices = [prev_sch.index(col) for col in new_sch]
+    if isinstance(prev_tuples, SpillList):
+        return new_sch, prev_tuples.select_columns(new_sch, indices)
+    return new_sch, [tuple([ptuple[i] for i in indices]) for ptuple in prev_tuples]
+def evaluate_subquery(task, orders=False):
+   """
+      task :   pair (query, oschema), where query is a Query whose tree is 
+               ready for evaluation (see Query.subquery) and oschema its 
+               output columns
+      orders : whether to return location orders instead of locations
+
+      evaluates the tree of query
+      Returns the results of its root projected on oschema
+   """
+   query, oschema = task
+   query.update_tree()
+   while not query.root.done:
+      query.evaluate_step(oschema)
+   res = []
+   for sch_tuples in query.root.result:
+      sch, tuples = project(sch_tuples, oschema)
+      if orders:
+         tuples = [tuple([loc.order() for loc in t]) for t in tuples]
+      res.append((sch, rm_dups(tuples)))
+   return res
+# tasks of the pool of the worker process, see run_pool
+_pool_tasks = []
+def _init_pool(tasks):
+   global _pool_tasks
+   _pool_tasks = tasks
+def _run_pool_task(i):
+   fn, arg = _pool_tasks[i]
+   return fn(arg, True)
+def run_pool(args, fn, parallel, workers=None):
+   """
+      args :     list of arguments
+      fn :       function fn(arg, orders) 
+      parallel : 'thread' or 'process'
+      workers :  maximum number of threads or processes (default: 
+                 concurrent.futures default)
+
+      Returns [fn(arg, False) for arg in args] computed in a pool of threads,
+      or [fn(arg, True) for arg in args] computed in a pool of processes: 
+      processes are forked, so that they inherit the taggers and predicates,
+      which may be lambdas that cannot be pickled, and return location orders,
+      since locations would be copies. Each pool passes its tasks to its 
+      processes with the initializer, as fork inherits the arguments without
+      pickling them, so pools of concurrent calls do not share tasks. Threads
+      are used where fork is not available
+   """
+   if parallel == 'process' and 'fork' in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context('fork')
+      tasks = [(fn, arg) for arg in args]
+      with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_pool,
+                               initargs=(tasks,)) as pool:
+         return list(pool.map(_run_pool_task, range(len(args))))
+   with ThreadPoolExecutor(workers) as pool:
+      results = list(pool.map(fn, args))
+   if parallel == 'process':
+      # threads were used, return location orders anyway
+      results = [[(sch, [tuple([loc.order() for loc in t]) for t in tuples]) 
+                  for sch, tuples in result] for result in results]
+   return results
+def tag_key(tag):
+   """
+      Returns hashable key of a tag, literal or list of locations
+   """
+   if isinstance(tag, dict):
+      return ('literal', tag['literal'])
+   if isinstance(tag, list):
+      return ('locs', tuple([loc.order() for loc in tag]))
+   return tag
+def execute_partition(task, orders=False):
+   """
+      task :   pair (query, params), where query is a Query on the locations
+               of a partition and params a dictionary of parameters of execute
+      orders : whether to return location orders instead of locations
+
+      Returns result of query.execute(**params)
+   """
+   query, params = task
+   res = query.execute(**params)
+   if params.get('columnar'):
+      res = list(res)
+   if orders:
+      res = [tuple([loc.order() for loc in t]) for t in res]
+   return res
 class Node:
    def __init__(self, op):
       self.op = op          # operator: predicate or booleans AND, OR
@@ -241,7 +1043,7 @@ class Query:
          conj   ::= term 'and' query
          disj   ::= term 'or' query
 
-         term   ::= pred '(' params ')'
+         term   ::= pred '(' params ')' | 'not' term | 'not' '(' query ')'
          params ::= int ',' params | int
 
          term   ::= 'dist(' int ',' int ')' relop int
@@ -254,6 +1056,17 @@ class Query:
 
          other-relation ::= 'subinterval' | 'intersects' | 'disjoint'
             | 'seq_before' | 'seq_before_meets' | 'seq_meets'
+            | 'nearest'
+
+         nearest(i,j) holds if the location of tag j is the nearest one after
+         the location of tag i with the same offset (e.g. same projected line).
+         Other nearest neighbour predicates are defined with method nearest
+
+         'not' is evaluated as an anti-join. Columns of a negated term that
+         are projected or appear in terms that are not negated are bound by
+         the rest of the query, its other columns are quantified inside the
+         negation: with tags AMOUNT and FOOTER, 'not subinterval(0,1)' with
+         project [0] returns the amounts that are not inside any footer
 
       tagger (Tagger Object) -- tagged text to apply query
 
@@ -271,6 +1084,18 @@ class Query:
           5:[('[<>=!]', 6, None)],
           6:[('=',7,'combine2'), ('[0-9]+', 8, '2tokens')],
           7:[('[0-9]+', 8, 'token')]}
+   # maximum number of children of an 'and' node to plan by dynamic programming
+   MAX_DP_CHILDREN = 10
+   # properties of user defined predicates, see UDP
+   UDP_PROPERTIES = ['same_offset', 'before', 'subinterval', 'symmetric']
+   # maximum number of parsed queries kept by all queries of the process, 
+   # 0 disables the cache, see parse_cached
+   PARSE_CACHE_SIZE = 256
+   # (query, number of tags, predicate names) --> (tokens, parse tree, dist predicates)
+   PARSE_CACHE = OrderedDict()
+   # hits, misses and evictions of the cache of parsed queries
+   PARSE_STATS = {'hits': 0, 'misses': 0, 'evicted': 0}
+   PARSE_LOCK = threading.Lock()
    def __init__(self, tags, query, tagger, project = [], log_on=False):
       self.PREDS = {'subinterval': subinterval, 
                'seq_before': seq_before,
@@ -290,18 +1115,51 @@ class Query:
       else:
          self.fd = None
       self.root = None
+      # parse tree whose leaves have predicate names, see parse
+      self.parsed = None
       self.tagger = tagger
       # subinterval(1, 0) and subinterval(4, 3) and seq_before(0, 2, 3)
       self.query = query 
       self.tokens = []
       # tags considered in this query and number of locations associated with each
       self.qtags = {i:tags[i] for i in range(len(tags))}
-      self.count = {i:len(tagger.get_locs(tags[i])) for i in range(len(tags))}
-      empty_tags = [self.qtags[i] for i in self.count.keys() if self.count[i] == 0]
+      self.lcount = {i:len(tagger.get_locs(tags[i])) for i in range(len(tags))}
+      # empty location lists are not reported, e.g. tags missing in a partition
+      empty_tags = [self.qtags[i] for i in self.lcount.keys() 
+                    if self.lcount[i] == 0 and not isinstance(self.qtags[i], list)]
       if len(empty_tags) != 0:
           handle_error(210604, 'Tags in query are empty: {}'.format(empty_tags))
-      # list of estimated counts of leaves that have not been computed
-      self.ecounts = []
+      # pending leaves by estimated count (see schedule), entries of leaves
+      # that were evaluated or re-estimated are skipped when popped
+      self.heap = []
+      self.tick = 0
+      # node --> its parent, leaf --> its position in depth-first order
+      self.parents = {}
+      self.leaf_index = {}
+      # nearest neighbour predicate name --> (k, direction, same_offset)
+      self.NNPREDS = {'nearest': (1, 'after', True)}
+      # nearest neighbour leaf predicate --> (k, direction, same_offset)
+      self.NEAREST = {}
+      # column number --> its locations reduced by semi-joins
+      self.locs = {}
+      # whether evaluation order was fixed by plan_tree
+      self.planned = False
+      # user defined predicate --> metadata {'batch', 'selectivity', 'properties'}
+      self.UDPS = {}
+      # multiway join leaf predicate --> leaves combined by it
+      self.MULTIWAY = {}
+      # anti-join leaf predicate --> (negated expression, its columns)
+      self.ANTI = {}
+      # facts implied by the conjunction at the root that are not leaves
+      self.implied = set()
+      # QueryBatch that shares leaf results with this query
+      self.shared = None
+      # maximum number of tuples of a result kept in memory, see execute
+      self.max_tuples = None
+      # CancelToken that limits the evaluation, see execute
+      self.token = None
+      # column number --> dictionary from location orders to its locations
+      self.canon = {}
       self.project = project
       if len(set(project).difference(set(range(len(self.qtags))))) != 0:
           fmt = "Invalid project columns in query: {}"
@@ -309,16 +1167,125 @@ class Query:
    def __del__(self):
       if self.fd != None:
          self.fd.close()
-   def UDP(self, pred_name, pred_function):
+   @classmethod
+   def clear_parse_cache(cls):
+      """Clear cache of parsed queries
+
+      Removes the parsed queries kept by all queries of the process and resets
+      the statistics of the cache in Query.PARSE_STATS: 
+         'hits' -- queries whose parse tree was taken from the cache
+         'misses' -- queries that were tokenized and parsed
+         'evicted' -- parse trees removed in least recently used order, when
+                      the cache exceeded Query.PARSE_CACHE_SIZE queries
+      """
+      with cls.PARSE_LOCK:
+         cls.PARSE_CACHE.clear()
+         cls.PARSE_STATS.update({'hits': 0, 'misses': 0, 'evicted': 0})
+   def UDP(self, pred_name, pred_function, batch=None, selectivity=None, properties=[]):
       """User Defined Predicate
       
       Parameters:
          pred_name (string) -- name of predicate
          pred_function (lambda) -- boolean function to apply when predicate is invoked. 
+         batch (function) -- function that takes a list of locations for each
+            parameter of the predicate and returns the list of tuples of 
+            locations that satisfy it, used instead of applying pred_function
+            to their cartesian product (default None)
+         selectivity (float) -- estimated fraction of the cartesian product of
+            the parameters that satisfies the predicate, used to plan queries
+            (default None: estimated from properties)
+         properties (string list) -- properties implied by the predicate on 
+            tuples (l1, ..., ln) (default []):
+               'same_offset' -- locations have the same offset
+               'before' -- before((li, li+1)) for each pair of consecutive 
+                           locations, as seq_before
+               'subinterval' -- subinterval((l1, l2)), for two parameters
+               'symmetric' -- (l1, l2) satisfies the predicate if and only if
+                              (l2, l1) does, for two parameters
          
-      Defines a new predicate to be included in queries
+      Defines a new predicate to be included in queries. Properties are used
+      as the properties of built-in predicates: to infer order relations,
+      to reduce locations with semi-joins (see execute) and to evaluate the
+      predicate only on candidate pairs of locations (e.g. pairs that satisfy
+      before, found by binary search) instead of their cartesian product
       """
+      invalid = [prop for prop in properties if prop not in Query.UDP_PROPERTIES]
+      if len(invalid) > 0:
+         fmt = "Invalid properties of predicate {}: {}. Use {}"
+         handle_error(110624, fmt.format(pred_name, invalid, Query.UDP_PROPERTIES))
+      if selectivity != None and not 0 < selectivity <= 1:
+         fmt = "Invalid selectivity of predicate {}: {}, it must be in (0, 1]"
+         handle_error(110625, fmt.format(pred_name, selectivity))
       self.PREDS[pred_name] = pred_function
+      self.UDPS[pred_function] = {'batch': batch, 'selectivity': selectivity,
+                                  'properties': set(properties)}
+   def nearest(self, pred_name, k=1, direction='after', same_offset=True):
+      """Nearest Neighbour Predicate
+      
+      Parameters:
+         pred_name (string) -- name of predicate
+         k (int) -- number of nearest locations (default 1)
+         direction (string) -- 'after', 'before' or 'both' (default 'after')
+         same_offset (boolean) -- whether locations must have the same offset (default True)
+         
+      Defines a new predicate to be included in queries: pred_name(i,j) holds if
+      location j is one of the k nearest locations of tag j to location i
+      in the given direction. See Tagger.nearest
+      """
+      if direction not in ['after', 'before', 'both']:
+         fmt = "Invalid direction {}, must be 'after', 'before' or 'both'"
+         handle_error(110617, fmt.format(direction))
+      self.NNPREDS[pred_name] = (k, direction, same_offset)
+   def chain(self, pred_name, step='before', max_gaps=None):
+      """Chain Predicate
+      
+      Parameters:
+         pred_name (string) -- name of predicate
+         step (string) -- 'before', 'meets' or 'before_meets': relation between
+            consecutive locations (default 'before')
+         max_gaps (int/int list) -- maximum number of characters between 
+            consecutive locations, for all of them or one for each pair of
+            consecutive parameters, None for no maximum (default None)
+         
+      Defines a new predicate to be included in queries: pred_name(c1,...,cn)
+      holds if each pair of consecutive locations satisfies step within its 
+      maximum gap, e.g. with max_gaps [2, None], label(0,1,2) finds a location
+      of tag 0 followed by one of tag 1 within 2 characters, followed by one 
+      of tag 2. Chains are evaluated as seq_before, seq_meets and 
+      seq_before_meets: extending partial chains by binary search
+      """
+      if step not in ['before', 'meets', 'before_meets']:
+         fmt = "Invalid step {}, must be 'before', 'meets' or 'before_meets'"
+         handle_error(110626, fmt.format(step))
+      self.PREDS[pred_name] = ChainPred(pred_name, step, max_gaps)
+   def nearest_pred(self, pred_name, params):
+      """
+         pred_name : name of a nearest neighbour predicate
+         params :    list of column numbers of predicate parameters
+         
+         Returns boolean function on a pair of locations that holds if the pair 
+         is in the result of Tagger.nearest for tags in params. Pairs are
+         computed on first call
+      """
+      if len(params) != 2:
+         fmt = "Predicate {} requires two parameters: {}"
+         handle_error(110618, fmt.format(pred_name, params))
+      k, direction, same_offset = self.NNPREDS[pred_name]
+      pairs = []
+      def pred(pair):
+         if len(pairs) == 0:
+            pairs.append(set([(l1.order(), l2.order()) for l1, l2 in self.nearest_pairs(pred)]))
+         return (pair[0].order(), pair[1].order()) in pairs[0]
+      self.NEAREST[pred] = (params, k, direction, same_offset)
+      return pred
+   def nearest_pairs(self, pred):
+      """
+         Returns iterator of the result of Tagger.nearest for nearest neighbour
+         leaf predicate <pred>
+      """
+      params, k, direction, same_offset = self.NEAREST[pred]
+      tags = [ self.qtags[i] for i in params ]
+      return self.tagger.nearest_iter(tags[0], tags[1], k, direction, same_offset)
    def tokenize(self):
       def parse_dist(i, tokens):
          """
@@ -366,25 +1333,17 @@ class Query:
          tokens.append(m.group())
       # --------
       # replace dist(n1, n2) op n3, where op in [<. >, =, <=, >=, !=]
-      # with dist_pred(_n(n1, n2) where
-      # dist_pred_n = lambda t: t[0].offset == t[1].offset and 
-      #                         t[1].start() >= t[0].end() and 
-      #                         t[1].start()-t[0].end()) op n3
+      # with dist_pred_op_n3(n1, n2), where dist_pred_op_n3 is a DistPred
       # --------
       self.tokens = []
       i = 0
       while i < len(tokens):
          if tokens[i] == 'dist':
-            n = len(self.PREDS.keys())
-            fn_str = 'dist_pred_{}'.format(n)
-            self.tokens.append(fn_str)
             i,token_list = parse_dist(i+1, tokens)
+            pred = DistPred(token_list[-2], int(token_list[-1]))
+            self.PREDS[pred.__name__] = pred
+            self.tokens.append(pred.__name__)
             self.tokens = self.tokens + token_list[:-2]
-            fmt = "lambda t: (t[0].offset == t[1].offset) and " + \
-                  "(t[1].start() >= t[0].end()) and " + \
-                  "(t[1].start()-t[0].end()) {} {}"
-            lambda_fn = fmt.format( token_list[-2], token_list[-1])
-            self.PREDS[fn_str] = eval( lambda_fn )
          else:
             self.tokens.append(tokens[i])
             i += 1
@@ -392,7 +1351,9 @@ class Query:
    def parse(self):
       """
          Processes list of tokens in self.tokens to compute a parse tree
-         It sets self.root to the root of the parse tree
+         It sets self.parsed to the root of the parse tree, whose leaves have
+         predicate names, and self.root to its copy with the predicates of 
+         this query (see instantiate)
       """
       def is_bop(token):
          # is token a boolean operator?
@@ -447,6 +1408,37 @@ class Query:
          node = Node(op)
          node.children = [child1, child2]
          preds.append(node)
+      def get_operand(i):
+         """
+            i : index in self.tokens where the operand begins
+
+            parses a predicate with its parameters, a subexpression between
+            parenthesis, or 'not' followed by an operand, which becomes the
+            only child of a 'not' node
+
+            Returns pair (node, i) where i is the index in self.tokens after
+            the operand
+         """
+         token = self.tokens[i]
+         if token == 'not':
+            if i+1 == len(self.tokens) or is_bop(self.tokens[i+1]) or self.tokens[i+1] == ')':
+               fmt = "Invalid syntax in query: {} - {}"
+               handle_error(110612,fmt.format(self.query, token))
+            node = Node('not')
+            child, i = get_operand(i+1)
+            node.children = [child]
+            return node, i
+         # parses subexpression starting at '(' by making a recursive call
+         if token == '(':
+            return get_tree(i+1, True)
+         # creates node with predicate and its parameters
+         if token not in self.PREDS and token not in self.NNPREDS:
+            fmt = "Invalid predicate in query; {}"
+            handle_error(110613, fmt.format(token))
+         # predicate name, its function is set by instantiate
+         node = Node(token)
+         node.params, i = get_pred_params(i+1)
+         return node, i+1
       def get_tree(start_index, open_paren):
          """
             start_index : index in self.tokens where the parsing begins
@@ -476,43 +1468,101 @@ class Query:
                bool_ops.append(token)
                nxt_type = 'pred'
                i += 1
-            # parses subexpression starting at '(' by making a recursive call
-            elif token == '(':
-               root, index = get_tree(i+1, True)
-               preds.append(root)
-               nxt_type = 'bool_op'
-               i = index
             # finishes parsing of subexpression ending at ')'
             elif  token == ')':
                while len(bool_ops) > 0:
                   get_subtree(bool_ops, preds, token)
                return preds.pop(), i+1
-            # creates node with predicate and its parameters
-            # pushes node into preds stack
+            # parses operand: predicate, subexpression or negation
+            # pushes its node into preds stack
             else:
-               # get predicate
-               if token not in self.PREDS:
-                  fmt = "Invalid predicate in query; {}"
-                  handle_error(110613, fmt.format(token))
-               function = self.PREDS[token]
-               node = Node(function)
-               node.params, i = get_pred_params(i+1)
+               node, i = get_operand(i)
                preds.append(node)
                # create subtree if top of bool_ops is 'and' with 'and' as parent
                # and top two elements in preds stack as children
                # pop 'and' and top two elements
                # push subtree into preds stack
-               if len(bool_ops) > 0 and bool_ops[-1] == 'and':
+               # a subexpression between parenthesis does not close a pending
+               # 'and', so 'a and (b) or c' is 'a and ((b) or c)'
+               if token != '(' and len(bool_ops) > 0 and bool_ops[-1] == 'and':
                   get_subtree(bool_ops, preds, token)
                nxt_type = 'bool_op'
-               i += 1
          while len(bool_ops) > 0:
             get_subtree(bool_ops, preds, "")
          if len(preds) == 0:
             fmt = "Invalid query; {}"
             handle_error(110614, fmt.format(self.query))
          return preds.pop()
-      self.root = get_tree(0, False)
+      self.parsed = get_tree(0, False)
+      self.root = self.instantiate(self.parsed)
+   def required_cols(self, ptr):
+      """
+         Returns set of the columns of the tree of <ptr> that have a location
+         in every result of <ptr>: columns of all the children of 'and' nodes
+         and columns of every child of 'or' nodes. Columns of negated 
+         expressions are not required
+      """
+      if len(ptr.children) == 0:
+         return set(ptr.params)
+      if ptr.op == 'not':
+         return set()
+      cols = [self.required_cols(child) for child in ptr.children]
+      if ptr.op == 'and':
+         return set().union(*cols)
+      return set.intersection(*cols)
+   def instantiate(self, ptr):
+      """
+         ptr : node of a parse tree whose leaves have predicate names as op
+
+         Returns a copy of the tree of <ptr> for evaluation, whose leaves 
+         have the predicates of this query. The tree of <ptr> is not modified
+         so it can be shared by queries, see parse_cached
+      """
+      node = Node(ptr.op)
+      node.params = list(ptr.params)
+      node.children = [self.instantiate(child) for child in ptr.children]
+      if len(ptr.children) == 0:
+         if ptr.op in self.NNPREDS:
+            node.op = self.nearest_pred(ptr.op, node.params)
+         else:
+            node.op = self.PREDS.get(ptr.op)
+      return node
+   def parse_cached(self):
+      """
+         tokenizes and parses the query, or takes its tokens and parse tree 
+         from the cache shared by all queries of the process. Entries are 
+         keyed by query string, number of tags and names of predicates (user
+         defined predicates may be named in queries), and are evicted in least 
+         recently used order when the cache exceeds Query.PARSE_CACHE_SIZE.
+         See clear_parse_cache for its statistics in Query.PARSE_STATS
+      """
+      if Query.PARSE_CACHE_SIZE <= 0:
+         self.tokenize()
+         self.parse()
+         return
+      key = (self.query, len(self.qtags), frozenset(self.PREDS), frozenset(self.NNPREDS))
+      with Query.PARSE_LOCK:
+         entry = Query.PARSE_CACHE.get(key)
+         if entry != None:
+            Query.PARSE_CACHE.move_to_end(key)
+            Query.PARSE_STATS['hits'] += 1
+      if entry != None:
+         tokens, self.parsed, dist_preds = entry
+         self.tokens = list(tokens)
+         for pred in dist_preds:
+            self.PREDS[pred.__name__] = pred
+         self.root = self.instantiate(self.parsed)
+         return
+      with Query.PARSE_LOCK:
+         Query.PARSE_STATS['misses'] += 1
+      self.tokenize()
+      self.parse()
+      dist_preds = [pred for pred in self.PREDS.values() if isinstance(pred, DistPred)]
+      with Query.PARSE_LOCK:
+         Query.PARSE_CACHE[key] = (list(self.tokens), self.parsed, dist_preds)
+         while len(Query.PARSE_CACHE) > Query.PARSE_CACHE_SIZE:
+            Query.PARSE_CACHE.popitem(last=False)
+            Query.PARSE_STATS['evicted'] += 1
    def flatten_tree(self):
       """
          combine contiguous 'and' or 'or' nodes into a single node
@@ -552,34 +1602,693 @@ class Query:
                ptr.children = ptr.children[:to_rm[r]]+ptr.children[to_rm[r]+1:]
             for child in ptr.children:
                depth_first(child)
+         elif ptr.op == 'not':
+            depth_first(ptr.children[0])
       depth_first(self.root)
-   def find_ecount(self, ecount):
-     lo = 0
-     hi = len(self.ecounts)-1
-     while lo <= hi:
-        mid = int( (lo+hi) / 2)
-        if self.ecounts[mid] == ecount:
-           return (True, mid)
-        elif self.ecounts[mid] < ecount:
-           lo = mid+1
-        else:
-           hi = mid-1
-     return (False, hi)
-   def delete_ecount(self, ecount):
-      found, indx = self.find_ecount(ecount) 
-      if not found:
-         fmt = 'Trying to delete unexistent ecount {} in {}'
-         handle_error(110615,fmt.format(ecount), self.ecounts)
-      self.ecounts = self.ecounts[:indx]+self.ecounts[indx+1:]
-   def update_ecount(self, oldcnt, newcnt):
-      # delete oldcnt
-      self.delete_ecount(oldcnt)
-      # insert newcnt
-      found, indx = self.find_ecount(newcnt) 
-      self.ecounts = self.ecounts[:indx+1]+[newcnt]+self.ecounts[indx+1:] 
-   def add_ecount(self, newcnt):
-      found, indx = self.find_ecount(newcnt) 
-      self.ecounts = self.ecounts[:indx+1]+[newcnt]+self.ecounts[indx+1:]           
+   def negate_tree(self):
+      """
+         replaces each 'not' node by a leaf that evaluates an anti-join (see 
+         anti_leaf). Columns of the negated expression that are output columns
+         or appear in predicates that are not negated are bound by the rest 
+         of the query; its other columns are quantified inside the negation: 
+         with tags AMOUNT and FOOTER, 'not subinterval(0,1)' projected on [0]
+         returns the amounts that are not inside any footer
+      """
+      def positive_cols(ptr, cols):
+         if ptr.op == 'not':
+            return
+         if len(ptr.children) == 0:
+            cols.update(ptr.params)
+         for child in ptr.children:
+            positive_cols(child, cols)
+      def depth_first(ptr):
+         for i, child in enumerate(ptr.children):
+            if child.op == 'not':
+               ptr.children[i] = self.anti_leaf(child.children[0], bound)
+            else:
+               depth_first(child)
+      bound = set(self.output_schema())
+      positive_cols(self.root, bound)
+      if self.root.op == 'not':
+         self.root = self.anti_leaf(self.root.children[0], bound)
+      else:
+         depth_first(self.root)
+   def anti_leaf(self, neg, bound):
+      """
+         neg :   root of negated expression
+         bound : columns bound by the rest of the query
+
+         Returns a leaf on the bound columns of <neg> that holds for the tuples
+         with no match in the result of <neg>. If <neg> is a predicate on bound
+         columns only, the leaf predicate is its negation. Otherwise the leaf
+         is recorded in self.ANTI and, when a previous result binds its 
+         columns, it is evaluated by anti_join, which only checks the tuples
+         of that result. Elsewhere (e.g. the leaf is the root or it is 
+         evaluated first in an 'or') its predicate computes the tuples of 
+         <neg> on all locations of the bound columns on its first call
+      """
+      node = Node(None)
+      cols = set(self.node_cols(neg))
+      node.params = sorted(cols.intersection(bound))
+      if len(node.params) == 0:
+         fmt = "Negated expression shares no column with the rest of query: {}"
+         handle_error(110619, fmt.format(self.query))
+      if len(neg.children) == 0 and set(neg.params) == set(node.params):
+         pred = neg.op
+         indices = [node.params.index(col) for col in neg.params]
+         node.op = lambda t: not pred(tuple([t[i] for i in indices]))
+         return node
+      excluded = []
+      def anti(t):
+         if len(excluded) == 0:
+            excluded.append(self.anti_excluded(neg, node.params))
+         return tuple([loc.order() for loc in t]) not in excluded[0]
+      node.op = anti
+      self.ANTI[anti] = (neg, sorted(cols))
+      return node
+   def anti_join(self, ptr, cols, tuples):
+      """
+         ptr :    anti-join leaf (see anti_leaf) whose columns are in cols
+         cols :   columns of tuples
+         tuples : previous result
+
+         Returns the tuples with no match in the negated expression of <ptr>,
+         which is evaluated only on the distinct locations of the columns of
+         <ptr> in <tuples> (see anti_excluded)
+      """
+      indices = [cols.index(col) for col in ptr.params]
+      cands = {}
+      for ltuple in tuples:
+         ctuple = tuple([ltuple[i] for i in indices])
+         cands.setdefault(tuple([loc.order() for loc in ctuple]), ctuple)
+      if len(cands) == 0:
+         return self.collect(cols, [])
+      neg, ncols = self.ANTI[ptr.op]
+      excluded = self.anti_excluded(neg, ptr.params, list(cands.values()))
+      return self.collect(cols, (ltuple for ltuple in tuples 
+                                 if tuple([ltuple[i].order() for i in indices]) not in excluded))
+   def anti_excluded(self, neg, params, cands=None):
+      """
+         neg :    root of negated expression
+         params : its bound columns
+         cands :  candidate tuples on params, None for all their locations
+
+         Returns the set of tuples of location orders on params that have a 
+         match in the result of <neg>. If <neg> is a predicate with a cheap 
+         semi-join (see semijoins) on a bound and a quantified column, the 
+         bound locations with a match are computed by the semi-join. Otherwise
+         a copy of <neg> is evaluated as a query that shares the tags and 
+         predicates of this query; the locations of bound columns are reduced
+         to those of the candidates, which are also the previous result of 
+         its root (see prev_result), so its leaves only extend candidates
+      """
+      def copy(ptr):
+         node = Node(ptr.op)
+         node.params = list(ptr.params)
+         node.children = [copy(child) for child in ptr.children]
+         return node
+      locs = {}
+      if cands != None:
+         for i, col in enumerate(params):
+            orders = {ctuple[i].order(): ctuple[i] for ctuple in cands}
+            locs[col] = [orders[key] for key in sorted(orders)]
+      sjoins = [] if len(neg.children) > 0 or len(neg.params) != 2 or neg.op in self.UDPS \
+               else self.semijoins(neg)
+      if len(sjoins) == 1 and len(params) == 1:
+         col1, col2, fn = sjoins[0]
+         locs1, locs2 = fn(self.tagger.get_locs(locs.get(col1, self.col_tag(col1))), 
+                           self.tagger.get_locs(locs.get(col2, self.col_tag(col2))))
+         res = locs1 if col1 == params[0] else locs2
+         return set([(loc.order(),) for loc in res])
+      root = copy(neg)
+      if cands != None:
+         if root.op != 'and':
+            node = Node('and')
+            node.children = [root]
+            root = node
+         root.result = [(list(params), cands)]
+      # columns quantified here are bound in nested negations
+      query = self.subquery(root, sorted(set(self.node_cols(neg))), locs)
+      if not query.prepare_tree():
+         return set()
+      while not query.root.done:
+         query.evaluate_step(params)
+      return query.result_orders(params)
+   def subquery(self, root, project, locs={}):
+      """
+         root :    root of a subtree of this query
+         project : output columns of subquery
+         locs :    column number --> its locations in the subquery, if they
+                   are not those of this query (default {})
+
+         Returns a Query on the same tags (or their locations reduced by 
+         semi-joins) and predicates whose tree is <root>. Estimates of pending
+         leaves are reset, they are computed by update_tree of the subquery
+      """
+      def depth_first(ptr):
+         if len(ptr.children) == 0 and not ptr.done:
+            ptr.ecount = None
+         for child in ptr.children:
+            depth_first(child)
+      depth_first(root)
+      query = Query([locs[i] if i in locs else self.col_tag(i) for i in range(len(self.qtags))], 
+                    self.query, self.tagger, project)
+      for attr in ['PREDS', 'NEAREST', 'NNPREDS', 'MULTIWAY', 'ANTI', 'UDPS', 'planned', 
+                   'max_tuples', 'token']:
+         setattr(query, attr, getattr(self, attr))
+      query.root = root
+      return query
+   def set_budget(self, max_tuples=None, max_memory=None):
+      """
+         sets self.max_tuples from the budget of execute: max_memory is 
+         converted to a number of tuples with the size of a tuple with a 
+         location for each column of the query
+      """
+      if max_memory != None:
+         size = sys.getsizeof(tuple(range(len(self.qtags)))) + 8
+         by_memory = max(1, max_memory // size)
+         max_tuples = by_memory if max_tuples == None else min(max_tuples, by_memory)
+      if max_tuples != None and max_tuples < 1:
+         handle_error(110623, 'Invalid budget: max_tuples {}'.format(max_tuples))
+      self.max_tuples = max_tuples
+   def set_token(self, timeout=None, max_predicate_calls=None, token=None):
+      """
+         sets self.token from the limits of execute
+      """
+      if token == None and timeout == None and max_predicate_calls == None:
+         self.token = None
+         return
+      self.token = token if token != None else CancelToken()
+      self.token.limit(timeout, max_predicate_calls)
+   def node_text(self, ptr):
+      """
+         Returns the subquery of node <ptr> as text, e.g. before(0,1)
+      """
+      if len(ptr.children) == 0:
+         names = {fn: name for name, fn in self.PREDS.items()}
+         name = names.get(ptr.op, getattr(ptr.op, '__name__', str(ptr.op)))
+         return "{}({})".format(name, ','.join([str(col) for col in ptr.params]))
+      return "(" + " {} ".format(ptr.op).join([self.node_text(child) for child in ptr.children]) + ")"
+   def running(self, ptr):
+      """
+         records node <ptr> as the node being evaluated in the token and 
+         checks the token
+      """
+      if self.token != None:
+         self.token.node = self.node_text(ptr)
+         self.token.check()
+   def canon_locs(self, col):
+      """
+         Returns dictionary from location orders to locations of column <col>,
+         used to read back spilled results (see SpillList)
+      """
+      if col not in self.canon:
+         locs = self.tagger.get_locs(self.qtags[col])
+         self.canon[col] = {loc.order(): loc for loc in locs}
+      return self.canon[col]
+   def collect(self, sch, tuples):
+      """
+         Returns the tuples of iterable <tuples> with columns <sch> in a list,
+         or in a SpillList if they exceed self.max_tuples
+      """
+      return collect(sch, tuples, self.max_tuples, self.canon_locs)
+   def product_tuples(self, tuples, ptuples, schema):
+      """
+         cartesian_prod, computed in chunks if there is a budget of tuples
+      """
+      if self.max_tuples == None:
+         return cartesian_prod(tuples, ptuples, schema, self.token)
+      soutput, res = cartesian_iter(tuples, ptuples, schema, self.token)
+      return soutput, self.collect(soutput, res)
+   def join_tuples(self, sch_tuples1, sch_tuples2):
+      """
+         natural_inner_join, computed in chunks if there is a budget of tuples
+      """
+      if self.max_tuples == None:
+         return natural_inner_join(sch_tuples1, sch_tuples2, self.token)
+      sch, res = hash_join(sch_tuples1, sch_tuples2, self.max_tuples, self.token)
+      return sch, self.collect(sch, res)
+   def infer_tree(self):
+      """
+         rewrites the tree with the order relations implied by conjunctions:
+         derives the before and subinterval facts implied by the leaves of 
+         each 'and' node and its ancestors (see order_closure), removes leaves
+         with a before or subinterval predicate implied by the other facts, 
+         and removes subtrees with contradictions such as before(0,1) and 
+         before(1,0). Facts implied by the root that are not leaves are kept
+         in self.implied to be used as semi-joins
+         Returns False if the whole query is a contradiction
+      """
+      def depth_first(ptr, inherited):
+         """
+            inherited : facts of 'and' ancestors of <ptr>
+            Returns False if subtree of <ptr> is a contradiction
+         """
+         if ptr.op == 'or':
+            ptr.children = [child for child in ptr.children if depth_first(child, inherited)]
+            return len(ptr.children) > 0
+         leaves = [ptr] if len(ptr.children) == 0 else \
+                  [child for child in ptr.children if len(child.children) == 0]
+         own = set()
+         for leaf in leaves:
+            own.update(self.leaf_facts(leaf))
+         facts = order_closure(inherited.union(own))
+         if any([op == before and a == b for op, a, b in facts]):
+            return False
+         if ptr == self.root:
+            self.implied = facts.difference(own)
+         if len(ptr.children) == 0:
+            return True
+         for child in ptr.children:
+            if len(child.children) > 0 and not depth_first(child, facts):
+               return False
+         # remove leaves implied by the other facts
+         for leaf in leaves:
+            if leaf.op not in [before, subinterval] or len(leaf.params) != 2 \
+               or len(ptr.children) == 1:
+               continue
+            fact = (leaf.op, leaf.params[0], leaf.params[1])
+            others = set()
+            for other in ptr.children:
+               if other != leaf and len(other.children) == 0:
+                  others.update(self.leaf_facts(other))
+            if fact in order_closure(inherited.union(others)):
+               ptr.children.remove(leaf)
+         return True
+      return depth_first(self.root, set())
+   def leaf_facts(self, ptr):
+      """
+         Returns set of facts implied by leaf <ptr>, see order_facts. Facts of
+         user defined predicates come from their properties (see UDP)
+      """
+      if ptr.op not in self.UDPS:
+         return order_facts(ptr.op, ptr.params)
+      props = self.UDPS[ptr.op]['properties']
+      facts = set()
+      if 'before' in props:
+         facts.update(order_facts(seq_before, ptr.params))
+      if 'subinterval' in props and len(ptr.params) == 2:
+         facts.update(order_facts(subinterval, ptr.params))
+      return facts
+   def probe_leaf(self, ptr):
+      """
+         checks whether leaf <ptr> has some result without evaluating it: 
+         chains stop at the first chain found (see seq_chain) and predicates
+         with a semi-join on two columns check whether it keeps some location
+         Returns True or False, None if the leaf has no cheap check
+      """
+      locs = [self.tagger.get_locs(self.col_tag(col)) for col in ptr.params]
+      windows = self.chain_windows(ptr)
+      if windows != None:
+         return next(seq_chain(locs, windows, self.token), None) != None
+      if len(ptr.params) != 2 or ptr.params[0] == ptr.params[1] or ptr.op in self.UDPS:
+         return None
+      sjoins = self.semijoins(ptr)
+      if len(sjoins) != 1:
+         return None
+      locs1, locs2 = sjoins[0][2](locs[0], locs[1])
+      return len(locs1) > 0
+   def probe_tree(self):
+      """
+         checks, in ascending order of cost, whether the leaves of the 
+         conjunction at the root have some result (see probe_leaf)
+         Returns False if one of them has no results, i.e. query result is
+         empty, True otherwise
+      """
+      if len(self.root.children) == 0:
+         leaves = [self.root]
+      elif self.root.op == 'and':
+         leaves = [child for child in self.root.children if len(child.children) == 0]
+      else:
+         return True
+      for leaf in sorted(leaves, key=self.leaf_cost):
+         self.running(leaf)
+         if self.probe_leaf(leaf) == False:
+            return False
+      return True
+   def prune(self, ptr):
+      """
+         marks 'and' node <ptr>, whose result is empty, and its pending 
+         descendants as done, so their leaves are not evaluated
+      """
+      def depth_first(node):
+         if node.done:
+            return
+         node.done = True
+         if len(node.children) == 0:
+            node.result = [(sorted(node.params), [])]
+            node.ecount = 0
+         for child in node.children:
+            depth_first(child)
+      ptr.result = [(sch, []) for sch, tuples in ptr.result]
+      for child in ptr.children:
+         depth_first(child)
+      ptr.done = True
+   def index_tree(self):
+      """
+         records the parent of each node of the tree and numbers its leaves
+         in depth-first order, the order in which leaves with equal estimates
+         are evaluated. Pending leaves are scheduled again by update_tree
+      """
+      def depth_first(ptr, parent):
+         self.parents[ptr] = parent
+         if len(ptr.children) == 0:
+            self.leaf_index[ptr] = len(self.leaf_index)
+         for child in ptr.children:
+            depth_first(child, ptr)
+      self.parents = {}
+      self.leaf_index = {}
+      self.heap = []
+      depth_first(self.root, None)
+   def priority(self, leaf):
+      """
+         key of <leaf> in the heap: its estimated count, or 0 if the tree was
+         planned (see plan_tree), so leaves are evaluated in depth-first order
+      """
+      return 0 if self.planned else leaf.ecount
+   def schedule(self, leaf):
+      """
+         pushes pending <leaf> in the heap with its current estimate. An 
+         entry whose key differs from the current estimate of its leaf is 
+         stale and is skipped by next_leaf
+      """
+      self.tick += 1
+      entry = (self.priority(leaf), self.leaf_index[leaf], self.tick, leaf)
+      heapq.heappush(self.heap, entry)
+   def next_leaf(self):
+      """
+         Returns the pending leaf with the lowest estimated count, the first
+         one in depth-first order if several leaves have the same estimate
+      """
+      while len(self.heap) > 0:
+         key, indx, tick, leaf = heapq.heappop(self.heap)
+         if not leaf.done and key == self.priority(leaf):
+            return leaf
+      handle_error(110615, 'No pending leaf to evaluate in query: {}'.format(self.query))
+   def prev_result(self, ptr):
+      """
+         Returns the result of the nearest 'and' ancestor of <ptr> with a 
+         result, the tuples its pending leaves are evaluated with, or None
+      """
+      ptr = self.parents[ptr]
+      while ptr != None:
+         if ptr.op == 'and' and len(ptr.result) > 0:
+            return ptr.result
+         ptr = self.parents[ptr]
+      return None
+   def col_tag(self, col):
+      """
+         Returns tag of column <col>, or its list of locations if it was
+         reduced by semi-joins
+      """
+      if col in self.locs:
+         return self.locs[col]
+      return self.qtags[col]
+   def semijoins(self, ptr):
+      """
+         Returns list of (col1, col2, function) for leaf <ptr>, where function
+         applies a semi-join on a pair of location lists of columns col1 and col2.
+         Returns [] if the predicate of <ptr> does not have a cheap semi-join
+      """
+      if isinstance(ptr.op, DistPred):
+         ranges = ptr.op.ranges
+         return [(ptr.params[0], ptr.params[1], lambda l1, l2: semijoin_dist(l1, l2, ranges))]
+      if ptr.op in self.NEAREST:
+         orders1 = set()
+         orders2 = set()
+         for l1, l2 in self.nearest_pairs(ptr.op):
+            orders1.add(l1.order())
+            orders2.add(l2.order())
+         def semijoin_nearest(locs1, locs2):
+            return [loc for loc in locs1 if loc.order() in orders1], \
+                   [loc for loc in locs2 if loc.order() in orders2]
+         return [(ptr.params[0], ptr.params[1], semijoin_nearest)]
+      if isinstance(ptr.op, ChainPred):
+         windows = ptr.op.windows(len(ptr.params))
+         return [(ptr.params[i], ptr.params[i+1], 
+                  lambda l1, l2, w=windows[i]: semijoin_window(l1, l2, w[0], w[1]))
+                 for i in range(len(ptr.params)-1)]
+      if ptr.op in self.UDPS:
+         # semi-joins of the properties of the predicate
+         sjfn = {before: semijoin_before, subinterval: semijoin_subinterval}
+         res = [(a, b, sjfn[op]) for op, a, b in self.leaf_facts(ptr)]
+         if 'same_offset' in self.UDPS[ptr.op]['properties']:
+            res = res + [(ptr.params[i], ptr.params[i+1], semijoin_offset) 
+                         for i in range(len(ptr.params)-1)]
+         return res
+      sjfn = {subinterval: semijoin_subinterval,
+              before: semijoin_before,
+              meets: semijoin_meets,
+              equal: semijoin_equal,
+              seq_before: semijoin_before,
+              seq_meets: semijoin_meets,
+              seq_before_meets: lambda l1, l2: semijoin_before(l1, l2, True)}
+      if ptr.op not in sjfn:
+         return []
+      # consecutive columns of seq_ predicates
+      return [(ptr.params[i], ptr.params[i+1], sjfn[ptr.op]) for i in range(len(ptr.params)-1)]
+   def semijoin_reduce(self):
+      """
+         Reduces the locations of each column with semi-joins along the predicates
+         of the conjunction at the root of the tree (Yannakakis-style reduction):
+         a location is discarded if it is not related by the predicate with any
+         location of the other column. Repeats until no list shrinks.
+         Reduced lists are kept in self.locs and self.lcount is updated.
+         Returns False if a list becomes empty, i.e. query result is empty
+      """
+      if len(self.root.children) == 0:
+         leaves = [self.root]
+      elif self.root.op == 'and':
+         leaves = [child for child in self.root.children if len(child.children) == 0]
+      else:
+         return True
+      sjoins = []
+      for leaf in leaves:
+         sjoins = sjoins + [sj for sj in self.semijoins(leaf) if sj[0] != sj[1]]
+      # implied facts are also semi-joins
+      sjfn = {before: semijoin_before, subinterval: semijoin_subinterval}
+      sjoins = sjoins + [(a, b, sjfn[op]) for op, a, b in self.implied if a != b]
+      for col1, col2, fn in sjoins:
+         for col in [col1, col2]:
+            if col not in self.locs:
+               self.locs[col] = self.tagger.get_locs(self.qtags[col])
+      changed = True
+      while changed:
+         changed = False
+         for col1, col2, fn in sjoins:
+            locs1, locs2 = fn(self.locs[col1], self.locs[col2])
+            if len(locs1) != len(self.locs[col1]) or len(locs2) != len(self.locs[col2]):
+               changed = True
+            self.locs[col1] = locs1
+            self.locs[col2] = locs2
+            if len(locs1) == 0 or len(locs2) == 0:
+               return False
+      for col in self.locs:
+         self.lcount[col] = len(self.locs[col])
+      return True
+   def leaf_cost(self, ptr):
+      """
+         computes the cost of evaluating leaf predicate on its parameters
+         dist predicates are evaluated with a proximity join, O((n+m) log m),
+         other predicates on the cartesian product of their parameters.
+         The cost of a result shared by a QueryBatch is its number of tuples
+      """
+      if self.shared != None:
+         key = self.leaf_key(ptr)
+         if key in self.shared.results:
+            return len(self.shared.results[key][0])
+      if ptr.op in self.MULTIWAY:
+         return sum([self.leaf_cost(part) for part in self.MULTIWAY[ptr.op]])
+      if ptr.op in self.ANTI:
+         # negated expression on all the locations of its columns, so the 
+         # leaf is evaluated after a previous result binds its columns
+         cnt = 1
+         for col in self.ANTI[ptr.op][1]:
+            cnt = cnt * self.lcount[col]
+         return cnt
+      if isinstance(ptr.op, DistPred) or ptr.op in self.NEAREST:
+         n = self.lcount[ptr.params[0]]
+         m = self.lcount[ptr.params[1]]
+         return round((n+m) * math.log(m+1, 2), 0) + 1
+      cnt = 1
+      for col in ptr.params:
+         cnt = cnt * self.lcount[col]
+      if self.chain_windows(ptr) != None:
+         # sort and search for each position, plus the chains found
+         cnts = [self.lcount[col] for col in ptr.params]
+         return round(sum([n * math.log(n+1, 2) for n in cnts]) + cnt * self.selectivity(ptr), 0) + 1
+      if ptr.op in self.UDPS and self.udp_strategy(ptr) != None:
+         # sort and search, then evaluate predicate on candidates
+         n = self.lcount[ptr.params[0]]
+         m = self.lcount[ptr.params[-1]]
+         if self.udp_strategy(ptr) == 'batch':
+            return round((n+m) * math.log(m+1, 2), 0) + 1
+         if self.udp_strategy(ptr) == 'symmetric':
+            return round(cnt / 2, 0) + 1
+         return round((n+m) * math.log(m+1, 2) + cnt * self.selectivity(ptr), 0) + 1
+      return cnt
+   def leaf_key(self, ptr):
+      """
+         Returns key that identifies the result of leaf <ptr> among the queries
+         of a QueryBatch: its predicate, the tags of its parameters and the 
+         positions of repeated parameters
+      """
+      if isinstance(ptr.op, DistPred):
+         op = ('dist', tuple(ptr.op.ranges))
+      elif ptr.op in self.NEAREST:
+         op = ('nearest',) + self.NEAREST[ptr.op][1:]
+      else:
+         op = ptr.op
+      tags = tuple([tag_key(self.col_tag(col)) for col in ptr.params])
+      return (op, tags, tuple([ptr.params.index(col) for col in ptr.params]))
+   def chain_windows(self, ptr):
+      """
+         Returns list of (lo, hi) ranges between consecutive parameters of leaf
+         <ptr> if its predicate is a chain (before, meets, their seq_ versions
+         or a ChainPred) on distinct columns, None otherwise
+      """
+      if len(set(ptr.params)) != len(ptr.params) or len(ptr.params) < 2:
+         return None
+      if isinstance(ptr.op, ChainPred):
+         return ptr.op.windows(len(ptr.params))
+      steps = {before: 'before', seq_before: 'before', meets: 'meets', seq_meets: 'meets',
+               seq_before_meets: 'before_meets'}
+      if ptr.op not in steps:
+         return None
+      return [step_window(steps[ptr.op])] * (len(ptr.params)-1)
+   def udp_strategy(self, ptr):
+      """
+         Returns how user defined predicate of leaf <ptr> is evaluated: 'batch'
+         with its batch function, 'band' on the candidate pairs of its 
+         properties (see band_pairs), 'symmetric' on half the pairs of a tag 
+         with itself, or None on the cartesian product of its parameters
+      """
+      meta = self.UDPS[ptr.op]
+      props = meta['properties']
+      if meta['batch'] != None:
+         return 'batch'
+      if len(ptr.params) != 2:
+         return None
+      if len(props.intersection(['same_offset', 'before', 'subinterval'])) > 0:
+         return 'band'
+      if 'symmetric' in props and \
+         tag_key(self.col_tag(ptr.params[0])) == tag_key(self.col_tag(ptr.params[1])):
+         return 'symmetric'
+      return None
+   def eval_udp(self, ptr):
+      """
+         evaluates user defined predicate of leaf <ptr>, see udp_strategy
+      """
+      pred = ptr.op
+      strategy = self.udp_strategy(ptr)
+      locs = [self.tagger.get_locs(self.col_tag(col)) for col in ptr.params]
+      if strategy == 'batch':
+         if self.token != None: self.token.check()
+         return [tuple(t) for t in self.UDPS[pred]['batch'](*locs)]
+      if strategy == 'band':
+         pairs = band_pairs(locs[0], locs[1], self.UDPS[pred]['properties'])
+      elif strategy == 'symmetric':
+         # (l1, l2) with l1 at or before l2, their results are mirrored
+         pairs = ((locs[0][i], locs[0][j]) for i in range(len(locs[0])) 
+                                           for j in range(i, len(locs[0])))
+      else:
+         return self.tagger.select(pred, [self.col_tag(col) for col in ptr.params], 
+                                   token=self.token)
+      res = []
+      for pair in pairs:
+         if self.token != None: self.token.check(1)
+         if pred(pair):
+            res.append(pair)
+            if strategy == 'symmetric' and pair[0] is not pair[1]:
+               res.append((pair[1], pair[0]))
+      return res
+   def select_leaf(self, ptr):
+      """
+         evaluates leaf predicate on the locations of the tags in its parameters
+         returns list of location tuples with columns in the order of ptr.params
+         if the query is in a QueryBatch, the result is shared with its other
+         queries
+      """
+      if self.shared == None:
+         return self.eval_leaf(ptr)
+      key = self.leaf_key(ptr)
+      if key in self.shared.results:
+         return self.shared.reuse(key)
+      cost = self.leaf_cost(ptr)
+      res = self.eval_leaf(ptr)
+      self.shared.store(key, res, cost)
+      return res
+   def eval_leaf(self, ptr):
+      """
+         evaluates leaf predicate, see select_leaf
+      """
+      tags = [ self.col_tag(i) for i in ptr.params ]
+      if isinstance(ptr.op, DistPred):
+         pairs = chain.from_iterable([self.tagger.proximity_iter(tags[0], tags[1], lo, hi)
+                                      for lo, hi in ptr.op.ranges])
+         return self.collect(ptr.params, pairs)
+      if ptr.op in self.NEAREST:
+         return self.collect(ptr.params, self.nearest_pairs(ptr.op))
+      if ptr.op in self.UDPS:
+         return self.eval_udp(ptr)
+      windows = self.chain_windows(ptr)
+      if windows != None:
+         chains = seq_chain([self.tagger.get_locs(tag) for tag in tags], windows, self.token)
+         return self.collect(ptr.params, chains)
+      if ptr.op in self.MULTIWAY:
+         # predicates with up to two parameters are evaluated and indexed,
+         # seq_ predicates are also indexed by their consecutive pairs,
+         # other predicates filter the result
+         relations = []
+         filters = []
+         for part in self.MULTIWAY[ptr.op]:
+            if len(part.params) <= 2:
+               relations.append((part.params, self.select_leaf(part)))
+               continue
+            filters.append((part.params, part.op))
+            windows = self.chain_windows(part)
+            if windows != None:
+               for i in range(len(part.params)-1):
+                  locs = [self.tagger.get_locs(self.col_tag(col)) for col in part.params[i:i+2]]
+                  relations.append((part.params[i:i+2], 
+                                    list(seq_chain(locs, windows[i:i+1], self.token))))
+         # columns not in any relation take all their locations
+         for col in ptr.params:
+            if not any([col in schema for schema, tuples in relations]):
+               relations.append(([col], [(loc,) for loc in self.tagger.get_locs(self.col_tag(col))]))
+         # bind columns with fewer locations first
+         cols = sorted(ptr.params, key=lambda col: self.lcount[col])
+         indices = [cols.index(col) for col in ptr.params]
+         return [tuple([t[i] for i in indices]) 
+                 for t in generic_join(relations, cols, filters, self.token)]
+      if self.max_tuples != None:
+         return self.collect(ptr.params, self.tagger.select_iter(ptr.op, tags, token=self.token))
+      return self.tagger.select(ptr.op, tags, token=self.token)
+   def dist_scan(self, ptr, cols, tuples):
+      """
+         ptr :   leaf with a DistPred predicate
+         cols :  columns of tuples, they include a parameter of ptr
+         tuples: previous result
+
+         evaluates the predicate of <ptr> from the locations of a bound column
+         in <tuples>: the locations of the other column are found by range 
+         scans on their sorted positions (see Tagger.proximity)
+         returns location pairs with columns in the order of ptr.params, in a
+         list or in a SpillList if they exceed self.max_tuples
+      """
+      col1, col2 = ptr.params
+      bound = col1 if col1 in cols else col2
+      indx = cols.index(bound)
+      locs = list({t[indx].order(): t[indx] for t in tuples}.values())
+      def pairs():
+         for lo, hi in ptr.op.ranges:
+            if bound == col1:
+               yield from self.tagger.proximity_iter(locs, self.col_tag(col2), lo, hi)
+            else:
+               for loc2, loc1 in self.tagger.proximity_iter(locs, self.col_tag(col1), 
+                                                            lo, hi, 'before'):
+                  yield (loc1, loc2)
+      return self.collect(ptr.params, pairs())
    def partial_cost(self, ptr, cols, tuples):
       """
          computes the cost of evaluating predicate on with prev results (cols, tuples)
@@ -595,51 +2304,229 @@ class Query:
          # cols and ptr.params are disjoint
          disjoint = True
          eval_on_expansion = None
-         # evaluate predicate on cartesian product of predicate parameters
-         cnt = 1
-         for col in ptr.params:
-            cnt = cnt * self.count[col]
+         # evaluate predicate on its parameters
+         cnt = self.leaf_cost(ptr)
          # apply cartesian product on eval result and prev result
          cnt = cnt * len(tuples)
+      elif isinstance(ptr.op, DistPred):
+         # range scans from the locations of a bound column, see dist_scan
+         disjoint = False
+         other = ptr.params[1] if ptr.params[0] in cols else ptr.params[0]
+         cnt = round(len(tuples) * math.log(self.lcount[other]+1, 2), 0) + 1
+         eval_on_expansion = False
       else:
          disjoint = False
          # evaluate predicate on cartesian product of tuples and tags in extra_cols
          cnt1 = len(tuples)
          for col in extra_cols:
-            cnt1 = cnt1 * self.count[col]
-         # evaluate predicate on cartesian product of predicate parameters
-         cnt2 = 1
-         for col in ptr.params:
-            cnt2 = cnt2 * self.count[col]
+            cnt1 = cnt1 * self.lcount[col]
+         # evaluate predicate on its parameters
+         cnt2 = self.leaf_cost(ptr)
          # apply join on eval result and prev result
          if cnt2 != 0 and len(tuples) != 0:
             cnt2 += cnt2 * math.log(cnt2) + len(tuples) * math.log(len(tuples))
          cnt = min(cnt1, round(cnt2,0)) # originally cnt = cnt1
          eval_on_expansion = (cnt == cnt1)
       return cnt, disjoint, eval_on_expansion
+   def selectivity(self, ptr):
+      """
+         estimates the fraction of the cartesian product of the parameters of 
+         leaf <ptr> that satisfies its predicate
+      """
+      cnts = [max(self.lcount[col], 1) for col in ptr.params]
+      if ptr.op in self.MULTIWAY:
+         sel = 1
+         for part in self.MULTIWAY[ptr.op]:
+            sel = sel * self.selectivity(part)
+         return sel
+      if ptr.op in self.UDPS:
+         meta = self.UDPS[ptr.op]
+         if meta['selectivity'] != None:
+            return meta['selectivity']
+         if 'subinterval' in meta['properties'] and len(cnts) == 2:
+            return 1 / cnts[1]
+         if 'before' in meta['properties']:
+            return 1 / math.factorial(len(cnts))
+         return 0.5
+      if isinstance(ptr.op, DistPred):
+         width = 0
+         for lo, hi in ptr.op.ranges:
+            width += len(self.tagger.text) if hi == None else hi-lo+1
+         return min(1.0, width / max(len(self.tagger.text), 1))
+      if ptr.op in self.NEAREST:
+         return min(1.0, self.NEAREST[ptr.op][1] / cnts[1])
+      if ptr.op in [subinterval, during, starts, finishes]:
+         return 1 / cnts[1]
+      if ptr.op in [equal, meets, overlaps, intersects]:
+         return 1 / max(cnts)
+      if ptr.op in [before, seq_before, seq_before_meets] or \
+         (isinstance(ptr.op, ChainPred) and ptr.op.step != 'meets'):
+         return 1 / math.factorial(len(cnts))
+      if ptr.op == seq_meets or isinstance(ptr.op, ChainPred):
+         sel = 1
+         for i in range(len(cnts)-1):
+            sel = sel / max(cnts[i], cnts[i+1])
+         return sel
+      if ptr.op == disjoint:
+         return 1.0
+      return 0.5
+   def plan_and(self, items):
+      """
+         items : list of triples (cols, card, cost) with the set of columns, estimated 
+                 number of tuples and estimated cost of the children of an 'and' node
+                 
+         computes the order to evaluate the children, avoiding cartesian products
+         unless children are not connected by columns. It uses dynamic programming
+         on subsets of children if there are at most MAX_DP_CHILDREN children, 
+         otherwise it adds the cheapest connected child at each step
+         
+         Returns triple (order, card, cost) where order is the list of indices of
+         items in evaluation order, card and cost are the estimated number of tuples
+         and cost of evaluating the children in that order
+      """
+      def product(cols):
+         cnt = 1
+         for col in cols:
+            cnt = cnt * max(self.lcount[col], 1)
+         return cnt
+      def extend(cols, card, indx):
+         """
+            estimates columns, number of tuples and cost of adding child <indx>
+            to a result with columns <cols> and <card> tuples
+         """
+         icols, icard, icost = items[indx]
+         shared = cols.intersection(icols)
+         if len(shared) == 0:
+            # cartesian product
+            newcard = card * icard
+            cost = icost + newcard
+         else:
+            newcard = card * icard / product(shared)
+            # evaluate on expansion or evaluate child and join
+            cost = min(card * product(icols.difference(cols)), icost + card + icard) + newcard
+         return cols.union(icols), newcard, cost
+      def candidates(cols, pending):
+         # pending children connected to cols, or all of them if none is connected
+         connected = [i for i in pending if len(cols.intersection(items[i][0])) > 0]
+         return connected if len(connected) > 0 else pending
+      n = len(items)
+      if n <= Query.MAX_DP_CHILDREN:
+         # best[mask] = (cost, card, cols, order) for subset mask of children
+         best = {}
+         for i in range(n):
+            cols, card, cost = items[i]
+            best[1 << i] = (cost + card, card, cols, [i])
+         for mask in range(1, 1 << n):
+            if mask not in best: continue
+            cost, card, cols, order = best[mask]
+            pending = [i for i in range(n) if not mask & (1 << i)]
+            for i in candidates(cols, pending):
+               newcols, newcard, step = extend(cols, card, i)
+               newmask = mask | (1 << i)
+               if newmask not in best or cost + step < best[newmask][0]:
+                  best[newmask] = (cost + step, newcard, newcols, order + [i])
+         cost, card, cols, order = best[(1 << n) - 1]
+         return order, card, cost
+      # greedy: start with cheapest child, then add the cheapest connected child
+      first = min(range(n), key=lambda i: items[i][2] + items[i][1])
+      order = [first]
+      cols, card, cost = items[first]
+      cost = cost + card
+      pending = [i for i in range(n) if i != first]
+      while len(pending) > 0:
+         steps = [(extend(cols, card, i), i) for i in candidates(cols, pending)]
+         (cols, card, step), i = min(steps, key=lambda x: x[0][2])
+         cost += step
+         order.append(i)
+         pending.remove(i)
+      return order, card, cost
+   def multiway_leaf(self, leaves):
+      """
+         leaves : list of leaf nodes of a conjunction
+         
+         Returns a leaf node whose predicate is the conjunction of the predicates
+         in <leaves> and whose parameters are the union of their parameters.
+         It is evaluated with a multiway join (see generic_join)
+      """
+      params = sorted(set([col for leaf in leaves for col in leaf.params]))
+      def pred(ltuple):
+         for leaf in leaves:
+            if not leaf.op(tuple([ltuple[params.index(col)] for col in leaf.params])):
+               return False
+         return True
+      self.MULTIWAY[pred] = leaves
+      node = Node(pred)
+      node.params = params
+      return node
+   def multiway_tree(self):
+      """
+         replaces the leaves of each 'and' node whose columns form a cyclic
+         hypergraph (see is_cyclic) by a single leaf evaluated with a multiway join
+      """
+      def depth_first(ptr):
+         for child in ptr.children:
+            depth_first(child)
+         if ptr.op == 'and':
+            leaves = [child for child in ptr.children if len(child.children) == 0]
+            if len(leaves) > 2 and is_cyclic([set(leaf.params) for leaf in leaves]):
+               others = [child for child in ptr.children if len(child.children) > 0]
+               ptr.children = [self.multiway_leaf(leaves)] + others
+      depth_first(self.root)
+   def plan_tree(self):
+      """
+         computes a fixed evaluation plan before the evaluation starts:
+         children of each 'and' node are sorted in the order computed by plan_and,
+         and leaves are evaluated in depth-first order. If no 'and' node has
+         several children, leaves are scheduled by their estimated counts
+      """
+      def depth_first(ptr):
+         """
+            sorts children of 'and' nodes in the subtree of <ptr>
+            returns (cols, card, cost) of <ptr>
+         """
+         if len(ptr.children) == 0:
+            card = self.selectivity(ptr)
+            for col in ptr.params:
+               card = card * self.lcount[col]
+            return set(ptr.params), card, self.leaf_cost(ptr)
+         items = [depth_first(child) for child in ptr.children]
+         cols = set()
+         for icols, icard, icost in items:
+            cols = cols.union(icols)
+         if ptr.op == 'or':
+            return cols, sum([i[1] for i in items]), sum([i[2] for i in items])
+         order, card, cost = self.plan_and(items)
+         ptr.children = [ptr.children[i] for i in order]
+         if len(order) > 1:
+            self.planned = True
+         return cols, card, cost
+      depth_first(self.root)
    def get_cost_leaf(self, ptr, prev_res):
        """
           updates estimate of computation cost of evaluating a leaf 
        """
        if prev_res == None:
-          # O(n): where n is size of cartesian product
-          ptr.ecount = 1
-          for col in ptr.params:
-             ptr.ecount = ptr.ecount * self.count[col]
+          ptr.ecount = self.leaf_cost(ptr)
           return None
        else:
           ptr.ecount = 0
           for cols, tuples in prev_res:
              cost, disjoint, eval_on_expansion = self.partial_cost(ptr, cols, tuples)
              ptr.ecount += cost
-   def update_tree(self):
+   def update_tree(self, leaf=None):
       """
+         leaf : leaf evaluated by compute_leaf, None to update the whole tree
+
+         an 'and' node whose result is empty is pruned, see prune
          traverse tree to update results of 'and'/'or' nodes if computation of
          their children was completed. 
          it traverses the tree depth-first and updates the nodes when returning
          to the node after visiting all its descendants
          moves up the results to update 'and' nodes results 
-         update ecount of leaves
+         update ecount of leaves and schedule them, see schedule
+         After evaluating <leaf>, only its ancestors are updated and only the
+         pending leaves below the highest ancestor whose result changed are
+         estimated again
       """
       def update_node(ptr, parent):
          """
@@ -663,49 +2550,120 @@ class Query:
                      handle_error(110616, msg )
                   else:
                      # apply join AQUI -- parent.result = naturaljoin(parent.result,ptr.result)
+                     self.running(parent)
                      new_parent_result =[]
                      for s1,t1 in parent.result:
                         for s2,t2 in ptr.result:
                            schema_inter = set(s1).intersection(set(s2))
                            if len(schema_inter) > 0:
-                              schema,tuples = natural_inner_join((s1,t1), (s2,t2))
+                              schema,tuples = self.join_tuples((s1,t1), (s2,t2))
                            else:
-                              schema,tuples = cartesian_prod(t1, t2, schema={'tuples':s1,'pred':s2})
+                              schema,tuples = self.product_tuples(t1, t2, schema={'tuples':s1,'pred':s2})
                            new_schema = True
                            for i, pair in enumerate(new_parent_result):
                               s,t = pair
                               if schema == s:
-                                 new_parent_result[i] = (s, rm_dups(t + tuples))
+                                 new_parent_result[i] = (s, rm_dups(concat(t, tuples)))
                                  new_schema = False
                                  break
                            if new_schema:
                               new_parent_result.append((schema,tuples))  
                      parent.result = new_parent_result      
+                  if is_empty(parent.result):
+                     # the conjunction is empty, skip its pending children
+                     self.prune(parent)
                else:
                   # parent is 'or', append result
                   merge_results(parent.result, ptr.result)
+      def cost_leaf(ptr, prev_res, reschedule):
+         prev_ecount = ptr.ecount
+         self.get_cost_leaf(ptr, prev_res)
+         if reschedule or ptr.ecount != prev_ecount:
+            # the previous entry of ptr in the heap is now stale
+            self.schedule(ptr)
+      def estimate(ptr, prev_res):
+         if ptr.done:
+            return
+         if len(ptr.children) == 0:
+            cost_leaf(ptr, prev_res, False)
+            return
+         if ptr.op == 'and' and len(ptr.result) > 0:
+            prev_res = ptr.result
+         for child in ptr.children:
+            estimate(child, prev_res)
       def depth_first(ptr, parent, prev_res):
          if len(ptr.children) == 0:
             # a leaf
             if not ptr.done:
-               prev_ecount = ptr.ecount
-               self.get_cost_leaf(ptr, prev_res)
-               # update self.ecounts
-               if prev_ecount == None:
-                  self.add_ecount(ptr.ecount)
-               else:
-                  self.update_ecount(prev_ecount, ptr.ecount)
+               cost_leaf(ptr, prev_res, True)
          else:
             # inner node
-            if not ptr.done:
+            if ptr.op == 'and' and not ptr.done and is_empty(ptr.result):
+               self.prune(ptr)
+               update_node(ptr, parent)
+            elif not ptr.done:
                if ptr.op == 'and' and len(ptr.result) > 0:
                   # and's current results move down
                   prev_res = ptr.result
                for child in ptr.children:
                   depth_first(child, ptr, prev_res)
                update_node(ptr, parent)
-      depth_first(self.root, None, None)
+      if leaf == None:
+         self.index_tree()
+         depth_first(self.root, None, None)
+         return
+      # ancestors of leaf are updated until one of them is still pending
+      changed = None
+      ptr = self.parents[leaf]
+      while ptr != None:
+         changed = ptr
+         parent = self.parents[ptr]
+         if ptr.op == 'and' and not ptr.done and is_empty(ptr.result):
+            self.prune(ptr)
+         update_node(ptr, parent)
+         if not ptr.done:
+            break
+         ptr = parent
+      if self.root.op == 'and':
+         # result of the root was projected, see push_projection
+         changed = self.root
+      if changed != None:
+         estimate(changed, self.prev_result(changed))
         
+   def push_projection(self, oschema):
+      """
+         oschema : list of output columns
+
+         projects the result of a root 'and' node on the columns that are
+         still needed: output columns, parameters of pending leaves and columns
+         of partial results of pending inner nodes, that will be joined with
+         the root result. duplicates left by the projection are removed, so
+         the tuples pushed down to the pending leaves do not grow with columns
+         that are no longer referenced
+      """
+      def depth_first(ptr, cols):
+         if len(ptr.children) == 0:
+            if not ptr.done:
+               cols.update(ptr.params)
+            return
+         if ptr.done:
+            return
+         if ptr != self.root:
+            for sch, tuples in ptr.result:
+               cols.update(sch)
+         for child in ptr.children:
+            depth_first(child, cols)
+      if self.root.op != 'and' or self.root.done or len(self.root.result) == 0:
+         return
+      cols = set(oschema)
+      depth_first(self.root, cols)
+      new_result = []
+      for sch_tuples in self.root.result:
+         sch, tuples = project(sch_tuples, cols)
+         if sch is not sch_tuples[0]:
+            tuples = rm_dups(tuples)
+         merge_results(new_result, [(sch, tuples)])
+      self.root.result = new_result
    def print_tree(self):
       def depth_first(ptr, pref):
          ptr.print_node(pref,self.tagger, self.fd)
@@ -730,14 +2688,15 @@ class Query:
             
    def compute_leaf(self):
       """
-         Traverse tree depth-first until it finds leaf with lowest value of ecount
-         When going down the tree and finding an 'and' node, take the result of
-         'and' node and push down as previous result. when a new 'and' node is
-         found the previous result is updated with the result of new 'and' node
-         When leaf with lowest value is found, it uses previous result to compute the
+         Takes the leaf with lowest value of ecount from the heap, or the first
+         pending leaf if the tree was planned (see plan_tree and next_leaf)
+         The result of its nearest 'and' ancestor with a result is pushed down
+         as previous result (see prev_result).
+         The leaf uses previous result to compute the
          result of the leaf and updates the result of the leaf parent.
          if leaf parent is 'and', it overwrites its result with computed result
          if leaf parent is 'or', it appends computed result to its result
+         Returns the evaluated leaf
       """
       def project(tuples, schema, outcols):
          """
@@ -747,153 +2706,1066 @@ class Query:
 
             returns projection of tuples on outcols
          """
-         res = []
          indices = [ i for i in range(len(schema)) if schema[i] in outcols]
-         for ltuple in tuples:
-            res.append(tuple([ltuple[i] for i in indices]))
-         return res 
+         outsch = [schema[i] for i in indices]
+         if isinstance(tuples, SpillList):
+            return tuples.select_columns(outsch, indices)
+         return self.collect(outsch, (tuple([ltuple[i] for i in indices]) for ltuple in tuples))
       def sort_columns(schema, tuples):
          """
-            sort columns in tuples by column number
+            sort columns in tuples by column number, a repeated column 
+            takes its first location
          """
-         newres = []
-         sschema = sorted(schema)
-         for ltuple in tuples:
-            t = []
-            for col in sschema:
-               index = [i for i in range(len(schema)) if schema[i] == col][0]
-               t.append(ltuple[index])
-            newres.append(tuple(t))
-         return sschema, newres      
-      def depth_first(ptr,ecount,prev_res,parent):
-         found = False
-         if len(ptr.children) == 0:
-            # a leaf
-            if not ptr.done and ptr.ecount == ecount: 
-               found = True
-               """
-               schema:
-                  'pred': leaf predicate parameters
-                  'tuples': schema (tags) of previous results
-                  'tags': 'pred'-'tuples'
-               """
-               schema = {'pred': ptr.params} 
-               new_res = []
-               if prev_res != None:
-                  # schemas of prev results and predicate params are disjoint
-                  disjoint = True
-                  partial_newres = None
-                  # computation limited with previous results
-                  for cols,tuples in prev_res:
-                     schema['tuples'] = cols
-                     # new columns to add with this predicate
-                     schema['tags'] = list(set(ptr.params).difference(set(cols)))
-                     if set(schema['tags']) == set(schema['pred']):
-                        # leaf predicate's parameters and prev result's tags are disjoint
-                        if partial_newres == None:
-                           tags = [ self.qtags[i] for i in ptr.params ]
-                           partial_newres = self.tagger.select(ptr.op, tags)
-                        newschema, newres = cartesian_prod(tuples, partial_newres, schema)
-                     else:
-                        disjoint = False
-                        # get cost of evaluation
-                        cost, disjoint1, eval_on_expansion = self.partial_cost(ptr, cols, tuples) 
-                        if eval_on_expansion:
-                           # expand previous result with new tags, then apply predicate
-                           tags = [ self.qtags[i] for i in schema['tags'] ]
-                           newschema, newres = self.tagger._select(ptr.op, tuples, tags, schema)
-                        else:
-                           # eval predicate on cartesian product of predicate parameters
-                           if partial_newres == None:
-                              tags = [ self.qtags[i] for i in ptr.params ]
-                              partial_newres = self.tagger.select(ptr.op, tags)
-                           # augment previous result with eval result
-                           newschema, newres = natural_inner_join((cols,tuples),(ptr.params,partial_newres))
-                     new_res.append((newschema, rm_dups(newres)))
-                  if disjoint:
-                     ptr.result = [(ptr.params, rm_dups(partial_newres))]
-                  else:
-                     # project on params and save result in leaf node
-                     res = []
-                     for cols, tuples in new_res:
-                        res = res + project(tuples, cols, ptr.params)
-                     ptr.result = [(ptr.params, rm_dups(res))]
+         sschema = sorted(set(schema))
+         indices = [schema.index(col) for col in sschema]
+         if isinstance(tuples, SpillList):
+            return sschema, tuples.select_columns(sschema, indices)
+         return sschema, self.collect(sschema, (tuple([ltuple[i] for i in indices]) for ltuple in tuples))
+      ptr = self.next_leaf()
+      parent = self.parents[ptr]
+      prev_res = self.prev_result(ptr)
+      self.running(ptr)
+      """
+      schema:
+         'pred': leaf predicate parameters
+         'tuples': schema (tags) of previous results
+         'tags': 'pred'-'tuples'
+      """
+      schema = {'pred': ptr.params} 
+      new_res = []
+      if prev_res != None:
+         # schemas of prev results and predicate params are disjoint
+         disjoint = True
+         partial_newres = None
+         psch = None
+         # computation limited with previous results
+         for cols,tuples in prev_res:
+            schema['tuples'] = cols
+            # new columns to add with this predicate
+            schema['tags'] = list(set(ptr.params).difference(set(cols)))
+            if set(schema['tags']) == set(schema['pred']):
+               # leaf predicate's parameters and prev result's tags are disjoint
+               if partial_newres == None:
+                  psch, partial_newres = sort_columns(ptr.params, self.select_leaf(ptr))
+               newschema, newres = self.product_tuples(tuples, partial_newres, 
+                                                       {'tuples': cols, 'pred': psch})
+            else:
+               disjoint = False
+               # get cost of evaluation
+               cost, disjoint1, eval_on_expansion = self.partial_cost(ptr, cols, tuples) 
+               if ptr.op in self.ANTI and len(schema['tags']) == 0:
+                  # negated expression evaluated on the bound tuples only
+                  newschema, newres = cols, self.anti_join(ptr, cols, tuples)
+               elif isinstance(ptr.op, DistPred):
+                  # range scans from the bound locations, joined with tuples
+                  newschema, newres = self.join_tuples((cols,tuples),
+                                                       sort_columns(ptr.params, 
+                                                                    self.dist_scan(ptr, cols, tuples)))
+               elif eval_on_expansion:
+                  # expand previous result with new tags, then apply predicate
+                  tags = [ self.col_tag(i) for i in schema['tags'] ]
+                  newschema, newres = self.tagger._select_iter(ptr.op, tuples, tags, schema,
+                                                               self.token)
+                  newres = self.collect(newschema, newres)
                else:
-                  # no previous results
-                  tags = [self.qtags[col] for col in ptr.params]
-                  # get results with columns not sorted
-                  newres_unsorted = self.tagger.select(ptr.op, tags)
-                  # sort columns
-                  newsch, newres = sort_columns(ptr.params, newres_unsorted)
-                  new_res = [ (newsch, newres) ]
-                  ptr.result = [ (newsch.copy(), newres.copy()) ]
-               self.delete_ecount(ecount)
-               ptr.done = True
-               ptr.ecount = len(ptr.result[0][1])
-               # move up new_res to parent
-               if parent != None:
-                  if parent.op == 'and':
-                     # overwrite
-                     parent.result = new_res
-                  else:
-                     # parent is 'or', append result
-                     merge_results(parent.result, new_res)
+                  # eval predicate on cartesian product of predicate parameters
+                  if partial_newres == None:
+                     psch, partial_newres = sort_columns(ptr.params, self.select_leaf(ptr))
+                  # augment previous result with eval result
+                  newschema, newres = self.join_tuples((cols,tuples),(psch,partial_newres))
+            new_res.append((newschema, rm_dups(newres)))
+         if disjoint:
+            ptr.result = [(psch, rm_dups(partial_newres))]
          else:
-            # inner node
-            if ptr.op == 'and' and len(ptr.result) > 0:
-               # and's current results move down
-               prev_res = ptr.result
-            for child in ptr.children:
-               found = depth_first(child, ecount, prev_res, ptr) 
-               if found: break
-         return found
-      min_ecount = self.ecounts[0]
-      depth_first(self.root, min_ecount, None, None)
-   def execute(self):       ## dab 2022-11-07
-      """Execute query
-      
-      Returns the list of tuple locations that satisfy the query. The number 
-      of elements in each tuple is determined from parameters tags and project
-      in the constructor. Each tuple has n elements where n is the number
-      of elements in project, if project is not [], or the number of elements in tags,
-      if project is [].
+            # project on params and save result in leaf node
+            res = []
+            for cols, tuples in new_res:
+               res = concat(res, project(tuples, cols, ptr.params))
+            ptr.result = [(ptr.params, rm_dups(res))]
+      else:
+         # no previous results
+         # get results with columns not sorted
+         newres_unsorted = self.select_leaf(ptr)
+         # sort columns
+         newsch, newres = sort_columns(ptr.params, newres_unsorted)
+         new_res = [ (newsch, newres) ]
+         ptr.result = [ (newsch.copy(), newres.copy() if isinstance(newres, list) else newres) ]
+      ptr.done = True
+      ptr.ecount = len(ptr.result[0][1])
+      # move up new_res to parent
+      if parent != None:
+         if parent.op == 'and':
+            # overwrite
+            parent.result = new_res
+         else:
+            # parent is 'or', append result
+            merge_results(parent.result, new_res)
+      return ptr
+   def prepare(self, semijoin=False, plan=True, multiway=True, infer=True, probe=True):
+      """
+         parses the query and prepares its tree for evaluation, see execute
+         for the parameters
+         Returns False if the query was found to have no results before 
+         evaluating it, True otherwise
+      """
+      self.parse_cached()  # partition query into tokens and create parse tree
+      return self.prepare_tree(semijoin, plan, multiway, infer, probe)
+   def prepare_tree(self, semijoin=False, plan=True, multiway=True, infer=True, probe=True):
+      """
+         prepares the parse tree in self.root for evaluation, see prepare
       """
-      self.tokenize()      # partition query into tokens
-      self.parse()         # create parse tree
       self.flatten_tree()  # reduce height of tree
+      self.negate_tree()   # evaluate 'not' nodes as anti-joins
+      if infer and not self.infer_tree():
+         return False      # query is a contradiction
+      if semijoin and not self.semijoin_reduce():
+         return False      # a tag has no locations satisfying the conjunction
+      if probe and not self.probe_tree():
+         return False      # a predicate of the conjunction has no results
+      if multiway: self.multiway_tree() # combine cyclic conjunctions
+      if plan: self.plan_tree() # order children of 'and' nodes
       self.update_tree()   # estimate counts of tuples to be evaluated by leaf nodes
       if self.fd != None: self.print_tree()
-      while not self.root.done:
-         self.compute_leaf() # evaluate leaf with lowest number of tuples to evaluate
-         self.update_tree()  # update tree with results of leaf
-         if self.fd != None: self.print_tree()
+      return True
+   def output_schema(self):
+      """
+         Returns the sorted list of output columns, the order of columns in 
+         result tuples
+      """
       if len(self.project) == 0:
-          oschema = list(range(len(self.qtags)))
+          return list(range(len(self.qtags)))
+      return sorted(self.project)
+   def evaluate_step(self, oschema):
+      """
+         evaluates one leaf of the tree and updates the tree with its result
+      """
+      leaf = self.compute_leaf() # evaluate leaf with lowest number of tuples to evaluate
+      self.push_projection(oschema) # drop columns no longer needed
+      self.update_tree(leaf)  # update ancestors of leaf with its result
+      if self.fd != None: self.print_tree()
+   def evaluate(self, oschema, parallel=None, workers=None):
+      """
+         evaluates the tree, see execute for parameters parallel and workers
+      """
+      if parallel not in [None, 'thread', 'process']:
+         fmt = "Invalid parallel mode: {}. Use None, 'thread' or 'process'"
+         handle_error(110620, fmt.format(parallel))
+      if parallel != None and self.evaluate_parallel(oschema, parallel, workers):
+         return
+      while not self.root.done:
+         self.evaluate_step(oschema)
+   def evaluate_parallel(self, oschema, parallel, workers):
+      """
+         evaluates the independent subtrees of the root in a pool of threads 
+         or processes: the children of an 'or' root, or the connected 
+         components (children sharing columns) of an 'and' root. Each subtree 
+         is evaluated as a subquery (see subquery), its results are projected
+         on oschema and are combined as update_tree does: merged for 'or', 
+         cartesian product for 'and' components
+         Returns False if the root has no independent subtrees
+      """
+      def cols(ptr):
+         if len(ptr.children) == 0:
+            return set(ptr.params)
+         res = set()
+         for child in ptr.children:
+            res.update(cols(child))
+         return res
+      if self.root.op == 'or':
+         subtrees = self.root.children
+      elif self.root.op == 'and':
+         # connected components of children
+         comps = []
+         for child in self.root.children:
+            ccols = cols(child)
+            joined = [comp for comp in comps if len(comp[0].intersection(ccols)) > 0]
+            comps = [comp for comp in comps if comp not in joined]
+            comp = (ccols, [child])
+            for other in joined:
+               comp = (comp[0].union(other[0]), other[1] + comp[1])
+            comps.append(comp)
+         subtrees = []
+         for ccols, children in comps:
+            if len(children) == 1:
+               subtrees.append(children[0])
+            else:
+               node = Node('and')
+               node.children = [child for child in self.root.children if child in children]
+               subtrees.append(node)
       else:
-          oschema = self.project
-      # project results to oschema
-      for i in range(len(self.root.result)):
-          self.root.result[i] = project(self.root.result[i], oschema)
-      # complete result with cartesian products, if needed
-      result = []
-      all_true = lambda x: True
-      for sch, tuples in self.root.result:
-        tags = [self.qtags[oschema[i]] for i in range(len(oschema)) if oschema[i] not in sch]
-        if len(tags) == 0:
-            result = result + tuples
+         return False
+      if len(subtrees) < 2:
+         return False
+      tasks = []
+      for subtree in subtrees:
+         query = self.subquery(subtree, sorted(cols(subtree)))
+         tasks.append((query, [col for col in oschema if col in cols(subtree)]))
+      results = run_pool(tasks, evaluate_subquery, parallel, workers)
+      if parallel == 'process':
+         # results have location orders, get locations of this process 
+         locs = {}
+         for col in range(len(self.qtags)):
+            locs[col] = {loc.order(): loc for loc in self.tagger.get_locs(self.col_tag(col))}
+         results = [[(sch, self.collect(sch, (tuple([locs[sch[i]][t[i]] for i in range(len(sch))])
+                                              for t in tuples)))
+                     for sch, tuples in result] for result in results]
+      self.root.result = []
+      for result in results:
+         if self.root.op == 'or':
+            merge_results(self.root.result, result)
+         elif len(self.root.result) == 0:
+            self.root.result = result
+         else:
+            new_result = []
+            for s1, t1 in self.root.result:
+               for s2, t2 in result:
+                  merge_results(new_result, [self.product_tuples(t1, t2, {'tuples': s1, 'pred': s2})])
+            self.root.result = new_result
+      self.root.done = True
+      return True
+   def completions(self, oschema):
+      """
+         projects the results of the root on oschema
+         Returns list of (sch, tuples, psch, plocs), where tuples follow schema
+         sch and must be completed with the cartesian product of the location
+         lists in plocs, one for each column in psch (output columns not 
+         constrained by the query). Spilled tuples have no duplicates
+      """
+      res = []
+      for sch_tuples in self.root.result:
+         sch, tuples = project(sch_tuples, oschema)
+         if isinstance(tuples, SpillList):
+            tuples = tuples.unique()
+         psch = [col for col in oschema if col not in sch]
+         plocs = [self.tagger.get_locs(self.col_tag(col)) for col in psch]
+         res.append((sch, tuples, psch, plocs))
+      return res
+   def result_orders(self, oschema):
+      """
+         Returns the set of results of the evaluated tree projected on oschema,
+         each result as a tuple of location orders (see Loc.order)
+      """
+      return set(self.completed_orders(oschema))
+   def result_keys(self, oschema):
+      """
+         Returns iterator of the distinct results of the evaluated tree 
+         projected on oschema, as result_orders, in sorted order. They are
+         deduplicated on disk in runs of self.max_tuples (see unique_keys)
+      """
+      return unique_keys(self.completed_orders(oschema), self.max_tuples)
+   def completed_orders(self, oschema):
+      """
+         yields the results of the evaluated tree projected on oschema and
+         completed with the output columns not constrained by the query, as
+         tuples of location orders. Results may be repeated
+      """
+      for sch, tuples, psch, plocs in self.completions(oschema):
+         indices = [(sch + psch).index(col) for col in oschema]
+         porders = [[loc.order() for loc in locs] for locs in plocs]
+         if isinstance(tuples, SpillList):
+            keys = tuples.keys()
+         else:
+            keys = set([tuple([loc.order() for loc in t]) for t in tuples])
+         for t in keys:
+            if self.token != None: self.token.check()
+            for pt in product(*porders):
+               r = t + pt
+               yield tuple([r[i] for i in indices])
+   def partitions(self, partition_by):
+      """
+         partition_by : tag, literal or list of locations. 'LINE' and 'PAGE' 
+                        are the lines and pages of the text if they are not tags
+
+         Returns sorted list of (start, end) positions in text of partitions
+      """
+      if isinstance(partition_by, str) and partition_by not in self.tagger.spans and \
+         partition_by in ['LINE', 'PAGE']:
+         regexp = LINE if partition_by == 'LINE' else PAGE
+         return self.tagger._findpatt(regexp, token=self.token)
+      return sorted([loc.txt_order() for loc in self.tagger.get_locs(partition_by)])
+   def execute_partitioned(self, partition_by, params, parallel, workers):
+      """
+         partition_by : see partitions
+         params :       dictionary of parameters of execute
+         parallel, workers : see execute
+
+         splits the locations of each tag by the partition that contains
+         them and executes the query on each partition. Partitions should
+         not overlap; locations not contained in a partition are discarded
+         and partitions where a required column (see required_cols) or an 
+         output column has no locations are skipped
+         Returns the concatenation of the results of the partitions
+      """
+      if parallel not in [None, 'thread', 'process']:
+         fmt = "Invalid parallel mode: {}. Use None, 'thread' or 'process'"
+         handle_error(110621, fmt.format(parallel))
+      spans = self.partitions(partition_by)
+      starts = [fr for fr, to in spans]
+      cols = range(len(self.qtags))
+      parts = [[[] for col in cols] for span in spans]
+      for col in cols:
+         for loc in self.tagger.get_locs(self.qtags[col]):
+            fr, to = loc.txt_order()
+            i = bisect_right(starts, fr) - 1
+            if i >= 0 and to <= spans[i][1]:
+               parts[i][col].append(loc)
+      # the tree is parsed once to find the columns required by all results
+      parsed = Query([self.qtags[col] for col in cols], self.query, self.tagger, self.project)
+      parsed.PREDS = dict(self.PREDS)
+      parsed.NNPREDS = dict(self.NNPREDS)
+      parsed.parse_cached()
+      required = parsed.required_cols(parsed.parsed).union(self.output_schema())
+      tasks = []
+      for locs in parts:
+         if min([len(locs[col]) for col in required] + [1]) == 0:
             continue
-        psch = [oschema[i] for i in range(len(oschema)) if oschema[i] not in sch]
-        schema = {'tuples': sch, 'pred': psch}
-        ptuples = self.tagger.select(all_true, tags)       
-        result = result + cartesian_prod(tuples, ptuples, schema)[1]
-      # remove duplicates
+         query = Query(locs, self.query, self.tagger, self.project)
+         query.PREDS = dict(self.PREDS)
+         query.NNPREDS = dict(self.NNPREDS)
+         query.UDPS = dict(self.UDPS)
+         tasks.append((query, params))
+      if parallel == None:
+         results = [execute_partition(task) for task in tasks]
+      else:
+         results = run_pool(tasks, execute_partition, parallel, workers)
+      if parallel == 'process':
+         # results have location orders, get locations of this process 
+         locs = {}
+         for col in cols:
+            locs[col] = {loc.order(): loc for loc in self.tagger.get_locs(self.qtags[col])}
+         oschema = self.output_schema()
+         results = [[tuple([locs[oschema[i]][t[i]] for i in range(len(t))]) for t in result] 
+                    for result in results]
+      res = []
+      for result in results:
+         res = res + result
+      return res
+   def columnar_result(self, oschema):
+      """
+         Returns ResultSet with the results of the evaluated tree projected on
+         oschema. Output columns not constrained by the query are completed
+         with indices of their locations, without building location tuples
+      """
+      locs = [self.tagger.get_locs(self.col_tag(col)) for col in oschema]
+      index = [{loc.order(): i for i, loc in enumerate(llist)} for llist in locs]
+      columns = [array('i') for col in oschema]
+      if self.max_tuples != None:
+         for key in self.result_keys(oschema):
+            for j in range(len(key)):
+               columns[j].append(index[j][key[j]])
+         return ResultSet(self.tagger, locs, columns)
+      comps = self.completions(oschema)
+      included = set()
+      for sch, tuples, psch, plocs in comps:
+         spos = [oschema.index(col) for col in sch]
+         ppos = [oschema.index(col) for col in psch]
+         # indices of distinct tuples in their order
+         base = dict.fromkeys([tuple([index[spos[i]][t[i].order()] for i in range(len(sch))]) 
+                               for t in tuples])
+         ranges = [range(len(locs[j])) for j in ppos]
+         r = [0] * len(oschema)
+         for itup in base:
+            for i in range(len(spos)):
+               r[spos[i]] = itup[i]
+            for ptup in product(*ranges):
+               for i in range(len(ppos)):
+                  r[ppos[i]] = ptup[i]
+               if len(comps) > 1:
+                  # results with different schemas may overlap
+                  if tuple(r) in included:
+                     continue
+                  included.add(tuple(r))
+               for j in range(len(r)):
+                  columns[j].append(r[j])
+      return ResultSet(self.tagger, locs, columns)
+   def execute(self, semijoin=False, plan=True, multiway=True, infer=True,
+               parallel=None, workers=None, partition_by=None, columnar=False,
+               max_tuples=None, max_memory=None, timeout=None, max_predicate_calls=None,
+               token=None, probe=True):       ## dab 2022-11-07
+      """Execute query
+      
+      Parameters:
+         semijoin (boolean) -- whether to reduce the locations of tags with 
+            semi-joins along the predicates of a conjunctive query before
+            evaluating it (default False)
+         plan (boolean) -- whether to fix the order of evaluation of the 
+            predicates in conjunctions before evaluating them, avoiding 
+            cartesian products (default True). If False, or if the query has no
+            conjunction to order, the pending predicate with the lowest
+            estimated cost is evaluated next
+         multiway (boolean) -- whether to evaluate conjunctions of predicates
+            that form a cycle, like subinterval(0,2) and subinterval(1,2) and 
+            before(0,1), with a worst-case optimal multiway join (default True).
+            If False, they are evaluated with pairwise joins
+         infer (boolean) -- whether to rewrite the query with the order relations
+            implied by its conjunctions: redundant predicates are removed and 
+            contradictions like before(0,1) and before(1,0) return [] without
+            evaluating the query (default True)
+         parallel (string) -- 'thread' or 'process' to evaluate the branches of
+            a disjunction at the root, or the components of a conjunction at
+            the root that share no columns, in a pool of threads or processes
+            (default None: sequential evaluation)
+         workers (int) -- maximum number of threads or processes of the pool
+            (default None: as in module concurrent.futures)
+         partition_by (string/literal/Loc list) -- tag whose locations, e.g. 
+            lines or pages, partition the text: the query is executed on each
+            partition with the locations of the tags contained in it and the
+            results are concatenated, so only tuples whose locations lie in 
+            the same partition are returned. 'LINE' and 'PAGE' are the lines 
+            and pages of the text if they are not tags. With parallel, the 
+            partitions are executed in the pool (default None)
+         columnar (boolean) -- whether to return the result as a ResultSet, 
+            which keeps for each column the indices of its locations in the 
+            locations of its tag instead of location tuples (default False)
+         max_tuples (int) -- maximum number of tuples of an intermediate result
+            kept in memory: larger cartesian products and joins are computed
+            in chunks of max_tuples tuples and their results are spilled to 
+            temporary files (default None: no maximum)
+         max_memory (int) -- maximum number of bytes of an intermediate result
+            kept in memory, converted to a number of tuples as max_tuples 
+            (default None: no maximum)
+         timeout (float) -- seconds after which the execution is stopped 
+            (default None: no time limit)
+         max_predicate_calls (int) -- maximum number of predicate evaluations
+            (default None: no limit)
+         token (CancelToken) -- token checked during the execution, whose
+            cancel method stops it, e.g. from another thread. timeout and
+            max_predicate_calls are set on it (default None). The limits are
+            checked while predicates are evaluated and tuples are joined; when
+            one is reached an ExtractError is raised naming the part of the
+            query being evaluated (see tagger.CancelToken). Forked processes
+            (parallel='process') only honor the limits, not cancel
+         probe (boolean) -- whether to check, before evaluating the query, that
+            each predicate of a conjunction at the root has some result, with
+            cheap checks in ascending order of cost: chains stop at the first
+            chain and predicates with semi-joins check the semi-join (default
+            True). During evaluation, a conjunction whose result becomes empty
+            is pruned and its pending predicates are not evaluated
+
+      Returns the list of tuple locations that satisfy the query (a ResultSet
+      if columnar is True). With a budget, results are sorted by location 
+      orders and, if there are more than max_tuples, they are returned as an
+      iterable with a length (a SpillList) that reads them back from its 
+      temporary files as it is iterated. The number 
+      of elements in each tuple is determined from parameters tags and project
+      in the constructor. Each tuple has n elements where n is the number
+      of elements in project, if project is not [], or the number of elements in tags,
+      if project is [].
+      """
+      oschema = self.output_schema()
+      self.set_budget(max_tuples, max_memory)
+      self.set_token(timeout, max_predicate_calls, token)
+      if partition_by != None:
+         params = {'semijoin': semijoin, 'plan': plan, 'multiway': multiway, 'infer': infer,
+                   'token': self.token, 'probe': probe}
+         if self.max_tuples != None:
+            # results of partitions are kept as columns, the budget applies
+            # to their concatenation
+            params.update({'max_tuples': self.max_tuples, 'columnar': True})
+         res = self.execute_partitioned(partition_by, params, parallel, workers)
+         if columnar:
+            locs = [self.tagger.get_locs(self.qtags[col]) for col in oschema]
+            return from_tuples(self.tagger, locs, res)
+         return res
+      if not self.prepare(semijoin, plan, multiway, infer, probe):
+         if columnar:
+            return ResultSet(self.tagger, [[] for col in oschema], [array('i') for col in oschema])
+         return []
+      self.evaluate(oschema, parallel, workers)
+      if columnar:
+         return self.columnar_result(oschema)
+      # complete result with cartesian products, if needed, and remove duplicates
+      if self.token != None:
+         self.token.node = "completion of output columns"
+      if self.max_tuples != None:
+         # results are deduplicated on disk, larger results are read back
+         # from disk as they are iterated
+         spill = SpillList(oschema, self.max_tuples, self.canon_locs)
+         spill.extend_stream(self.completed_orders(oschema))
+         spill = spill.unique()
+         return list(spill) if len(spill) <= self.max_tuples else spill
       sresult = []
       included = set([])
-      for r in result:
-         if r in included: continue
-         sresult.append(r)
-         included.add(r)
+      for sch, tuples, psch, plocs in self.completions(oschema):
+         if len(psch) == 0:
+            # projected columns already present
+            result = tuples
+         else:
+            schema = {'tuples': sch, 'pred': psch}
+            result = cartesian_iter(tuples, list(product(*plocs)), schema, self.token)[1]
+         for r in result:
+            if r in included: continue
+            sresult.append(r)
+            included.add(r)
       return sresult
+   def leaf_windows(self, ptr):
+      """
+         Returns list of windows (col1, col2, ranges, same_offset) of leaf 
+         <ptr> if its predicate is a chain or a dist predicate on distinct
+         columns, None otherwise. A window holds for locations l1 and l2 of 
+         col1 and col2 if the start of l2 minus the end of l1 is in one of the
+         (lo, hi) ranges (see dist_ranges), and they have the same offset if
+         same_offset is True. A chain has one window for each pair of 
+         consecutive parameters (see chain_windows)
+      """
+      windows = self.chain_windows(ptr)
+      if windows != None:
+         return [(ptr.params[i], ptr.params[i+1], [windows[i]], False) 
+                 for i in range(len(windows))]
+      if isinstance(ptr.op, DistPred) and ptr.params[0] != ptr.params[1]:
+         return [(ptr.params[0], ptr.params[1], ptr.op.ranges, True)]
+      return None
+   def col_locs(self, col, index):
+      """
+         Returns the locations of column <col> without repeated locations, 
+         kept in <index> (see bindings)
+      """
+      key = ('locs', col)
+      if key not in index:
+         locs = self.tagger.get_locs(self.col_tag(col))
+         index[key] = list({loc.order(): loc for loc in locs}.values())
+      return index[key]
+   def col_index(self, col, by_end, same_offset, index):
+      """
+         Returns range_index of the locations of column <col>, kept in <index>
+      """
+      key = ('range', col, by_end, same_offset)
+      if key not in index:
+         index[key] = range_index(self.col_locs(col, index), by_end, same_offset)
+      return index[key]
+   def window_scan(self, window, col, loc, index):
+      """
+         window : see leaf_windows
+         col :    column of window bound to <loc>
 
+         Returns iterator of the positions of the locations of the other 
+         column of <window> that satisfy it with <loc>, found by binary search
+      """
+      col1, col2, ranges, same_offset = window
+      group = loc.offset if same_offset else None
+      if col == col1:
+         keys, positions = self.col_index(col2, False, same_offset, index).get(group, ([], []))
+         for lo, hi in ranges:
+            end = loc.intrval[1]
+            b, e = range_bounds(keys, end+lo, None if hi == None else end+hi)
+            yield from positions[b:e]
+      else:
+         keys, positions = self.col_index(col1, True, same_offset, index).get(group, ([], []))
+         for lo, hi in ranges:
+            start = loc.intrval[0]
+            b, e = range_bounds(keys, None if hi == None else start-hi, start-lo)
+            yield from positions[b:e]
+   def in_window(self, window, loc1, loc2):
+      """
+         Returns whether locations <loc1> and <loc2> of the columns of 
+         <window> satisfy it
+      """
+      col1, col2, ranges, same_offset = window
+      if same_offset and loc1.offset != loc2.offset:
+         return False
+      d = loc2.intrval[0] - loc1.intrval[1]
+      return any([lo <= d and (hi == None or d <= hi) for lo, hi in ranges])
+   def eager_leaf(self, ptr):
+      """
+         Returns whether leaf <ptr> is evaluated at once instead of one 
+         candidate tuple at a time by bindings: nearest neighbour, multiway 
+         and user defined predicates with a batch function or properties
+      """
+      return ptr.op in self.NEAREST or ptr.op in self.MULTIWAY or \
+             (ptr.op in self.UDPS and self.udp_strategy(ptr) != None)
+   def bindings(self, ptr, binding, index):
+      """
+         ptr :     node of the tree
+         binding : dictionary from column numbers to locations
+         index :   dictionary of locations and indices of columns and leaves
+                   built while enumerating
 
+         Returns iterator of the extensions of <binding> with locations of
+         the columns of <ptr> that satisfy <ptr>, without evaluating its
+         leaves at once: children of 'and' nodes are nested loops that first
+         evaluate the leaves with fewest candidates given the bound columns
+         (see conj_bindings), windows extend a location by binary search 
+         (see window_scan) and other predicates are evaluated one candidate
+         tuple at a time. Children of 'or' nodes are enumerated one after the
+         other, so the same extension may be returned more than once
+      """
+      if len(ptr.children) == 0:
+         return self.conj_bindings(self.constraints([ptr]), binding, index)
+      if ptr.op == 'or':
+         return chain.from_iterable([self.bindings(child, binding, index) for child in ptr.children])
+      return self.conj_bindings(self.constraints(ptr.children), binding, index)
+   def constraints(self, nodes):
+      """
+         Returns list of (kind, item, node) for the conjunction of <nodes>:
+         ('window', window, leaf) for each window of a leaf (see leaf_windows),
+         ('leaf', leaf, leaf) for other leaves and ('node', node, node) for 
+         inner nodes
+      """
+      items = []
+      for node in nodes:
+         windows = self.leaf_windows(node) if len(node.children) == 0 else None
+         if windows != None:
+            items = items + [('window', window, node) for window in windows]
+         elif len(node.children) == 0:
+            items.append(('leaf', node, node))
+         else:
+            items.append(('node', node, node))
+      return items
+   def constraint_cost(self, item, binding, index):
+      """
+         Returns estimated number of candidates of constraint <item> (see
+         constraints) given the columns bound in <binding>. Inner nodes are
+         enumerated when their columns are bound or no leaf is left
+      """
+      kind, obj, node = item
+      if kind == 'node':
+         key = ('cols', id(node))
+         if key not in index:
+            index[key] = set(self.node_cols(node))
+         return 0 if index[key].issubset(binding) else math.inf
+      cols = obj[:2] if kind == 'window' else list(dict.fromkeys(obj.params))
+      unbound = [col for col in cols if col not in binding]
+      if len(unbound) == 0:
+         return 0
+      if len(unbound) < len(cols) and (kind == 'window' or self.eager_leaf(obj)):
+         return 1
+      if kind == 'window':
+         return len(self.col_locs(unbound[0], index))
+      if self.eager_leaf(obj):
+         return self.leaf_cost(obj)
+      cost = 1
+      for col in unbound:
+         cost = cost * len(self.col_locs(col, index))
+      return cost
+   def node_cols(self, ptr):
+      """
+         Returns list of the columns of the leaves below <ptr>
+      """
+      if len(ptr.children) == 0:
+         return list(ptr.params)
+      cols = []
+      for child in ptr.children:
+         cols = cols + self.node_cols(child)
+      return cols
+   def conj_bindings(self, items, binding, index):
+      """
+         Returns iterator of the extensions of <binding> that satisfy the 
+         constraints in <items> (see constraints). The constraint with the
+         lowest cost is enumerated first, then the others on each of its
+         extensions
+      """
+      if len(items) == 0:
+         yield binding
+         return
+      costs = [self.constraint_cost(item, binding, index) for item in items]
+      i = costs.index(min(costs))
+      kind, obj, node = items[i]
+      rest = items[:i] + items[i+1:]
+      if kind == 'node':
+         extensions = self.bindings(node, binding, index)
+      elif kind == 'window':
+         extensions = self.window_bindings(obj, node, binding, index)
+      else:
+         extensions = self.leaf_bindings(node, binding, index)
+      for ext in extensions:
+         yield from self.conj_bindings(rest, ext, index)
+   def window_bindings(self, window, ptr, binding, index):
+      """
+         Returns iterator of the extensions of <binding> that satisfy 
+         <window> of leaf <ptr>
+      """
+      col1, col2 = window[:2]
+      self.running(ptr)
+      if col1 in binding and col2 in binding:
+         if self.token != None: self.token.check(1)
+         if self.in_window(window, binding[col1], binding[col2]):
+            yield binding
+         return
+      if col1 in binding or col2 in binding:
+         bound, free = (col1, col2) if col1 in binding else (col2, col1)
+         sources = [binding[bound]]
+      else:
+         bound, free = col1, col2
+         sources = self.col_locs(col1, index)
+      locs = self.col_locs(free, index)
+      for loc in sources:
+         for pos in self.window_scan(window, bound, loc, index):
+            if self.token != None: self.token.check(1)
+            ext = dict(binding)
+            ext[bound] = loc
+            ext[free] = locs[pos]
+            yield ext
+   def leaf_bindings(self, ptr, binding, index):
+      """
+         Returns iterator of the extensions of <binding> that satisfy leaf
+         <ptr>. Its predicate is applied to one candidate at a time, from the
+         cartesian product of the locations of its unbound columns, or looked
+         up in its result if it is evaluated at once (see eager_leaf)
+      """
+      self.running(ptr)
+      cols = list(dict.fromkeys(ptr.params))
+      bound = [col for col in cols if col in binding]
+      if self.eager_leaf(ptr):
+         key = ('leaf', id(ptr), tuple(bound))
+         if key not in index:
+            matches = {}
+            for t in self.select_leaf(ptr):
+               values = dict(zip(ptr.params, t))
+               if tuple([values[col] for col in ptr.params]) != tuple(t):
+                  continue   # repeated column with different locations
+               matches.setdefault(tuple([values[col].order() for col in bound]), []).append(values)
+            index[key] = matches
+         for values in index[key].get(tuple([binding[col].order() for col in bound]), []):
+            ext = dict(binding)
+            ext.update(values)
+            yield ext
+         return
+      free = [col for col in cols if col not in binding]
+      for locs in product(*[self.col_locs(col, index) for col in free]):
+         ext = dict(binding)
+         ext.update(zip(free, locs))
+         if self.token != None: self.token.check(1)
+         if ptr.op(tuple([ext[col] for col in ptr.params])):
+            yield ext
+   def count_tree(self, oschema):
+      """
+         counts the results of a leaf or a conjunction of leaves at the root
+         without joining them. Windows of chains and dist predicates relate
+         two columns (see leaf_windows), other predicates on two columns are
+         evaluated into pairs of locations and predicates on one column
+         filter its locations. If the related columns form a forest, counts
+         are propagated from the leaves to the root of each tree: the count 
+         of a location is the product, over the children of its column, of
+         the sum of the counts of the child locations related to it, computed
+         with prefix sums for windows (see count_message). Output columns not
+         constrained by the query multiply the count by their number of 
+         locations
+         Returns the count, or None if the tree is not supported: other inner
+         nodes, cycles, predicates on more than two columns that are not
+         chains, or trees with more than one output column and columns 
+         projected out
+      """
+      if len(self.root.children) == 0:
+         leaves = [self.root]
+      elif self.root.op == 'and' and all([len(child.children) == 0 for child in self.root.children]):
+         leaves = self.root.children
+      else:
+         return None
+      filters = {}   # column --> leaves on that column only
+      edges = {}     # (col1, col2), col1 < col2 --> windows and leaves relating them
+      for leaf in leaves:
+         cols = list(dict.fromkeys(leaf.params))
+         if len(cols) != len(leaf.params):
+            return None
+         windows = self.leaf_windows(leaf)
+         if len(cols) == 1:
+            filters.setdefault(cols[0], []).append(leaf)
+         elif windows != None:
+            for window in windows:
+               relations = edges.setdefault(tuple(sorted(window[:2])), [])
+               for i, (kind, other, first) in enumerate(relations):
+                  if kind == 'window' and other[:2] == window[:2]:
+                     # windows in the same direction are intersected
+                     relations[i] = (kind, intersect_windows(other, window), first)
+                     break
+               else:
+                  relations.append(('window', window, leaf))
+         elif len(cols) == 2:
+            edges.setdefault(tuple(sorted(cols)), []).append(('leaf', leaf, leaf))
+         else:
+            return None
+      adjacent = {}
+      for col1, col2 in edges:
+         adjacent.setdefault(col1, []).append(col2)
+         adjacent.setdefault(col2, []).append(col1)
+      cols = set(filters).union(adjacent)
+      # trees of related columns
+      trees = []
+      seen = set()
+      for col in sorted(cols):
+         if col in seen:
+            continue
+         tree = [col]
+         seen.add(col)
+         for node in tree:
+            for nxt in adjacent.get(node, []):
+               if nxt not in seen:
+                  seen.add(nxt)
+                  tree.append(nxt)
+         if sum([len(adjacent.get(node, [])) for node in tree]) != 2 * (len(tree) - 1):
+            return None    # cyclic
+         trees.append(tree)
+      index = {}
+      def vector(col, parent):
+         # counts of the locations of col in the subtree of col
+         locs = self.col_locs(col, index)
+         vec = [1] * len(locs)
+         for leaf in filters.get(col, []):
+            self.running(leaf)
+            for i, loc in enumerate(locs):
+               if vec[i] == 0:
+                  continue
+               if self.token != None: self.token.check(1)
+               if not leaf.op((loc,)):
+                  vec[i] = 0
+         for nxt in adjacent.get(col, []):
+            if nxt != parent:
+               msg = self.count_message(edges[tuple(sorted([col, nxt]))], nxt, col, 
+                                        vector(nxt, col), index)
+               vec = [v * m for v, m in zip(vec, msg)]
+         return vec
+      cnt = 1
+      for tree in trees:
+         out = [col for col in tree if col in oschema]
+         if 1 < len(out) < len(tree):
+            return None
+         vec = vector(out[0] if len(out) > 0 else tree[0], None)
+         if len(out) == 0:
+            cnt = cnt * (1 if any(vec) else 0)
+         elif len(out) == 1 and len(tree) > 1:
+            cnt = cnt * sum([1 for v in vec if v > 0])
+         else:
+            cnt = cnt * sum(vec)
+         if cnt == 0:
+            return 0
+      for col in oschema:
+         if col not in cols:
+            cnt = cnt * len(self.tagger.get_locs(self.col_tag(col)))
+      return cnt
+   def count_message(self, relations, src, dst, vec, index):
+      """
+         relations : windows and leaves relating columns <src> and <dst>, see
+                     count_tree
+         vec :       counts of the locations of src
+
+         Returns list with the sum of the counts of the locations of src
+         related to each location of dst. For a single window, the sums are
+         differences of prefix sums of vec over the locations of src sorted by
+         start (end if src is the first column of the window), otherwise the
+         related pairs are computed (see relation_pairs)
+      """
+      dlocs = self.col_locs(dst, index)
+      msg = [0] * len(dlocs)
+      if len(relations) == 1 and relations[0][0] == 'window':
+         col1, col2, ranges, same_offset = relations[0][1]
+         self.running(relations[0][2])
+         sums = {}
+         for group, (keys, positions) in self.col_index(src, src == col1, same_offset, index).items():
+            prefix = [0]
+            for pos in positions:
+               prefix.append(prefix[-1] + vec[pos])
+            sums[group] = (keys, prefix)
+         for i, loc in enumerate(dlocs):
+            if self.token != None: self.token.check()
+            keys, prefix = sums.get(loc.offset if same_offset else None, ([], [0]))
+            for lo, hi in ranges:
+               if src == col2:
+                  end = loc.intrval[1]
+                  b, e = range_bounds(keys, end+lo, None if hi == None else end+hi)
+               else:
+                  start = loc.intrval[0]
+                  b, e = range_bounds(keys, None if hi == None else start-hi, start-lo)
+               msg[i] += prefix[e] - prefix[b]
+         return msg
+      for pos_src, pos_dst in self.relation_pairs(relations, src, dst, index):
+         msg[pos_dst] += vec[pos_src]
+      return msg
+   def relation_pairs(self, relations, src, dst, index):
+      """
+         Returns set of pairs of positions of locations of columns <src> and
+         <dst> that satisfy all the windows and leaves in <relations>: pairs
+         of a window, found by binary search, or of the result of a leaf are
+         filtered by the other relations
+      """
+      slocs = self.col_locs(src, index)
+      dlocs = self.col_locs(dst, index)
+      relations = sorted(relations, key=lambda rel: rel[0] != 'window')
+      kind, obj, leaf = relations[0]
+      self.running(leaf)
+      pairs = set()
+      if kind == 'window':
+         for i, loc in enumerate(slocs):
+            for pos in self.window_scan(obj, src, loc, index):
+               if self.token != None: self.token.check(1)
+               pairs.add((i, pos))
+      else:
+         spos = {loc.order(): i for i, loc in enumerate(slocs)}
+         dpos = {loc.order(): i for i, loc in enumerate(dlocs)}
+         isrc, idst = leaf.params.index(src), leaf.params.index(dst)
+         for t in self.select_leaf(leaf):
+            pairs.add((spos[t[isrc].order()], dpos[t[idst].order()]))
+      for kind, obj, leaf in relations[1:]:
+         self.running(leaf)
+         keep = set()
+         for i, j in pairs:
+            if self.token != None: self.token.check(1)
+            locs = {src: slocs[i], dst: dlocs[j]}
+            if kind == 'window':
+               holds = self.in_window(obj, locs[obj[0]], locs[obj[1]])
+            else:
+               holds = leaf.op(tuple([locs[col] for col in leaf.params]))
+            if holds:
+               keep.add((i, j))
+         pairs = keep
+      return pairs
+   def count(self, semijoin=False, plan=True, multiway=True, infer=True,
+             parallel=None, workers=None, max_tuples=None, max_memory=None,
+             timeout=None, max_predicate_calls=None, token=None, probe=True):
+      """Count the results of the query
+      
+      Parameters: same as execute
+
+      Returns the number of distinct tuples of locations that satisfy the query.
+      If the query is a conjunction of predicates on at most two columns that
+      relate its columns without cycles (chains count as pairs of consecutive
+      columns), counts are propagated through the predicates without joining
+      their results (see count_tree): chains and dist predicates are counted 
+      by binary search without evaluating them on pairs of locations. 
+      Otherwise the query is evaluated and its results are counted without
+      building output tuples: output columns not constrained by the query 
+      multiply the count by their number of locations. Tuples are only enumerated
+      (as location orders) when the root has results with different schemas,
+      which may overlap, e.g. for a disjunction at the root.
+      """
+      self.set_budget(max_tuples, max_memory)
+      self.set_token(timeout, max_predicate_calls, token)
+      if not self.prepare(semijoin, plan, multiway, infer, probe):
+         return 0
+      oschema = self.output_schema()
+      cnt = self.count_tree(oschema)
+      if cnt != None:
+         return cnt
+      self.evaluate(oschema, parallel, workers)
+      comps = self.completions(oschema)
+      if len(comps) == 1:
+         sch, tuples, psch, plocs = comps[0]
+         if isinstance(tuples, SpillList):
+            cnt = len(tuples)   # without duplicates, see completions
+         else:
+            cnt = len(set([tuple([loc.order() for loc in t]) for t in tuples]))
+         for locs in plocs:
+            cnt = cnt * len(locs)
+         return cnt
+      if self.max_tuples != None:
+         cnt = 0
+         for key in self.result_keys(oschema):
+            cnt += 1
+         return cnt
+      return len(self.result_orders(oschema))
+   def repeated_params(self, ptr):
+      """
+         Returns whether a leaf in the subtree of <ptr> repeats a column
+      """
+      if len(ptr.children) == 0:
+         return len(set(ptr.params)) != len(ptr.params)
+      return any([self.repeated_params(child) for child in ptr.children])
+   def exists(self, semijoin=False, plan=True, multiway=True, infer=True,
+              timeout=None, max_predicate_calls=None, token=None, probe=True):
+      """Check whether the query has results
+      
+      Parameters: same as execute
+
+      Returns True if some tuple of locations satisfies the query, False 
+      otherwise. Leaves are not evaluated at once: tuples are enumerated one
+      at a time (see bindings), so the evaluation stops at the first tuple 
+      that satisfies the query. Queries with a predicate that repeats a 
+      column, e.g. meets(2,2), are counted instead (see count), since 
+      bindings would give the repeated column a single location while 
+      execute evaluates the predicate on the pairs of its locations
+      """
+      self.parse_cached()
+      if self.repeated_params(self.root):
+         return self.count(semijoin, plan, multiway, infer, timeout=timeout, 
+                           max_predicate_calls=max_predicate_calls, token=token, 
+                           probe=probe) > 0
+      self.set_token(timeout, max_predicate_calls, token)
+      if not self.prepare(semijoin, plan, multiway, infer, probe):
+         return False
+      index = {}
+      if min([len(self.col_locs(col, index)) for col in self.output_schema()] + [1]) == 0:
+         return False    # an output column has no locations
+      return next(self.bindings(self.root, {}, index), None) != None
+
+class QueryBatch:
+   """Class for executing queries on the same tagged text sharing their results
+
+   Constructor Parameters:
+
+      tagger (Tagger Object) -- tagged text to apply queries
 
+   Leaves of different queries with the same predicate on the same tags are 
+   evaluated once: their result is kept by the batch and reused by the other
+   queries, which join with it instead of evaluating the predicate again.
+   Identical queries are executed once. Attribute stats reports the work
+   saved by sharing:
+      'queries' -- number of queries in batch
+      'duplicates' -- queries answered with the result of an identical query
+      'evaluated' -- number of leaf results computed
+      'reused' -- number of leaf results taken from the batch
+      'saved' -- estimated number of predicate evaluations saved by reuse
+   """
+   def __init__(self, tagger):
+      self.tagger = tagger
+      self.queries = []
+      # leaf key (see Query.leaf_key) --> (result, cost of computing it)
+      self.results = {}
+      self.stats = {'queries': 0, 'duplicates': 0, 'evaluated': 0, 'reused': 0, 'saved': 0}
+   def add(self, tags, query, project=[]):
+      """Add query to batch
+
+      Parameters: same as Query constructor
+
+      Returns the Query object, to define its user defined predicates
+      """
+      q = Query(tags, query, self.tagger, project)
+      q.shared = self
+      self.queries.append(q)
+      self.stats['queries'] += 1
+      return q
+   def store(self, key, result, cost):
+      """
+         keeps leaf <result> of <key>, computed with estimated <cost>
+      """
+      self.results[key] = (result, cost)
+      self.stats['evaluated'] += 1
+   def reuse(self, key):
+      """
+         Returns leaf result of <key>
+      """
+      result, cost = self.results[key]
+      self.stats['reused'] += 1
+      self.stats['saved'] += cost
+      return result
+   def execute(self, semijoin=False, plan=True, multiway=True, infer=True,
+               parallel=None, workers=None, partition_by=None, columnar=False,
+               max_tuples=None, max_memory=None, timeout=None, max_predicate_calls=None,
+               token=None, probe=True):
+      """Execute queries in batch
+      
+      Parameters: see Query.execute. The projection of each query is given
+      to add. timeout and max_predicate_calls limit the whole batch: its 
+      queries are executed with the same token
+
+      Returns list with the result of each query (see Query.execute) in the
+      order they were added
+      """
+      if token == None and (timeout != None or max_predicate_calls != None):
+         token = CancelToken()
+      if token != None:
+         token.limit(timeout, max_predicate_calls)
+      results = []
+      done = {}
+      for q in self.queries:
+         key = (tuple([tag_key(q.qtags[i]) for i in range(len(q.qtags))]), q.query, 
+                tuple(q.project), tuple(sorted(q.PREDS.items(), key=lambda item: item[0])),
+                tuple(sorted(q.NNPREDS.items())))
+         if key in done:
+            self.stats['duplicates'] += 1
+            results.append(list(done[key]) if isinstance(done[key], list) else done[key])
+            continue
+         done[key] = q.execute(semijoin, plan, multiway, infer, parallel=parallel, 
+                               workers=workers, partition_by=partition_by, columnar=columnar,
+                               max_tuples=max_tuples, max_memory=max_memory, token=token,
+                               probe=probe)
+         results.append(done[key])
+      return results
@@ -0,0 +1,80 @@
+"""Module that implements columnar sets of location tuples
+
+   from_tuples(Tagger object, list of Loc lists, list of Loc tuples) -> ResultSet
+
+   Class ResultSet methods:
+      __init__(Tagger object, list of Loc lists, list of int arrays)
+      __len__() -> int
+      __iter__() -> Loc tuple iterator
+      __getitem__(int) -> Loc tuple
+      indices(int) -> int array
+      tuples() -> list of Loc tuples
+      texts() -> list of string tuples
+"""
+from array import array
+from .extracterror import handle_error
+
+class ResultSet:
+   """Columnar set of location tuples
+   
+   Constructor Parameters:
+      tagger (Tagger object) -- tagged text the locations belong to
+      locs (list of Loc lists) -- locations of each column, sorted by 
+         from,to,offset as returned by Tagger.get_locs
+      columns (list of int arrays) -- for each column, indices in its list
+         of locations of the locations in each tuple
+
+   Tuples are not stored: a tuple of locations is built when it is accessed
+   """
+   def __init__(self, tagger, locs, columns):
+      self.tagger = tagger
+      self.locs = locs
+      self.columns = columns
+   def __len__(self):
+      if len(self.columns) == 0:
+         return 0
+      return len(self.columns[0])
+   def __iter__(self):
+      for i in range(len(self)):
+         yield self[i]
+   def __getitem__(self, i):
+      return tuple([self.locs[j][self.columns[j][i]] for j in range(len(self.columns))])
+   def indices(self, col):
+      """Returns array of indices in the list of locations of column col
+      
+      Parameters:
+         col (int) -- position of column in tuples
+      """
+      return self.columns[col]
+   def tuples(self):
+      """Returns list of location tuples"""
+      return list(self)
+   def texts(self):
+      """Returns list of tuples of strings in the locations of each tuple"""
+      return [self.tagger.get_text_tuple(ltuple) for ltuple in self]
+def from_tuples(tagger, locs, tuples):
+   """Creates a ResultSet
+   
+   Parameters:
+      tagger (Tagger object) -- tagged text the locations belong to
+      locs (list of Loc lists) -- locations of each column, sorted by
+         from,to,offset
+      tuples (list of Loc tuples) -- tuples to include, locations are found
+         in locs by their from,to,offset
+
+   Returns ResultSet with tuples, without duplicates
+   """
+   index = [{loc.order(): i for i, loc in enumerate(llist)} for llist in locs]
+   columns = [array('i') for llist in locs]
+   included = set()
+   for ltuple in tuples:
+      try:
+         itup = tuple([index[j][ltuple[j].order()] for j in range(len(locs))])
+      except KeyError:
+         handle_error(111001, 'Location of tuple not found in locations of its column')
+      if itup in included:
+         continue
+      included.add(itup)
+      for j in range(len(locs)):
+         columns[j].append(itup[j])
+   return ResultSet(tagger, locs, columns)
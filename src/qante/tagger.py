@@ -3,11 +3,15 @@
    lit(string) -> literal
    
    Class Tagger Methods:
-      __init__(string, boolean)
-      tagRE(string, string, int, boolean)
+      __init__(string, boolean, int)
+      tagRE(string, string, int, boolean, CancelToken)
       tag_loc(string, Loc)
       tag_list(string. Loc list)
       tag_lists(string, list of Loc lists)
+      tag_union(string, string list)
+      tag_intersect(string, string list)
+      tag_difference(string, string, string list)
+      tag_complement(string, string list, int pair)
       del_tag(string)     
       display_matches()
       display_doc()
@@ -21,36 +25,222 @@
       in_tag(Loc, string list) -> string
       not_in(Loc list, int pair) -> Loc list
       project(string, string) -> Loc list
-      replace_tag(string, string) -> string
+      proximity(string/literal, string/literal, int, int, string) -> Loc pair list
+      nearest(string/literal, string/literal, int, string, boolean) -> Loc pair list
+      between(string/literal, string/literal, int, string) -> Loc list
+      replace_tag(string, string, file object) -> string
+      apply_tags(string list, file object) -> string
+
+   Class CancelToken Methods:
+      __init__(float, int)
+      limit(float, int)
+      cancel()
+      remaining() -> float
+      check(int)
 """
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from itertools import product
 import regex as re
+from bisect import bisect_left, bisect_right
 
 from .extracterror import handle_error
 from .loc import Loc, expand
 from .loctuple import subinterval
-from .loclist import binary_search, merge_list
+from .loclist import binary_search
 
 def lit( str_to_match):
    """
       Returns a literal object for input parameter
    """
    return {'literal': str_to_match}
+class CancelToken:
+   """Class to limit or cancel the work of tagging and queries
+
+   Constructor Parameters:
+
+      timeout (float) -- seconds until the work is stopped (default None: no
+         time limit)
+      max_predicate_calls (int) -- maximum number of predicate evaluations 
+         (default None: no limit)
+
+   The token is checked cooperatively while predicates are evaluated, tuples
+   are joined and regular expressions are matched. cancel() stops the work
+   at the next check, e.g. when it is called from another thread. When a 
+   limit is reached, an ExtractError is raised with code 110108 (timeout), 
+   110109 (max_predicate_calls) or 110110 (cancelled), whose message names 
+   the part of the query that was running, also kept in attribute node.
+   Attribute calls counts the predicate evaluations.
+   """
+   CLOCK_STEPS = 256   # checks between readings of the clock
+   def __init__(self, timeout=None, max_predicate_calls=None):
+      self.timeout = None
+      self.deadline = None
+      self.max_predicate_calls = None
+      self.calls = 0
+      self.steps = 0
+      self.cancelled = False
+      self.node = None    # description of the work in progress
+      self.limit(timeout, max_predicate_calls)
+   def limit(self, timeout=None, max_predicate_calls=None):
+      """
+         sets the limits of the token, timeout counts from now
+      """
+      if timeout != None:
+         self.timeout = timeout
+         self.deadline = time.monotonic() + timeout
+      if max_predicate_calls != None:
+         self.max_predicate_calls = max_predicate_calls
+   def cancel(self):
+      """
+         stops the work at the next check
+      """
+      self.cancelled = True
+   def remaining(self):
+      """
+         Returns seconds until the deadline, None if there is no timeout
+      """
+      if self.deadline == None:
+         return None
+      return max(0, self.deadline - time.monotonic())
+   def check(self, calls=0):
+      """
+         calls : number of predicate evaluations since the last check
+
+         raises an ExtractError if a limit was reached or the token was 
+         cancelled. The clock is read every CLOCK_STEPS checks
+      """
+      self.calls += calls
+      self.steps += 1
+      if self.cancelled:
+         self.stop(110110, "cancellation")
+      if self.max_predicate_calls != None and self.calls > self.max_predicate_calls:
+         self.stop(110109, "limit of {} predicate calls".format(self.max_predicate_calls))
+      if self.deadline != None and self.steps % self.CLOCK_STEPS == 0 and \
+         time.monotonic() > self.deadline:
+         self.stop(110108, "timeout of {} seconds".format(self.timeout))
+   def stop(self, code, reason):
+      where = "" if self.node == None else " while evaluating {}".format(self.node)
+      handle_error(code, "Stopped by {}{}".format(reason, where))
+# ---------------spans: sorted lists of (from, to) pairs-----------------
+# positions in spans are relative to beginning of text (offset zero)
+def _to_spans(locs):
+   """
+      converts Loc list <locs> into a list of (from, to) pairs with respect
+      to beginning of text, sorted by from, to
+      locs are already sorted when all offsets are equal, so sorting is only
+      needed for projected locations
+   """
+   spans = [(loc.offset+loc.intrval[0], loc.offset+loc.intrval[1]) for loc in locs]
+   for i in range(1, len(spans)):
+      if spans[i] < spans[i-1]:
+         return sorted(spans)
+   return spans
+def _union_spans(span_lists):
+   """
+      merges sorted span lists in <span_lists> with a k-way merge and
+      combines intersecting spans into one
+      returns sorted list of disjoint spans
+   """
+   res = []
+   for fr, to in heapq.merge(*span_lists):
+      if len(res) == 0:
+         res.append((fr, to))
+         continue
+      last_fr, last_to = res[-1]
+      # as in merge_list, an empty span that touches another span is merged into it
+      if fr < last_to or (fr == last_to and (fr == to or last_fr == last_to)):
+         if to > last_to:
+            res[-1] = (last_fr, to)
+      else:
+         res.append((fr, to))
+   return res
+def _intersect_spans(spans1, spans2):
+   """
+      returns sorted list of spans covering text covered by both <spans1>
+      and <spans2>. Both inputs must be sorted lists of disjoint spans
+   """
+   res = []
+   i = 0
+   j = 0
+   while i < len(spans1) and j < len(spans2):
+      fr = max(spans1[i][0], spans2[j][0])
+      to = min(spans1[i][1], spans2[j][1])
+      if fr < to:
+         res.append((fr, to))
+      if spans1[i][1] < spans2[j][1]:
+         i += 1
+      else:
+         j += 1
+   return res
+def _subtract_spans(spans1, spans2):
+   """
+      returns sorted list of spans covering text covered by <spans1>
+      but not by <spans2>. Both inputs must be sorted lists of disjoint spans
+   """
+   res = []
+   j = 0
+   for fr, to in spans1:
+      # skip spans in spans2 that end before fr
+      while j < len(spans2) and spans2[j][1] <= fr:
+         j += 1
+      k = j
+      while k < len(spans2) and spans2[k][0] < to:
+         if spans2[k][0] > fr:
+            res.append((fr, spans2[k][0]))
+         fr = max(fr, spans2[k][1])
+         k += 1
+      if fr < to:
+         res.append((fr, to))
+   return res
 class Tagger:
    """
       
    Constructor parameters:
       text (string) -- text to be tagged
       lower_case (boolean) -- if True, convert text to lower case (default True) 
+      cache_tuples (int) -- maximum number of tuples kept in the cache of results
+         of select, 0 disables the cache (default 0). Results are keyed by
+         relation, tags and versions of the tags, and the least recently used
+         are evicted. Changing a tag invalidates its results. Selections on
+         lists of locations are not cached
       
    Locations associated with a tag are always sorted by fr,to,offset
    """
-   def __init__(self, text, lower_case=True):
+   def __init__(self, text, lower_case=True, cache_tuples=0):
       if lower_case:
          self.text = text.lower()
       else:
          self.text = text
       self.spans   = {} # tag --> [ (from, to), ...]
-   def tagRE(self, tag, regexp, group=0, overlapped=False):
+      self.versions = {} # tag --> number of changes of tag
+      self.cache_tuples = cache_tuples
+      self.cache = OrderedDict() # (relation, tags, versions, aggfn) --> result of select
+      self.cache_keys = {} # tag --> keys of cached selections on tag
+      self.cached_tuples = 0 # number of tuples in cache
+      # selections may run in threads of a query, see Query.execute
+      self.cache_lock = threading.Lock()
+   def _changed(self, tag):
+      """
+         increments version of <tag> and removes cached selections on it
+      """
+      with self.cache_lock:
+         self.versions[tag] = self.versions.get(tag, 0) + 1
+         for key in list(self.cache_keys.get(tag, [])):
+            self._uncache(key)
+   def _uncache(self, key):
+      """
+         removes selection <key> from the cache and from the keys of its tags,
+         the caller holds cache_lock
+      """
+      self.cached_tuples -= len(self.cache.pop(key))
+      for tag in key[1]:
+         self.cache_keys[tag].discard(key)
+         if len(self.cache_keys[tag]) == 0:
+            del self.cache_keys[tag]
+   def tagRE(self, tag, regexp, group=0, overlapped=False, token=None):
       """Tag strings in text matching regexp with tag
          
       Parameters:
@@ -58,6 +248,7 @@ class Tagger:
          regexp (string) -- regular expression
          group (int) -- match group within the regular expression (default 0)
          overlapped (boolean) -- whether regular expression matches overlap (default False)
+         token (CancelToken) -- token that limits the matching time (default None)
       
       Raises an exception if tag already exists
       """
@@ -65,15 +256,26 @@ class Tagger:
          msg = "Tag {} already in. Did not overwrite".format(tag)
          handle_error(110101, msg)
       self.spans[tag] = [Loc(i[0], i[1]) \
-                         for i in self._findpatt(regexp,group,overlapped)]
-   def _findpatt(self, pattern,group=0,overlapped=False):
+                         for i in self._findpatt(regexp,group,overlapped,token)]
+      self._changed(tag)
+   def _findpatt(self, pattern,group=0,overlapped=False,token=None):
       """
          Returns start and end positions of strings in self.text that match <pattern>
+         the deadline of <token>, if any, is the timeout of the regex module
       """
       res = []
-      for m in re.finditer(pattern, self.text, overlapped=overlapped):
-         fr,to = m.span(group)
-         res.append(m.span(group))
+      if token == None:
+         for m in re.finditer(pattern, self.text, overlapped=overlapped):
+            res.append(m.span(group))
+         return res
+      token.node = "regular expression {}".format(pattern)
+      try:
+         for m in re.finditer(pattern, self.text, overlapped=overlapped, 
+                              timeout=token.remaining()):
+            token.check()
+            res.append(m.span(group))
+      except TimeoutError:
+         token.stop(110108, "timeout of {} seconds".format(token.timeout))
       return res
    def display_matches(self):
       """ Prints tagged strings with their respective tags"""
@@ -104,6 +306,7 @@ class Tagger:
       if not found:
          self.spans[tag] = self.spans[tag][:indx+1] + [loc] + \
                            self.spans[tag][indx+1:]
+         self._changed(tag)
       else:
          msg = "Tag {} already has location {}"
          handle_error(210102, msg.format(tag, loc.txt_order()))
@@ -130,41 +333,150 @@ class Tagger:
                result.append(Loc(start, end, offset))
                break
       return sorted(result, key=lambda x: x.order())
-   def between(self, startTag, endTag, distance):
-      # more efficient than seq_before
-      # --- HAS NOT BEEN TESTED ---
-      def locateIn(ilist, start):
-         """
-            locate <start> in <ilist>
-            if multiple intervals in <ilist> have <start> as the beginning
-            of the interval, returns the index of the first one
-            if no interval in <ilist> have <start> as the beginning of 
-            interval, returns index i such that <start> is between
-            start of ilist[i] and ilist[i+1]
-         """
-         lo = 0
-         hi = len(ilist)-1
-         while lo <= hi:
-            mid = int( (lo+hi)/2 )
-            if start == ilist[mid].start():
-               while mid >=0 and start == ilist[mid].start():
-                  mid -= 1
-               return mid+1
-            elif start < ilist[mid].start():
-               hi = mid-1
-            else:
-               lo = mid+1
-         return lo
-      lower = self.get_locs(startTag)
-      upper = self.get_locs(endTag)
+   def proximity(self, tag1, tag2, lo=0, hi=None, direction='after'):
+      """Returns pairs of locations tagged by tag1 and tag2 that are within a distance range
+         
+      Parameters:
+         tag1 (string/literal) -- tag of first location in pairs
+         tag2 (string/literal) -- tag of second location in pairs
+         lo (int) -- minimum number of characters between locations (default 0)
+         hi (int) -- maximum number of characters between locations, None for no 
+                     maximum (default None)
+         direction (string) -- 'after' if tag2 location must start after the end of 
+                               tag1 location, 'before' if tag2 location must end
+                               before the start of tag1 location, 'both' for either
+                               (default 'after')
+      
+      Locations in a pair must have the same offset. The distance is the number of
+      characters between the end of one location and the start of the other one.
+      Tag2 locations are grouped by offset and located by binary search within the 
+      group of each tag1 location, so the cost is O((n+m) log m + k) where n and m 
+      are the number of locations of tag1 and tag2 and k the number of pairs.
+      Returns list of (tag1 location, tag2 location) pairs
+      """
+      return list(self.proximity_iter(tag1, tag2, lo, hi, direction))
+   def proximity_iter(self, tag1, tag2, lo=0, hi=None, direction='after'):
+      """
+         iterator of the pairs of locations tagged by <tag1> and <tag2> that
+         are within a distance range, see proximity
+      """
+      if direction not in ['after', 'before', 'both']:
+         fmt = "Invalid direction {}, must be 'after', 'before' or 'both'"
+         handle_error(110107, fmt.format(direction))
+      locs1 = self.get_locs(tag1)
+      locs2 = self.get_locs(tag2)
+      lo = max(lo, 0)
+      if hi != None and hi < lo:
+         return
+      # tag2 locations grouped by offset, sorted by start and by end
+      groups = {}
+      for loc in locs2:
+         groups.setdefault(loc.offset, []).append(loc)
+      for key, locs in groups.items():
+         byend = sorted(locs, key=lambda x: (x.intrval[1], x.intrval[0]))
+         groups[key] = (locs, [loc.intrval[0] for loc in locs],
+                        byend, [loc.intrval[1] for loc in byend])
+      if direction != 'before':
+         for loc1 in locs1:
+            if loc1.offset not in groups: continue
+            bystart, starts, byend, ends = groups[loc1.offset]
+            end = loc1.intrval[1]
+            b = bisect_left(starts, end+lo)
+            e = len(starts) if hi == None else bisect_right(starts, end+hi)
+            for indx in range(b, e):
+               yield (loc1, bystart[indx])
+      if direction != 'after':
+         for loc1 in locs1:
+            if loc1.offset not in groups: continue
+            bystart, starts, byend, ends = groups[loc1.offset]
+            start, end = loc1.intrval
+            b = 0 if hi == None else bisect_left(ends, start-hi)
+            e = bisect_right(ends, start-lo)
+            for indx in range(b, e):
+               # an empty location next to an empty loc1 is both after and before it
+               if direction == 'both' and byend[indx].intrval[0] >= end: continue
+               yield (loc1, byend[indx])
+   def nearest(self, tag1, tag2, k=1, direction='after', same_offset=True):
+      """Returns pairs of each location tagged by tag1 with its k nearest locations tagged by tag2
+         
+      Parameters:
+         tag1 (string/literal) -- tag of first location in pairs
+         tag2 (string/literal) -- tag of locations to search for the nearest ones
+         k (int) -- maximum number of tag2 locations paired with each tag1 location (default 1)
+         direction (string) -- 'after' if tag2 locations must start after the end of
+                               tag1 location, 'before' if they must end before its 
+                               start, 'both' for either (default 'after')
+         same_offset (boolean) -- whether locations in a pair must have the same
+                                  offset, e.g. be in the same projected line (default True)
+      
+      The distance is the number of characters between the two locations. If same_offset 
+      is False, distances are computed with respect to the beginning of text.
+      Returns list of (tag1 location, tag2 location) pairs, sorted by tag1 location
+      and then by distance
+      """
+      return list(self.nearest_iter(tag1, tag2, k, direction, same_offset))
+   def nearest_iter(self, tag1, tag2, k=1, direction='after', same_offset=True):
+      """
+         iterator of the pairs of each location tagged by <tag1> with its <k>
+         nearest locations tagged by <tag2>, see nearest
+      """
+      if direction not in ['after', 'before', 'both']:
+         fmt = "Invalid direction {}, must be 'after', 'before' or 'both'"
+         handle_error(110107, fmt.format(direction))
+      def interval(loc):
+         if same_offset:
+            return loc.intrval
+         return loc.txt_order()
+      def group(loc):
+         return loc.offset if same_offset else None
+      # tag2 locations grouped by offset, sorted by start and by end
+      groups = {}
+      for loc in self.get_locs(tag2):
+         groups.setdefault(group(loc), []).append(loc)
+      for key, locs in groups.items():
+         bystart = sorted(locs, key=lambda x: interval(x))
+         byend = sorted(locs, key=lambda x: (interval(x)[1], interval(x)[0]))
+         groups[key] = (bystart, [interval(x)[0] for x in bystart],
+                        byend, [interval(x)[1] for x in byend])
+      for loc1 in self.get_locs(tag1):
+         if group(loc1) not in groups: continue
+         bystart, starts, byend, ends = groups[group(loc1)]
+         s1, e1 = interval(loc1)
+         candidates = []
+         if direction != 'before':
+            i = bisect_left(starts, e1)
+            candidates += [(starts[j]-e1, 0, j, bystart[j]) for j in range(i, min(i+k, len(starts)))]
+         if direction != 'after':
+            i = bisect_right(ends, s1)
+            candidates += [(s1-ends[j], 1, -j, byend[j]) for j in range(i-1, max(i-k, 0)-1, -1)]
+         if direction == 'both':
+            # an empty location may be both after and before loc1
+            unique = {}
+            for cand in candidates:
+               unique.setdefault(id(cand[3]), cand)
+            candidates = list(unique.values())
+         for cand in heapq.nsmallest(k, candidates, key=lambda x: x[:3]):
+            yield (loc1, cand[3])
+   def between(self, startTag, endTag, distance, direction='after'):
+      """Returns locations between strings tagged by startTag and endTag
+         
+      Parameters:
+         startTag (string/literal) -- tag of strings where locations start
+         endTag (string/literal) -- tag of strings where locations end
+         distance (int) -- maximum length of returned locations
+         direction (string) -- 'after', 'before' or 'both' as in proximity (default 'after')
+      
+      For each pair of strings tagged by startTag and endTag that are at most 
+      distance characters apart, it returns the location of the text between
+      them. Strings that meet are excluded. More efficient than a query with 
+      seq_before or dist.
+      """
       res = []
-      for intrval in lower:
-         b = locateIn(upper, intrval.end())
-         e = locateIn(upper, intrval.end()+distance)
-         for indx in range(b, e+1):
-            d = upper[indx].start()-intrval.end()
-            if d <= distance and d > 0:
-               res.append( Loc(intrval.end(), upper[indx].start()) )
+      for loc1, loc2 in self.proximity(startTag, endTag, 1, distance, direction):
+         if loc2.start() >= loc1.end():
+            res.append(Loc(loc1.end(), loc2.start(), loc1.offset))
+         else:
+            res.append(Loc(loc2.end(), loc1.start(), loc1.offset))
       return res
    def tag_list(self, tag, locs):
       """Tag locs with tag
@@ -185,7 +497,80 @@ class Tagger:
       """
       for i,llist in enumerate(loc_lists):
          self.tag_list("{}_{}".format(prefix_tag,i),llist)
-   def _select(self, pred, tuples, tags, schema):
+   def _derive_tag(self, tag, spans):
+      """
+         tags <spans>, a sorted list of (from, to) pairs, with <tag>
+         without searching for the insertion point of each location
+      """
+      if tag in self.spans:
+         msg = "Tag {} already in. Did not overwrite".format(tag)
+         handle_error(110106, msg)
+      self.spans[tag] = [Loc(fr, to) for fr, to in spans]
+      self._changed(tag)
+   def tag_union(self, new_tag, tags):
+      """Tag text tagged by any of the tags with new_tag
+         
+      Parameters:
+         new_tag (string) -- tag to be created
+         tags (string/literal list) -- tags to combine
+         
+      Intersecting locations are merged into one. Locations of new_tag
+      have offset zero. Raises an exception if new_tag already exists
+      """
+      self._derive_tag(new_tag, _union_spans([_to_spans(self.get_locs(t)) for t in tags]))
+   def tag_intersect(self, new_tag, tags):
+      """Tag text tagged by all of the tags with new_tag
+         
+      Parameters:
+         new_tag (string) -- tag to be created
+         tags (string/literal list) -- tags to combine
+         
+      Locations of new_tag have offset zero. Raises an exception if new_tag
+      already exists
+      """
+      res = []
+      for indx, tag in enumerate(tags):
+         spans = _union_spans([_to_spans(self.get_locs(tag))])
+         res = spans if indx == 0 else _intersect_spans(res, spans)
+      self._derive_tag(new_tag, res)
+   def tag_difference(self, new_tag, tag, tags):
+      """Tag text tagged by tag but not by any of the tags with new_tag
+         
+      Parameters:
+         new_tag (string) -- tag to be created
+         tag (string/literal) -- tag of text to include
+         tags (string/literal list) -- tags of text to exclude
+         
+      Locations of new_tag have offset zero. Raises an exception if new_tag
+      already exists
+      """
+      include = _union_spans([_to_spans(self.get_locs(tag))])
+      exclude = _union_spans([_to_spans(self.get_locs(t)) for t in tags])
+      self._derive_tag(new_tag, _subtract_spans(include, exclude))
+   def tag_complement(self, new_tag, tags, within=None):
+      """Tag text not tagged by any of the tags with new_tag
+         
+      Parameters:
+         new_tag (string) -- tag to be created
+         tags (string/literal list) -- tags of text to exclude
+         within (int pair) -- start and end location of text to consider (default None)
+         
+      If within is not None, locations of new_tag are limited to
+      text[within[0]:within[1]]. Locations of new_tag have offset zero.
+      Raises an exception if new_tag already exists
+      """
+      if within == None:
+         within = (0, len(self.text))
+      exclude = _union_spans([_to_spans(self.get_locs(t)) for t in tags])
+      self._derive_tag(new_tag, _subtract_spans([tuple(within)], exclude))
+   def _select(self, pred, tuples, tags, schema, token=None):
+      """
+          select locations tuples from <tuples> and <tags> that satisfy 
+          <pred>, see _select_iter
+      """
+      soutput, selected = self._select_iter(pred, tuples, tags, schema, token)
+      return (soutput, list(selected))
+   def _select_iter(self, pred, tuples, tags, schema, token=None):
       """
           select locations tuples from <tuples> and <tags> that satisfy 
           <pred>
@@ -198,7 +583,7 @@ class Tagger:
              'pred':   [i1, ..., ir]
              'tuples': [j1, ..., jt]
              'tags':   [k1, ..., kg]
-          output: a list of locations tuples and its schema (col numbers):
+          output: schema (col numbers) and an iterator of locations tuples:
              [(loc1, ..., locn), ...] where n=t+g 
              columns in <output> are sorted by column number
           
@@ -271,130 +656,138 @@ class Tagger:
          # predicate columns come from tuples and tags
          soutput = sorted(stuples + stags)
          return (stuples, stags, spred, soutput)       
+      def selected(locs):
+         # iterate over tuples, which may not be a list, and the cartesian
+         # product of the locations of tags
+         for ltuple in tuples:
+            for tlocs in product(*locs):
+               args = [ltuple] + list(tlocs)
+               pargs = get_pred_args(args, stuples, stags, spred)
+               if token != None: token.check(1)
+               if pred(pargs):
+                  yield get_out_tuple(args, stuples, stags, soutput)
       stuples, stags, spred, soutput = check_schema(schema)
-      result = []
-      nrargs = len(tags)+1      
-      locs = [tuples] # list of locations lists
-      maxindx = [len(tuples)-1]
+      locs = [] # list of locations lists
       for tag in tags:
           col = self.get_locs(tag)
           if len(col) == 0:
-              return (soutput, result) 
+              return (soutput, iter([]))
           locs.append(col)
-          maxindx.append(len(col) - 1)
-      indx = [0]*nrargs # current indices for each array ints
-      while indx[0] <= maxindx[0]:
-          # get tuple of intervals from arrays in ints
-          # one from each array
-          args = [ locs[i][indx[i]] for i in range(nrargs) ]
-          pargs = get_pred_args(args, stuples, stags, spred)
-          if pred(pargs):
-             otuple = get_out_tuple(args, stuples, stags, soutput)
-             result.append(otuple)
-          # get next indices
-          j = nrargs-1
-          while j > 0 and indx[j] == maxindx[j]:
-              j -= 1 
-          indx[j] += 1
-          for k in range(j+1, nrargs):
-              indx[k] = 0
-      return (soutput, result) 
-   def select(self, relation, tags, aggfn=lambda x:x):
+      return (soutput, selected(locs))
+   def select(self, relation, tags, aggfn=lambda x:x, token=None):
       """
          select intervals tagged by <tags> list that satisfy relation
          apply <aggfn> to selected intervals
          output is not sorted
          
          superseded by Query module
+         results are cached if the cache is enabled, see constructor
+         <token> (CancelToken) limits the evaluation of relation
       """
-      result = []
-      nrargs = len(tags)
-      maxindx = []
-      locs = [] # list of locations lists
-      for tag in tags:
-         col = self.get_locs(tag)
-         if len(col) == 0:
-             return result
-         locs.append(col)
-         maxindx.append(len(col) - 1)
-      indx = [0]*nrargs # current indices for each array ints
-      while indx[0] <= maxindx[0]:
-         # get tuple of intervals from arrays in ints
-         # one from each array
-         args = tuple([locs[i][indx[i]] for i in range(nrargs)])
+      if self.cache_tuples > 0 and not any([isinstance(tag, list) for tag in tags]):
+         tkeys = tuple([('literal', tag['literal']) if isinstance(tag, dict) else tag \
+                        for tag in tags])
+         with self.cache_lock:
+            versions = tuple([self.versions.get(tag, 0) for tag in tkeys])
+            key = (relation, tkeys, versions, aggfn)
+            if key in self.cache:
+               self.cache.move_to_end(key)
+               return list(self.cache[key])
+         # evaluated without the lock, so threads select in parallel
+         result = self._select_all(relation, tags, aggfn, token)
+         if len(result) <= self.cache_tuples:
+            with self.cache_lock:
+               # a tag changed during evaluation, the result may be stale
+               current = tuple([self.versions.get(tag, 0) for tag in tkeys])
+               if current == versions and key not in self.cache:
+                  self.cache[key] = result
+                  self.cached_tuples += len(result)
+                  for tag in tkeys:
+                     self.cache_keys.setdefault(tag, set()).add(key)
+               # evict least recently used results
+               while self.cached_tuples > self.cache_tuples:
+                  self._uncache(next(iter(self.cache)))
+         return list(result)
+      return self._select_all(relation, tags, aggfn, token)
+   def _select_all(self, relation, tags, aggfn, token=None):
+      """
+         select on the cartesian product of the locations of <tags>, see select
+      """
+      return list(self.select_iter(relation, tags, aggfn, token))
+   def select_iter(self, relation, tags, aggfn=lambda x:x, token=None):
+      """
+         iterator of the intervals tagged by <tags> list that satisfy relation,
+         with <aggfn> applied, see select. Results are not cached
+      """
+      locs = [self.get_locs(tag) for tag in tags]
+      for args in product(*locs):
+         if token != None: token.check(1)
          if relation(args):
-            result.append(aggfn(args))
-         # get next indices
-         j = nrargs-1
-         while j > 0 and indx[j] == maxindx[j]:
-            j -= 1 
-         indx[j] += 1
-         for k in range(j+1, nrargs):
-            indx[k] = 0
-      return result
+            yield aggfn(args)
 
    def not_in(self, tags, refint=None):
       """Get text locations not tagged by tags.
          
       Parameters:
          tags (string list) -- list of tags
-         refint (int pair) -- start and end location of text to consider (default None)
+         refint (int pair or list of int pairs) -- start and end location of text
+                             to consider, or a list of them (default None)
                              
       Returns list of locations in text not tagged by any of the tags in 
       parameter tags. If refint is not None, returned locations are
-      limited to text[refint[0]:refint[1]]. Returned list is sorted by
-      from,to, offset and all offsets are zero.
+      limited to text[refint[0]:refint[1]]. If refint is a list of pairs
+      (e.g. one per page), returned locations are limited to each of them;
+      overlapping pairs are merged first, so no location is returned twice.
+      Returned list is sorted by from,to, offset and all offsets are zero.
       """
       if type(tags) is not list:
          handle_error(110104, 'parameter of <not_in> must be a list of tags' )
       if refint == None:
-         refint=(0,len(self.text))
-      # find intervals to discard
-      discard = []
-      for tag in tags:
-         discard = discard + self.get_locs(tag)
-      if len(discard) == 0: return [Loc(0, len(self.text))]
-      rem = [expand(loc) for loc in merge_list(discard)]
-      
-      # build list of locations in <refint> that do not overlap <rem>
-      res = []
-      point = refint[0]
-      for elt in rem:
-         loc = expand(elt)
-         if loc.start() < point: continue
-         if loc.start() >= refint[1]: break
-         if point != loc.start():
-             res.append(Loc(point, loc.start()))
-         point = loc.end()
-      if point != refint[1]:
-         res.append(Loc(point, refint[1]))
-      return sorted(res, key=lambda x: x.order())
-   def apply_tags(self, tags):
+         windows = [(0,len(self.text))]
+      elif len(refint) == 0:
+         # empty list of windows
+         return []
+      elif isinstance(refint[0], (tuple, list)):
+         windows = _union_spans([sorted([tuple(w) for w in refint])])
+      else:
+         windows = [tuple(refint)]
+      # k-way merge of sorted tag locations into intervals to discard
+      discard = _union_spans([_to_spans(self.get_locs(tag)) for tag in tags])
+      # locations in <windows> that do not overlap <discard>
+      return [Loc(fr, to) for fr, to in _subtract_spans(windows, discard)]
+   def apply_tags(self, tags, fd=None):
       """
          show text resulting from replacing text associated with tags 
          in list <tags> by the corresponding tags enclosed by char ~
+         if <fd> is not None, the text is written to file descriptor <fd>
+         instead of being returned
+         where locations overlap, the leftmost location prevails
       """
-      txt = self.text
-      for tag in self.spans:
-         if tag not in tags: continue
-         for intrval in self.spans[tag]:
-            fr = intrval.start() + intrval.offset
-            to = intrval.end() + intrval.offset
+      def tag_spans(tag):
+         return [(fr, to, tag) for fr, to in _to_spans(self.spans[tag])]
+      def pieces(spans):
+         point = 0
+         for fr, to, tag in spans:
+            if to <= point: continue
             origLen = to-fr
-            fill = origLen - len(tag)
-            if fill < 0:
-               tags = tag[:origLen]
-            else:
-               tags = tag
+            fill = max(origLen - len(tag), 0)
             beforeF = int(fill/2)
             afterF = fill - beforeF
-            txt = txt[:fr] + '~'*beforeF+ tags + '~'*afterF +txt[to:]
-      return txt
+            tagged = ('~'*beforeF + tag[:origLen] + '~'*afterF)[max(point-fr, 0):]
+            fr = max(fr, point)
+            yield self.text[point:fr]
+            yield tagged
+            point = to
+         yield self.text[point:]
+      # k-way merge of locations of all tags in <tags> sorted by position in text
+      spans = heapq.merge(*[tag_spans(tag) for tag in self.spans if tag in tags])
+      return self._write_pieces(pieces(spans), fd)
    def get_locs(self, tag, overlapped=False):
       """Returns Loc list of text tagged with tag
          
       Parameters:
-         tag (string/literal) -- tag or literal
+         tag (string/literal/Loc list) -- tag, literal or list of locations sorted 
+                                          by from,to,offset, which is returned as is
          overlapped (boolean) -- whether string matches overlap when tag is a literal 
                                  (default False)
       """
@@ -410,6 +803,8 @@ class Tagger:
             res = []
          else:
             res = self.spans[tag]
+      elif isinstance(tag, list):
+         res = tag
       else:
          handle_error(110105, 'first parameter of get_locs must be a tag or a literal' )        
       return res
@@ -426,23 +821,33 @@ class Tagger:
          isIn, indx = binary_search( self.spans[tag], loc )
          if isIn: return tag
       return None
-   def replace_tag(self, tag, replacement):
+   def replace_tag(self, tag, replacement, fd=None):
       """Returns text resulting from replacing strings tagged with tag with replacement
          
       Parameters:
          tag (string) -- tag of strings to be replaced
          replacement (string) -- replacement string
+         fd (file object) -- if not None, text is written to fd instead of
+                             being returned (default None)
       """
-      result = self.text
-      locs = merge_list(self.get_locs(tag))
-      for indx in range(len(locs)-1, -1, -1):
-         fr, to = locs[indx].intrval
-         offset = locs[indx].offset
-         fr = fr + offset
-         to = to + offset
-         result = result[:fr] + replacement + result[to:]
-      return result
-
+      def pieces(spans):
+         point = 0
+         for fr, to in spans:
+            yield self.text[point:fr]
+            yield replacement
+            point = to
+         yield self.text[point:]
+      spans = _union_spans([_to_spans(self.get_locs(tag))])
+      return self._write_pieces(pieces(spans), fd)
+   def _write_pieces(self, pieces, fd):
+      """
+         joins <pieces> of text into a string, or writes them to file
+         descriptor <fd> if it is not None
+      """
+      if fd == None:
+         return ''.join(pieces)
+      for piece in pieces:
+         fd.write(piece)
    def display_doc(self):
       """display entire text"""
       print(self.text)
@@ -507,5 +912,6 @@ class Tagger:
          handle_error(210103, 'Tag {} to remove does not exist'.format(tag))
       else:
          del self.spans[tag]
+         self._changed(tag)
 
     
@@ -0,0 +1,921 @@
+import itertools
+import random
+import re
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from qante.loc import Loc
+from qante.tagger import Tagger, CancelToken
+from qante.query import Query, QueryBatch, DistPred, SpillList
+from qante.query import semijoin_before, semijoin_meets, semijoin_equal, semijoin_subinterval
+from qante.query import semijoin_dist, is_cyclic, order_closure, seq_chain
+from qante.loctuple import before, subinterval
+from qante.resultset import ResultSet, from_tuples
+from qante.extracterror import ExtractError
+import qante.loctuple as LT
+
+
+def orders(res):
+   return sorted([tuple([loc.order() for loc in t]) for t in res])
+
+@pytest.fixture
+def tagger():
+   t = Tagger('total 12\nfoo 7 x\nbar 345 total 8\n')
+   t.tagRE('WORD', '[a-z]+')
+   t.tagRE('NUM', '[0-9]+')
+   return t
+
+@pytest.mark.parametrize('relop', ['<', '<=', '=', '>', '>=', '!='])
+@pytest.mark.parametrize('n', [0, 1, 3])
+def test_dist(tagger, relop, n):
+   op = '==' if relop == '=' else relop
+   expected = [(w.order(), d.order()) 
+               for w, d in itertools.product(tagger.get_locs('WORD'), tagger.get_locs('NUM'))
+               if d.start() >= w.end() and eval('{} {} {}'.format(d.start()-w.end(), op, n))]
+   res = Query(['WORD', 'NUM'], 'dist(0,1) {} {}'.format(relop, n), tagger).execute()
+   assert orders(res) == sorted(expected)
+
+@pytest.mark.parametrize('query, relop, n, params', [
+   ('dist(0,1) < 3', '<', 3, [0, 1]),
+   ('dist( 1 , 0 )<=10', '<=', 10, [1, 0]),
+   ('dist(0,1)=0', '=', 0, [0, 1]),
+   ('dist(0,1) != 2', '!=', 2, [0, 1]),
+   ('dist(1,0) >= 4', '>=', 4, [1, 0]),
+   ('dist(0,1)> 1', '>', 1, [0, 1]),
+])
+def test_parse_dist(tagger, query, relop, n, params):
+   q = Query(['WORD', 'NUM'], query, tagger)
+   q.parse_cached()
+   assert q.root.op == DistPred(relop, n)
+   assert q.root.params == params
+
+@pytest.mark.parametrize('query, code', [
+   ('dist(0,1) < x', 110606),
+   ('dist(0;1) < 3', 110606),
+   ('dist(0,1) =< 3', 110606),
+   ('dist(0,1) <', 110607),
+   ('dist(0,1)', 110607),
+])
+def test_parse_invalid_dist(tagger, query, code):
+   with pytest.raises(ExtractError) as err:
+      Query(['WORD', 'NUM'], query, tagger).execute()
+   assert err.value.code == code
+
+def test_dist_pred_equality(tagger):
+   # same ranges of distances, different predicates
+   lt, le = DistPred('<', 3), DistPred('<=', 2)
+   assert lt.ranges == le.ranges
+   assert lt != le
+   assert lt == DistPred('<', 3) and hash(lt) == hash(DistPred('<', 3))
+   assert len(set([lt, le, DistPred('<', 3)])) == 2
+   res = Query(['WORD', 'NUM'], 'dist(0,1) < 3 and dist(0,1) <= 2', tagger).execute()
+   assert orders(res) == orders(Query(['WORD', 'NUM'], 'dist(0,1) < 3', tagger).execute())
+
+@pytest.fixture
+def pairs_tagger():
+   # 300 locations of A followed by their B, so any pair of tags has many candidates
+   t = Tagger(' '.join(['a{} b{}'.format(i, i) for i in range(300)]))
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('B', 'b[0-9]+')
+   return t
+
+def brute_count(tagger, tags, pred, project):
+   res = set()
+   for t in itertools.product(*[tagger.get_locs(tag) for tag in tags]):
+      if pred(t):
+         res.add(tuple([t[i].order() for i in project]))
+   return len(res)
+
+@pytest.mark.parametrize('query', ['disjoint(0,1)', 'disjoint(0,1) or before(1,0)',
+                                   'before(0,1) and disjoint(1,0)'])
+def test_exists_stops_at_first_result(pairs_tagger, query):
+   token = CancelToken()
+   assert Query(['A', 'B'], query, pairs_tagger).exists(token=token)
+   assert token.calls <= 10
+
+@pytest.mark.parametrize('method', ['execute', 'count', 'exists'])
+@pytest.mark.parametrize('params, code', [({'timeout': 0}, 110108), 
+                                          ({'max_predicate_calls': 100}, 110109)])
+def test_execution_limits(pairs_tagger, method, params, code):
+   # no pair of locations intersects, so exists evaluates all of them
+   query = Query(['A', 'B'], 'intersects(0,1)', pairs_tagger)
+   with pytest.raises(ExtractError) as err:
+      getattr(query, method)(**params)
+   assert err.value.code == code
+   assert 'while evaluating' in err.value.msg
+
+def test_cancel_from_another_thread(pairs_tagger):
+   token = CancelToken()
+   timer = threading.Timer(0.05, token.cancel)
+   timer.start()
+   with pytest.raises(ExtractError) as err:
+      Query(['A', 'B', 'A'], 'disjoint(0,1) and disjoint(1,2)', pairs_tagger).execute(token=token)
+   timer.join()
+   assert err.value.code == 110110
+   assert token.node in err.value.msg
+   # a cancelled token stops the work at its first check
+   with pytest.raises(ExtractError) as err:
+      Query(['A', 'B'], 'before(0,1)', pairs_tagger).execute(token=token)
+   assert err.value.code == 110110
+
+def test_token_limits_are_shared(pairs_tagger):
+   token = CancelToken(max_predicate_calls=1000)
+   # 3 x 300 pairs, the second query exceeds the calls left by the first one
+   Query([pairs_tagger.get_locs('A')[:3], 'B'], 'intersects(0,1)', pairs_tagger).execute(token=token)
+   assert 0 < token.calls <= 1000
+   with pytest.raises(ExtractError) as err:
+      Query([pairs_tagger.get_locs('A')[:3], 'B'], 'intersects(0,1)', pairs_tagger).execute(token=token)
+   assert err.value.code == 110109
+   assert CancelToken().remaining() == None
+   assert 0 < CancelToken(timeout=60).remaining() <= 60
+
+def test_exists_without_results(pairs_tagger):
+   token = CancelToken()
+   assert not Query(['A', 'B'], 'meets(0,1) and before(1,0)', pairs_tagger).exists(token=token)
+   assert not Query(['A', 'B'], 'dist(1,0) = 0', pairs_tagger).exists(token=token)
+
+def test_count_before_without_evaluating_pairs(pairs_tagger):
+   token = CancelToken()
+   cnt = Query(['A', 'B'], 'before(0,1)', pairs_tagger).count(token=token)
+   assert cnt == brute_count(pairs_tagger, ['A', 'B'], lambda t: t[0].end() < t[1].start(), [0, 1])
+   assert token.calls <= 10
+
+def test_count_chain_with_dist(pairs_tagger):
+   token = CancelToken()
+   query = Query(['A', 'B', 'A'], 'seq_before(0,1,2) and dist(0,1) < 40', pairs_tagger)
+   cnt = query.count(token=token)
+   alocs = pairs_tagger.get_locs('A')
+   expected = 0
+   for b in pairs_tagger.get_locs('B'):
+      # locations of A before b within 40 characters, times locations of A after b
+      expected += len([a for a in alocs if 0 < b.start() - a.end() < 40]) * \
+                  len([a for a in alocs if a.start() > b.end()])
+   assert cnt == expected
+   assert token.calls <= 10
+
+@pytest.mark.parametrize('query, project', [
+   ('before(0,1) and subinterval(1,2)', []),
+   ('before(0,1) and dist(1,2) < 5', [0]),
+   ('before(0,1) and dist(1,2) < 5', [2, 1]),
+   ('meets(0,1) or before(1,0)', [1]),
+   ('before(0,1) and not subinterval(1,2)', [0, 1]),
+   ('intersects(0,2) and before(0,1) and before(1,2)', []),
+])
+def test_count_matches_execute(tagger, query, project):
+   tags = ['WORD', 'NUM', 'WORD']
+   res = Query(tags, query, tagger, project).execute()
+   cnt = Query(tags, query, tagger, project).count()
+   assert cnt == len(set([tuple([loc.order() for loc in t]) for t in res]))
+   assert Query(tags, query, tagger, project).exists() == (cnt > 0)
+
+PREDS = ['before', 'meets', 'overlaps', 'during', 'starts', 'finishes', 'equal',
+         'subinterval', 'intersects', 'disjoint']
+
+def random_atom(rnd, i, j):
+   # (query, python expression) of a random predicate on columns i and j
+   if rnd.random() < 0.2:
+      relop, n = rnd.choice(['<', '<=', '>', '>=', '=', '!=']), rnd.randint(0, 6)
+      op = '==' if relop == '=' else relop
+      expr = '(t[{j}].offset == t[{i}].offset and t[{j}].start() >= t[{i}].end() and ' \
+             't[{j}].start() - t[{i}].end() {op} {n})'.format(i=i, j=j, op=op, n=n)
+      return 'dist({},{}) {} {}'.format(i, j, relop, n), expr
+   pred = rnd.choice(PREDS)
+   return '{}({},{})'.format(pred, i, j), 'LT.{}((t[{}], t[{}]))'.format(pred, i, j)
+
+def random_query(rnd, ncols):
+   (q1, e1), (q2, e2), (q3, e3) = [random_atom(rnd, *rnd.sample(range(ncols), 2)) for i in range(3)]
+   # a negated predicate on the columns of another one
+   cols = [int(col) for col in re.findall('[0-9]+', q1)[:2]]
+   qn, en = random_atom(rnd, *rnd.sample(cols, 2))
+   return rnd.choice([
+      ('{} and {}'.format(q1, q2), '{} and {}'.format(e1, e2)),
+      ('{} and {} and {}'.format(q1, q2, q3), '{} and {} and {}'.format(e1, e2, e3)),
+      ('{} and ({} or {})'.format(q1, q2, q3), '{} and ({} or {})'.format(e1, e2, e3)),
+      ('{} and not {}'.format(q1, qn), '{} and not {}'.format(e1, en)),
+      ('{} or {}'.format(q1, q2), '{} or {}'.format(e1, e2)),
+   ])
+
+def random_tagger(rnd):
+   words = ['ab', 'cd', '12', '3', 'x']
+   lines = [' '.join([rnd.choice(words) for i in range(rnd.randint(1, 6))]) 
+            for j in range(rnd.randint(1, 3))]
+   t = Tagger('\n'.join(lines))
+   t.tagRE('WORD', '[a-z]+')
+   t.tagRE('NUM', '[0-9]+')
+   t.tagRE('TOKEN', '[^ \n]+')
+   t.tagRE('LINE', '[^\n]+')
+   return t
+
+def brute_force(tagger, tags, expr, project):
+   res = set()
+   pred = eval('lambda t: ' + expr)
+   for t in itertools.product(*[tagger.get_locs(tag) for tag in tags]):
+      if pred(t):
+         # columns of results are in the order of tags
+         res.add(tuple([t[i].order() for i in sorted(project)]))
+   return sorted(res)
+
+@pytest.mark.parametrize('options', [{}, {'semijoin': True}, {'plan': False}, {'multiway': False},
+                                     {'infer': False}])
+@pytest.mark.parametrize('seed', range(4))
+def test_options_match_brute_force(seed, options):
+   rnd = random.Random(seed)
+   for trial in range(40):
+      t = random_tagger(rnd)
+      # empty tags are not part of the cartesian product of a query
+      pool = [tag for tag in ['WORD', 'NUM', 'TOKEN', 'LINE'] if len(t.get_locs(tag)) > 0]
+      tags = [rnd.choice(pool) for i in range(rnd.randint(2, 4))]
+      query, expr = random_query(rnd, len(tags))
+      project = rnd.sample(range(len(tags)), rnd.randint(1, len(tags)))
+      res = Query(tags, query, t, project).execute(**options)
+      assert orders(res) == brute_force(t, tags, expr, project), query
+
+def outcome(fn):
+   # result of fn, or code of the ExtractError it raises
+   try:
+      return fn()
+   except ExtractError as err:
+      return ('error', err.code)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_exists_matches_count(seed):
+   rnd = random.Random(seed)
+   repeated = 0
+   for trial in range(40):
+      t = random_tagger(rnd)
+      pool = [tag for tag in ['WORD', 'NUM', 'TOKEN', 'LINE'] if len(t.get_locs(tag)) > 0]
+      tags = [rnd.choice(pool) for i in range(rnd.randint(2, 4))]
+      query, expr = random_query(rnd, len(tags))
+      if rnd.random() < 0.5:
+         # a predicate that repeats a column
+         col = rnd.randrange(len(tags))
+         query = '{} {} {}'.format(query, rnd.choice(['and', 'or']), random_atom(rnd, col, col)[0])
+         repeated += 1
+      project = rnd.sample(range(len(tags)), rnd.randint(1, len(tags)))
+      cnt = outcome(lambda: Query(tags, query, t, project).count())
+      res = outcome(lambda: Query(tags, query, t, project).execute())
+      exists = outcome(lambda: Query(tags, query, t, project).exists())
+      if isinstance(cnt, tuple):
+         assert exists == res == cnt, query
+         continue
+      assert cnt == len(set(orders(res))), query
+      assert exists == (cnt > 0), query
+   assert repeated > 0
+
+def test_plan_by_default(tagger):
+   query = Query(['WORD', 'NUM', 'WORD'], 'before(0,1) and before(1,2)', tagger)
+   query.execute()
+   assert query.planned
+   query = Query(['WORD', 'NUM', 'WORD'], 'before(0,1) and before(1,2)', tagger)
+   query.execute(plan=False)
+   assert not query.planned
+   # without a conjunction to order, leaves are scheduled by their estimated counts
+   query = Query(['WORD', 'NUM'], 'before(0,1) or meets(1,0)', tagger)
+   query.execute()
+   assert not query.planned
+
+@pytest.mark.parametrize('max_dp', [10, 0])
+def test_plan_avoids_cartesian_products(tagger, max_dp, monkeypatch):
+   monkeypatch.setattr(Query, 'MAX_DP_CHILDREN', max_dp)
+   query = Query(['WORD'] * 6, '', tagger)
+   query.lcount = [10] * 6
+   # a chain 0-1-2-3-4-5 of predicates, the cheapest ones at its ends
+   items = [(set([0, 1]), 5, 5), (set([4, 5]), 5, 5), (set([2, 3]), 50, 50), 
+            (set([1, 2]), 50, 50), (set([3, 4]), 50, 50)]
+   order, card, cost = query.plan_and(items)
+   assert sorted(order) == list(range(5))
+   cols = set(items[order[0]][0])
+   for i in order[1:]:
+      assert len(cols.intersection(items[i][0])) > 0
+      cols = cols.union(items[i][0])
+
+@pytest.mark.parametrize('edges, cyclic', [
+   ([], False),
+   ([{0, 1}, {1, 2}], False),
+   ([{0, 1}, {1, 2}, {0, 2}], True),
+   ([{0, 1, 2}, {0, 1}, {1, 2}, {0, 2}], False),
+   ([{0, 1}, {1, 2}, {2, 3}, {3, 0}], True),
+   ([{0, 3}, {1, 3}, {0, 1, 2}, {2, 3}], True),
+   ([{0, 1}, {1, 2}, {2, 0}, {0, 1, 2}, {2, 3}], False),
+])
+def test_is_cyclic(edges, cyclic):
+   assert is_cyclic(edges) == cyclic
+
+def test_cyclic_conjunction_uses_multiway_join(tagger):
+   tags = ['WORD', 'NUM', 'WORD', 'LINE']
+   tagger.tagRE('LINE', '[^\n]+')
+   query = 'subinterval(0,3) and subinterval(1,3) and seq_before(0,1,2) and subinterval(2,3)'
+   expr = 'LT.subinterval((t[0], t[3])) and LT.subinterval((t[1], t[3])) and ' \
+          'LT.seq_before((t[0], t[1], t[2])) and LT.subinterval((t[2], t[3]))'
+   expected = brute_force(tagger, tags, expr, [0, 1, 2, 3])
+   assert len(expected) > 0
+   q = Query(tags, query, tagger)
+   assert orders(q.execute()) == expected
+   assert len(q.MULTIWAY) == 1
+   q = Query(tags, query, tagger)
+   assert orders(q.execute(multiway=False)) == expected
+   assert len(q.MULTIWAY) == 0
+   # an acyclic conjunction
+   q = Query(tags, 'subinterval(0,3) and seq_before(0,1,2)', tagger)
+   q.execute()
+   assert len(q.MULTIWAY) == 0
+
+def test_order_closure():
+   facts = order_closure(set([(before, 0, 1), (subinterval, 2, 1), (before, 1, 3), (subinterval, 4, 2)]))
+   assert set([(a, b) for op, a, b in facts if op == before]) == \
+          set([(0, 1), (0, 2), (0, 4), (1, 3), (2, 3), (4, 3), (0, 3)])
+   assert set([(a, b) for op, a, b in facts if op == subinterval]) == set([(2, 1), (4, 2), (4, 1)])
+
+@pytest.fixture
+def lines_tagger():
+   t = Tagger('total 12 foo 7\nbar 345 x 8 baz\n90 total\n')
+   t.tagRE('WORD', '[a-z]+')
+   t.tagRE('NUM', '[0-9]+')
+   t.tagRE('LINE', '[^\n]+')
+   # words and numbers projected on the start of their line
+   for tag in ['WORD', 'NUM']:
+      t.tag_list('L' + tag, [Loc(loc.start() - line.start(), loc.end() - line.start(), line.start())
+                             for line in t.get_locs('LINE') for loc in t.get_locs(tag) 
+                             if LT.subinterval((loc, line))])
+   return t
+
+@pytest.mark.parametrize('tags, pred, properties, strategy', [
+   (['WORD', 'NUM'], lambda t: t[0].end() < t[1].start() < t[0].end() + 8, ['before'], 'band'),
+   (['NUM', 'LINE'], lambda t: LT.subinterval(t) and t[0].start() == t[1].start(), ['subinterval'], 'band'),
+   (['LWORD', 'LNUM'], lambda t: t[0].offset == t[1].offset and t[0].start() < t[1].start(), 
+    ['same_offset'], 'band'),
+   (['LWORD', 'LNUM'], lambda t: t[0].offset == t[1].offset and t[0].end() < t[1].start(), 
+    ['same_offset', 'before'], 'band'),
+   (['WORD', 'WORD'], lambda t: abs(t[0].start() - t[1].start()) < 8, ['symmetric'], 'symmetric'),
+   (['WORD', 'NUM'], lambda t: abs(t[0].start() - t[1].start()) < 8, ['symmetric'], None),
+   (['WORD', 'NUM'], lambda t: t[1].start() - t[0].start() == 6, [], None),
+])
+def test_udp_strategies(lines_tagger, tags, pred, properties, strategy):
+   calls = []
+   def udp(t):
+      calls.append(t)
+      return pred(t)
+   query = Query(tags, 'udp(0,1)', lines_tagger)
+   query.UDP('udp', udp, properties=properties)
+   query.parse_cached()
+   assert query.udp_strategy(query.root) == strategy
+   res = query.execute()
+   expected = sorted([(l1.order(), l2.order()) for l1, l2 in 
+                      itertools.product(*[lines_tagger.get_locs(tag) for tag in tags]) if pred((l1, l2))])
+   assert len(expected) > 0
+   assert orders(res) == expected
+   product = len(lines_tagger.get_locs(tags[0])) * len(lines_tagger.get_locs(tags[1]))
+   assert len(calls) < product if strategy != None else len(calls) == product
+
+def test_udp_batch(lines_tagger):
+   def batch(words, nums):
+      return [(w, n) for w in words for n in nums if w.end() + 1 == n.start()]
+   def fail(t):
+      raise AssertionError('predicate evaluated')
+   words, nums = lines_tagger.get_locs('WORD'), lines_tagger.get_locs('NUM')
+   query = Query(['WORD', 'NUM'], 'next(0,1)', lines_tagger)
+   query.UDP('next', fail, batch=batch)
+   assert orders(query.execute()) == orders(batch(words, nums))
+   # the predicate may still be applied to the tuples of a previous result
+   query = Query(['WORD', 'NUM', 'LINE'], 'next(0,1) and subinterval(1,2)', lines_tagger)
+   query.UDP('next', lambda t: t[0].end() + 1 == t[1].start(), batch=batch, properties=['before'])
+   expected = [(w.order(), n.order(), l.order()) for w, n in batch(words, nums) 
+               for l in lines_tagger.get_locs('LINE') if LT.subinterval((n, l))]
+   assert len(expected) > 0
+   assert orders(query.execute()) == sorted(expected)
+
+def test_udp_selectivity(lines_tagger):
+   query = Query(['WORD', 'NUM'], 'p(0,1) and q(0,1) and r(1,0)', lines_tagger)
+   query.UDP('p', lambda t: True, selectivity=0.01)
+   query.UDP('q', lambda t: True, properties=['before'])
+   query.UDP('r', lambda t: True)
+   query.prepare()
+   sels = sorted([query.selectivity(leaf) for leaf in query.root.children])
+   assert sels == [0.01, 0.5, 0.5]
+   with pytest.raises(ExtractError) as err:
+      query.UDP('s', lambda t: True, selectivity=0)
+   assert err.value.code == 110625
+   with pytest.raises(ExtractError) as err:
+      query.UDP('s', lambda t: True, properties=['after'])
+   assert err.value.code == 110624
+
+@pytest.mark.parametrize('seed', range(3))
+def test_seq_chain(seed):
+   rnd = random.Random(seed)
+   for trial in range(50):
+      n = rnd.randint(1, 4)
+      locs = [random_locs(rnd, rnd.randint(0, 6)) for i in range(n)]
+      windows = [rnd.choice([(0, 0), (1, None), (0, None), (1, 3), (0, 2)]) for i in range(n-1)]
+      def in_windows(t):
+         return all([lo <= t[i+1].start() - t[i].end() and (hi == None or t[i+1].start() - t[i].end() <= hi)
+                     for i, (lo, hi) in enumerate(windows)])
+      expected = [tuple([loc.order() for loc in t]) for t in itertools.product(*locs) if in_windows(t)]
+      res = [tuple([loc.order() for loc in t]) for t in seq_chain(locs, windows)]
+      assert sorted(res) == sorted(expected)
+      assert len(set(res)) == len(res)
+
+@pytest.mark.parametrize('step, max_gaps, seq_pred', [
+   ('before', None, 'seq_before'),
+   ('meets', None, 'seq_meets'),
+   ('before_meets', None, 'seq_before_meets'),
+   ('before', 4, None),
+   ('before', [8, None], None),
+   ('before_meets', [None, 2], None),
+])
+def test_chain(step, max_gaps, seq_pred):
+   tagger = Tagger('ab12cd 3 x45y\nfoo 7 bar 6 baz')
+   tagger.tagRE('WORD', '[a-z]+')
+   tagger.tagRE('NUM', '[0-9]+')
+   tags = ['WORD', 'NUM', 'WORD']
+   query = Query(tags, 'label(0,1,2)', tagger)
+   query.chain('label', step, max_gaps)
+   res = orders(query.execute())
+   gaps = max_gaps if isinstance(max_gaps, list) else [max_gaps] * 2
+   lo = {'before': 1, 'meets': 0, 'before_meets': 0}[step]
+   def pred(t):
+      for i in range(2):
+         d = t[i+1].start() - t[i].end()
+         if d < lo or (step == 'meets' and d > 0) or (gaps[i] != None and d > gaps[i]):
+            return False
+      return True
+   expected = sorted([tuple([loc.order() for loc in t]) 
+                      for t in itertools.product(*[tagger.get_locs(tag) for tag in tags]) if pred(t)])
+   assert len(expected) > 0
+   assert res == expected
+   if seq_pred != None:
+      assert res == orders(Query(tags, '{}(0,1,2)'.format(seq_pred), tagger).execute())
+
+def test_chain_errors(tagger):
+   query = Query(['WORD', 'NUM', 'WORD'], 'label(0,1,2)', tagger)
+   with pytest.raises(ExtractError) as err:
+      query.chain('label', 'after')
+   assert err.value.code == 110626
+   query.chain('label', 'before', [2])
+   with pytest.raises(ExtractError) as err:
+      query.execute()
+   assert err.value.code == 110627
+
+@pytest.mark.parametrize('query', ['disjoint(1,2) and before(0,1)', 
+                                   'intersects(1,2) and seq_before(0,1,2)', 
+                                   'disjoint(1,2) and dist(0,1) < 5'])
+def test_probe_finds_empty_conjunction(pairs_tagger, query):
+   # no location of A follows the last location of B
+   tags = [pairs_tagger.get_locs('B')[-1:], 'A', 'B']
+   q = Query(tags, query, pairs_tagger)
+   assert not q.prepare()
+   assert q.execute() == []
+   q = Query(tags, query, pairs_tagger)
+   assert q.prepare(probe=False)
+   assert q.execute(probe=False) == []
+
+def test_probe_leaf(pairs_tagger):
+   q = Query(['A', 'B', 'A'], 'before(0,1) and disjoint(1,2) and seq_meets(0,1,2) and p(0,2)', pairs_tagger)
+   q.UDP('p', lambda t: True)
+   q.parse_cached()
+   q.flatten_tree()
+   probes = dict([(getattr(leaf.op, '__name__', None), q.probe_leaf(leaf)) for leaf in q.root.children])
+   # before has a semi-join, chains stop at the first one found
+   assert probes == {'before': True, 'disjoint': None, 'seq_meets': False, '<lambda>': None}
+
+def test_prune_empty_conjunction(pairs_tagger, monkeypatch):
+   # nothing is known about p, so it is evaluated and disjoint is skipped
+   tags = [pairs_tagger.get_locs('A')[:5], pairs_tagger.get_locs('B')[:5], 'A']
+   pruned = []
+   prune = Query.prune
+   def record(self, ptr):
+      pruned.append(ptr)
+      prune(self, ptr)
+   monkeypatch.setattr(Query, 'prune', record)
+   for plan in [True, False]:
+      token = CancelToken()
+      q = Query(tags, 'p(0,1) and disjoint(1,2)', pairs_tagger)
+      q.UDP('p', lambda t: False, selectivity=0.001)
+      assert q.execute(token=token, plan=plan) == []
+      assert token.calls == 25
+      assert pruned[-1] == q.root
+      assert all([leaf.done for leaf in q.root.children])
+
+@pytest.mark.parametrize('plan', [False, True])
+def test_scheduler_order(monkeypatch, plan):
+   # the next leaf is the first pending one in depth-first order with the 
+   # lowest estimated count, or the first pending one if the tree was planned
+   def leaves(ptr):
+      if len(ptr.children) == 0:
+         return [ptr]
+      return [leaf for child in ptr.children for leaf in leaves(child)]
+   next_leaf = Query.next_leaf
+   steps = []
+   def check(self):
+      pending = [leaf for leaf in leaves(self.root) if not leaf.done]
+      leaf = next_leaf(self)
+      assert leaf is min(pending, key=self.priority)
+      steps.append(leaf)
+      return leaf
+   monkeypatch.setattr(Query, 'next_leaf', check)
+   rnd = random.Random(1)
+   for trial in range(60):
+      t = random_tagger(rnd)
+      pool = [tag for tag in ['WORD', 'NUM', 'TOKEN', 'LINE'] if len(t.get_locs(tag)) > 0]
+      tags = [rnd.choice(pool) for i in range(rnd.randint(2, 4))]
+      query, expr = random_query(rnd, len(tags))
+      res = Query(tags, query, t).execute(plan=plan, multiway=False)
+      assert orders(res) == brute_force(t, tags, expr, range(len(tags)))
+   assert len(steps) > 60
+
+@pytest.fixture
+def parse_cache(monkeypatch):
+   monkeypatch.setattr(Query, 'PARSE_CACHE_SIZE', 3)
+   Query.clear_parse_cache()
+   yield Query.PARSE_STATS
+   Query.clear_parse_cache()
+
+def test_parse_cache_hits_and_misses(tagger, parse_cache):
+   expected = orders(Query(['WORD', 'NUM'], 'before(0,1) and dist(0,1) < 3', tagger).execute())
+   assert parse_cache == {'hits': 0, 'misses': 1, 'evicted': 0}
+   res = Query(['WORD', 'NUM'], 'before(0,1) and dist(0,1) < 3', tagger).execute()
+   assert parse_cache == {'hits': 1, 'misses': 1, 'evicted': 0}
+   assert orders(res) == expected
+   # the number of tags and the names of predicates are part of the key
+   Query(['WORD', 'NUM', 'WORD'], 'before(0,1) and dist(0,1) < 3', tagger).execute()
+   q = Query(['WORD', 'NUM'], 'before(0,1) and dist(0,1) < 3', tagger)
+   q.UDP('p', lambda t: True)
+   q.execute()
+   assert parse_cache == {'hits': 1, 'misses': 3, 'evicted': 0}
+
+def test_parse_cache_evicts_least_recently_used(tagger, parse_cache):
+   queries = ['before(0,1)', 'meets(0,1)', 'disjoint(0,1)']
+   for query in queries:
+      Query(['WORD', 'NUM'], query, tagger).parse_cached()
+   # 'before(0,1)' becomes the most recently used, 'meets(0,1)' is evicted
+   Query(['WORD', 'NUM'], 'before(0,1)', tagger).parse_cached()
+   Query(['WORD', 'NUM'], 'overlaps(0,1)', tagger).parse_cached()
+   assert parse_cache == {'hits': 1, 'misses': 4, 'evicted': 1}
+   assert [key[0] for key in Query.PARSE_CACHE] == ['disjoint(0,1)', 'before(0,1)', 'overlaps(0,1)']
+   Query(['WORD', 'NUM'], 'meets(0,1)', tagger).parse_cached()
+   assert parse_cache == {'hits': 1, 'misses': 5, 'evicted': 2}
+
+def test_parse_cache_disabled(tagger, parse_cache, monkeypatch):
+   monkeypatch.setattr(Query, 'PARSE_CACHE_SIZE', 0)
+   for i in range(2):
+      res = Query(['WORD', 'NUM'], 'before(0,1)', tagger).execute()
+   assert len(res) > 0
+   assert parse_cache == {'hits': 0, 'misses': 0, 'evicted': 0}
+   assert len(Query.PARSE_CACHE) == 0
+
+def test_parse_cache_keeps_dist_predicates(tagger, parse_cache):
+   expected = [(w.order(), n.order()) 
+               for w, n in itertools.product(tagger.get_locs('WORD'), tagger.get_locs('NUM'))
+               if 0 <= n.start() - w.end() < 3]
+   Query(['WORD', 'NUM'], 'dist(0,1) < 3', tagger).execute()
+   # parse tree and dist predicate of the second query come from the cache
+   res = Query(['WORD', 'NUM'], 'dist(0,1) < 3', tagger).execute()
+   assert parse_cache['hits'] == 1
+   assert orders(res) == sorted(expected)
+
+def test_infer_removes_implied_predicates(tagger):
+   tags = ['WORD', 'NUM', 'WORD']
+   query = Query(tags, 'before(0,1) and before(1,2) and before(0,2)', tagger)
+   assert query.prepare()
+   leaves = sorted([(leaf.op.__name__, list(leaf.params)) for leaf in query.root.children])
+   assert leaves == [('before', [0, 1]), ('before', [1, 2])]
+   expected = orders(Query(tags, 'before(0,1) and before(1,2) and before(0,2)', tagger).execute(infer=False))
+   assert len(expected) > 0
+   assert orders(Query(tags, 'before(0,1) and before(1,2) and before(0,2)', tagger).execute()) == expected
+
+@pytest.mark.parametrize('query', [
+   'before(0,1) and before(1,0)',
+   'seq_before(0,1,2) and before(2,0)',
+   'subinterval(0,2) and before(2,1) and before(1,0)',
+   'before(0,1) and subinterval(2,1) and (before(1,0) or before(2,0))',
+])
+def test_infer_contradictions_without_evaluation(tagger, query):
+   tags = ['WORD', 'NUM', 'WORD']
+   token = CancelToken()
+   assert Query(tags, query, tagger).execute(token=token) == []
+   assert token.calls == 0
+   assert Query(tags, query, tagger).execute(infer=False) == []
+
+def test_infer_removes_contradictory_branches(tagger):
+   tags = ['WORD', 'NUM']
+   res = Query(tags, 'before(0,1) and (before(1,0) or dist(0,1) < 3)', tagger).execute()
+   expected = Query(tags, 'before(0,1) and dist(0,1) < 3', tagger).execute()
+   assert len(expected) > 0
+   assert orders(res) == orders(expected)
+
+@pytest.mark.parametrize('query', [
+   'before(0,1) and before(1,2) and before(2,3)',
+   'before(0,1) and (before(1,2) or before(2,1)) and before(0,3)',
+   'before(0,1) and before(2,3)',
+])
+@pytest.mark.parametrize('project', [[3], [0, 2], [1, 2, 3]])
+def test_projection_pushed_down(tagger, query, project, monkeypatch):
+   def cols(ptr):
+      if len(ptr.children) == 0:
+         return set(ptr.params)
+      return set([col for child in ptr.children for col in cols(child)])
+   push = Query.push_projection
+   schemas = []
+   def record(self, oschema):
+      push(self, oschema)
+      needed = set(oschema)
+      for child in self.root.children:
+         if not child.done:
+            needed.update(cols(child))
+      for sch, tuples in self.root.result:
+         # only columns still needed, without duplicates
+         assert set(sch) <= needed
+         assert len(set(tuples)) == len(tuples)
+         schemas.append(sch)
+   monkeypatch.setattr(Query, 'push_projection', record)
+   tags = ['WORD', 'NUM', 'WORD', 'NUM']
+   res = Query(tags, query, tagger, project).execute()
+   expr = re.sub(r'([a-z]+)\(([0-9]),([0-9])\)', r'LT.\1((t[\2], t[\3]))', query)
+   assert orders(res) == brute_force(tagger, tags, expr, project)
+   assert len(schemas) > 0
+
+def random_locs(rnd, n):
+   intrvals = set()
+   for i in range(n):
+      fr = rnd.randint(0, 20)
+      intrvals.add((fr, fr + rnd.randint(0, 4)))
+   return [Loc(fr, to) for fr, to in sorted(intrvals)]
+
+@pytest.mark.parametrize('fn, pred', [
+   (semijoin_before, LT.before),
+   (semijoin_meets, LT.meets),
+   (semijoin_equal, LT.equal),
+   (semijoin_subinterval, LT.subinterval),
+   (lambda l1, l2: semijoin_dist(l1, l2, [(2, 5)]), 
+    lambda t: 2 <= t[1].start() - t[0].end() <= 5),
+])
+def test_semijoin_keeps_related_locations(fn, pred):
+   rnd = random.Random(0)
+   for trial in range(100):
+      locs1 = random_locs(rnd, rnd.randint(0, 6))
+      locs2 = random_locs(rnd, rnd.randint(0, 6))
+      res1, res2 = fn(locs1, locs2)
+      assert res1 == [l1 for l1 in locs1 if any([pred((l1, l2)) for l2 in locs2])]
+      assert res2 == [l2 for l2 in locs2 if any([pred((l1, l2)) for l1 in locs1])]
+
+def tree(node):
+   # children of a parsed node are stacked, the last operand first
+   if len(node.children) == 0:
+      return '{}({})'.format(node.op, ','.join([str(col) for col in node.params]))
+   if node.op == 'not':
+      return 'not ' + tree(node.children[0])
+   return '(' + ' {} '.format(node.op).join([tree(child) for child in reversed(node.children)]) + ')'
+
+@pytest.mark.parametrize('query, expected', [
+   # a parenthesized operand does not close a pending 'and'
+   ('before(0,1) and (meets(0,1)) or before(1,0)', 
+    '(before(0,1) and (meets(0,1) or before(1,0)))'),
+   ('before(0,1) and (meets(0,1) or before(1,0)) and before(1,0)', 
+    '(before(0,1) and ((meets(0,1) or before(1,0)) and before(1,0)))'),
+   ('(before(1,0)) or before(0,1) and (meets(0,1))', 
+    '(before(1,0) or (before(0,1) and meets(0,1)))'),
+   ('before(0,1) and before(1,0) or meets(0,1)', 
+    '((before(0,1) and before(1,0)) or meets(0,1))'),
+   ('before(0,1) and not (meets(0,1)) or before(1,0)', 
+    '((before(0,1) and not meets(0,1)) or before(1,0))'),
+])
+def test_parse_tree(tagger, query, expected):
+   q = Query(['WORD', 'NUM'], query, tagger)
+   q.parse_cached()
+   assert tree(q.parsed) == expected
+
+def test_not_is_anti_join(tagger):
+   res = Query(['WORD', 'NUM'], 'before(0,1) and not dist(0,1) < 3', tagger).execute()
+   expected = [t for t in itertools.product(tagger.get_locs('WORD'), tagger.get_locs('NUM'))
+               if t[1].start() - t[0].end() >= 3]
+   assert len(res) > 0
+   assert orders(res) == orders(expected)
+
+def test_not_evaluates_negation_on_bound_tuples():
+   t = Tagger('ab12 cd 3 x 45 ef6 7')
+   t.tagRE('WORD', '[a-z]+')
+   t.tagRE('NUM', '[0-9]+')
+   seen = set()
+   def udp(pair):
+      seen.add(pair[0].order())
+      return True
+   query = Query(['WORD', 'NUM', 'NUM'], 'meets(0,1) and not (udp(1,2) and before(1,2))', t, [0, 1])
+   query.UDP('udp', udp)
+   res = query.execute()
+   nums = t.get_locs('NUM')
+   expected = [(w, n) for w, n in itertools.product(t.get_locs('WORD'), nums)
+               if w.end() == n.start() and not any([n.end() < m.start() for m in nums])]
+   assert orders(res) == orders(expected)
+   # the negated expression only sees numbers that follow a word
+   assert seen == set([(2, 4, 0), (17, 18, 0)])
+
+def test_concurrent_process_pools(tagger):
+   # each call forks its own pool with its own tasks
+   queries = ['before(0,1) or meets(1,0)', 'before(1,0) or subinterval(0,1)', 
+              'intersects(0,1) or before(0,1)', 'disjoint(0,1) or meets(0,1)'] * 2
+   expected = [orders(Query(['WORD', 'NUM'], query, tagger).execute()) for query in queries]
+   def run(query):
+      return orders(Query(['WORD', 'NUM'], query, tagger).execute(parallel='process', workers=2))
+   with ThreadPoolExecutor(4) as pool:
+      assert list(pool.map(run, queries)) == expected
+
+def brute_partitioned(tagger, tags, pred, project):
+   # results of pred on the locations of each line, a quantified column 
+   # without locations in a line is None
+   res = set()
+   for fr, to in [(m.start(), m.end()) for m in re.finditer('[^\n]*\n', tagger.text)]:
+      locs = [[loc for loc in tagger.get_locs(tag) if fr <= loc.txt_order()[0] and 
+               loc.txt_order()[1] <= to] for tag in tags]
+      locs = [l if len(l) > 0 or i in project else [None] for i, l in enumerate(locs)]
+      for t in itertools.product(*locs):
+         if pred(t):
+            res.add(tuple([t[i].order() for i in project]))
+   return sorted(res)
+
+def bef(l1, l2):
+   return l1 != None and l2 != None and l1.end() < l2.start()
+
+def mts(l1, l2):
+   return l1 != None and l2 != None and l1.end() == l2.start()
+
+@pytest.mark.parametrize('query, pred', [
+   ('before(0,1) or before(0,2)', lambda t: bef(t[0], t[1]) or bef(t[0], t[2])),
+   ('before(0,1) and not before(1,2)', lambda t: bef(t[0], t[1]) and not bef(t[1], t[2])),
+   ('before(0,1) and not meets(1,2)', lambda t: bef(t[0], t[1]) and not mts(t[1], t[2])),
+])
+def test_partition_with_empty_tags(query, pred):
+   t = Tagger('total 12\nfoo 7 x\n')
+   t.tagRE('WORD', '[a-z]+')
+   t.tagRE('NUM', '[0-9]+')
+   t.tagRE('X', 'x')
+   tags = ['WORD', 'NUM', 'X']
+   expected = brute_partitioned(t, tags, pred, [0, 1])
+   assert ((0, 5, 0), (6, 8, 0)) in expected     # in a line without X
+   for parallel in [None, 'thread', 'process']:
+      res = Query(tags, query, t, [0, 1]).execute(partition_by='LINE', parallel=parallel)
+      assert orders(res) == expected
+   # X is required by both branches of the disjunction
+   res = Query(tags, 'before(0,2) or before(1,2)', t, [0, 1]).execute(partition_by='LINE')
+   assert orders(res) == brute_partitioned(t, tags, lambda t: bef(t[0], t[2]) or bef(t[1], t[2]), [0, 1])
+
+@pytest.mark.parametrize('params', [{'partition_by': 'LINE'}, {'parallel': 'thread'},
+                                    {'parallel': 'process', 'partition_by': 'LINE'},
+                                    {'max_tuples': 2, 'columnar': True}])
+def test_batch_forwards_execute_options(tagger, params):
+   batch = QueryBatch(tagger)
+   batch.add(['WORD', 'NUM'], 'before(0,1) or before(1,0)')
+   batch.add(['WORD', 'NUM'], 'before(0,1) or before(1,0)')
+   batch.add(['WORD', 'NUM'], 'before(0,1)', [1])
+   results = batch.execute(**params)
+   for res, (query, project) in zip(results, [('before(0,1) or before(1,0)', []),
+                                              ('before(0,1) or before(1,0)', []),
+                                              ('before(0,1)', [1])]):
+      expected = Query(['WORD', 'NUM'], query, tagger, project).execute(**params)
+      if params.get('columnar'):
+         res, expected = res.tuples(), expected.tuples()
+      assert orders(res) == orders(expected)
+   assert batch.stats['duplicates'] == 1
+
+def test_batch_limits_whole_batch(tagger):
+   batch = QueryBatch(tagger)
+   batch.add(['WORD', 'NUM'], 'before(0,1)')
+   batch.add(['NUM', 'WORD'], 'before(0,1)')
+   token = CancelToken()
+   batch.execute(token=token)
+   batch = QueryBatch(tagger)
+   batch.add(['WORD', 'NUM'], 'before(0,1)')
+   batch.add(['NUM', 'WORD'], 'before(0,1)')
+   with pytest.raises(ExtractError):
+      batch.execute(max_predicate_calls=token.calls - 1)
+
+def test_batch_keys_location_lists_by_content(tagger):
+   batch = QueryBatch(tagger)
+   batch.add([list(tagger.get_locs('WORD')), 'NUM'], 'before(0,1)')
+   batch.add([list(tagger.get_locs('WORD')), 'NUM'], 'before(0,1)')
+   batch.add([tagger.get_locs('WORD')[:1], 'NUM'], 'before(0,1)')
+   results = batch.execute()
+   assert batch.stats['duplicates'] == 1
+   assert orders(results[0]) == orders(results[1])
+   first = tagger.get_locs('WORD')[0].order()
+   assert orders(results[2]) == [t for t in orders(results[0]) if t[0] == first]
+
+@pytest.mark.parametrize('params', [{}, {'max_tuples': 3}, {'partition_by': 'LINE'},
+                                    {'parallel': 'thread'}])
+@pytest.mark.parametrize('project', [[], [2, 0]])
+def test_columnar_result(tagger, params, project):
+   tags = ['WORD', 'NUM', 'WORD']
+   query = 'before(0,1) and before(1,2) or meets(2,0)'
+   # only columnar results may exceed max_tuples
+   expected = Query(tags, query, tagger, project).execute(partition_by=params.get('partition_by'))
+   res = Query(tags, query, tagger, project).execute(columnar=True, **params)
+   assert isinstance(res, ResultSet)
+   assert len(res) == len(expected) > 0
+   assert orders(res.tuples()) == orders(expected)
+   assert orders(res) == orders(expected)
+   assert [res[i] for i in range(len(res))] == res.tuples()
+   oschema = sorted(project) if len(project) > 0 else [0, 1, 2]
+   for j, col in enumerate(oschema):
+      # indices of the locations of the column in the locations of its tag
+      locs = tagger.get_locs(tags[col])
+      assert [locs[i] for i in res.indices(j)] == [t[j] for t in res]
+   assert res.texts() == [tagger.get_text_tuple(t) for t in res]
+
+def test_result_set_from_tuples(tagger):
+   words = tagger.get_locs('WORD')
+   nums = tagger.get_locs('NUM')
+   res = from_tuples(tagger, [words, nums], [(words[1], nums[0]), (words[0], nums[2]), (words[1], nums[0])])
+   assert len(res) == 2
+   assert list(res.indices(0)) == [1, 0]
+   assert list(res.indices(1)) == [0, 2]
+   assert res.texts() == [('foo', '12'), ('total', '345')]
+   assert len(from_tuples(tagger, [], [])) == 0
+   with pytest.raises(ExtractError) as err:
+      from_tuples(tagger, [words, nums], [(nums[0], words[0])])
+   assert err.value.code == 111001
+
+@pytest.mark.parametrize('query', ['before(0,1) or disjoint(0,1)',
+                                   '(before(0,1) or disjoint(0,1)) and before(1,2)'])
+def test_spilled_results_without_duplicates(query):
+   t = Tagger(' '.join(['a{} b{}'.format(i, i) for i in range(20)]))
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('B', 'b[0-9]+')
+   full = Query(['A', 'B', 'A'], query, t, [0, 1])
+   expected = full.execute()
+   spilled = Query(['A', 'B', 'A'], query, t, [0, 1])
+   # branches overlap, so the spilled union of their results has duplicates
+   res = spilled.execute(max_tuples=5, columnar=True)
+   assert orders(res.tuples()) == orders(expected)
+   root = [(sch, len(tuples)) for sch, tuples in spilled.root.result]
+   assert root == [(sch, len(tuples)) for sch, tuples in full.root.result]
+
+@pytest.mark.parametrize('mode', ['execute', 'columnar', 'count'])
+def test_budget_bounds_peak_memory(mode):
+   t = Tagger(' '.join(['a{} b{}'.format(i, i) for i in range(80)]))
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('B', 'b[0-9]+')
+   def run(max_tuples):
+      query = Query(['A', 'B'], 'disjoint(0,1) or before(1,0)', t)
+      tracemalloc.start()
+      try:
+         if mode == 'count':
+            res = query.count(max_tuples=max_tuples)
+         else:
+            res = query.execute(max_tuples=max_tuples, columnar=mode == 'columnar')
+         peak = tracemalloc.get_traced_memory()[1]
+      finally:
+         tracemalloc.stop()
+      if mode != 'count':
+         res = orders(res.tuples() if mode == 'columnar' else res)
+      return res, peak
+   expected, peak = run(None)
+   res, budget_peak = run(200)
+   assert res == expected
+   # the union of 6400 pairs is deduplicated on disk, not in a set, and
+   # is not returned as a list
+   assert budget_peak < peak / 4
+
+def test_budget_returns_results_beyond_budget():
+   t = Tagger(' '.join(['a{} b{}'.format(i, i) for i in range(80)]))
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('B', 'b[0-9]+')
+   expected = Query(['A', 'B'], 'disjoint(0,1) or before(1,0)', t).execute()
+   res = Query(['A', 'B'], 'disjoint(0,1) or before(1,0)', t).execute(max_tuples=200)
+   assert len(res) == len(expected) == 6400
+   assert [tuple([loc.order() for loc in r]) for r in res] == orders(expected)
+   # results within the budget are a list
+   res = Query(['A', 'B'], 'before(0,1) and meets(0,1)', t).execute(max_tuples=200)
+   assert isinstance(res, list) and len(res) == 0
+
+@pytest.mark.parametrize('query, project', [
+   ('meets(2,2)', [0, 1, 2, 3]),
+   ('subinterval(0,0)', [0, 1, 2, 3]),
+   ('before(0,1) and dist(2,2) < 4', []),
+   ('disjoint(2,2) or before(2,3)', [2]),
+])
+def test_budget_with_repeated_columns(query, project):
+   t = Tagger('ab cd ab x cd ab')
+   for tag, regexp in [('t0', 'ab'), ('t1', 'cd'), ('t2', '[a-z]*'), ('t3', 'x|ab')]:
+      t.tagRE(tag, regexp)
+   tags = ['t0', 't1', 't2', 't3']
+   expected = Query(tags, query, t, project).execute()
+   res = Query(tags, query, t, project).execute(max_tuples=3)
+   assert len(expected) > 3
+   # a repeated column takes one position in result tuples
+   assert all([len(r) == len(project or tags) for r in expected])
+   assert sorted([tuple([loc.order() for loc in r]) for r in res]) == orders(expected)
+
+@pytest.mark.parametrize('query', ['dist(0,1) < 30', 'nearest(0,1)', 
+                                   'before(0,1) and dist(1,2) != 3'])
+def test_budget_spills_dist_and_nearest(query):
+   t = Tagger(' '.join(['a{} b{}'.format(i, i) for i in range(30)]))
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('B', 'b[0-9]+')
+   tags = ['A', 'B', 'A']
+   expected = Query(tags, query, t).execute()
+   query = Query(tags, query, t)
+   res = query.execute(max_tuples=4)
+   assert sorted([tuple([loc.order() for loc in r]) for r in res]) == orders(expected)
+   # pairs of the leaves were spilled
+   assert all([isinstance(tuples, SpillList) for sch, tuples in query.root.result])
@@ -0,0 +1,373 @@
+import io
+import itertools
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from qante.loc import Loc
+from qante.extracterror import ExtractError
+from qante.tagger import Tagger, CancelToken
+from qante.query import dist_ranges
+from qante.loctuple import before
+
+
+def orders(pairs):
+   return sorted([(l1.order(), l2.order()) for l1, l2 in pairs])
+
+def brute_proximity(tagger, tag1, tag2, lo, hi, direction):
+   res = []
+   for l1, l2 in itertools.product(tagger.get_locs(tag1), tagger.get_locs(tag2)):
+      if l1.offset != l2.offset:
+         continue
+      dists = []
+      if direction != 'before' and l2.start() >= l1.end():
+         dists.append(l2.start() - l1.end())
+      if direction != 'after' and l2.end() <= l1.start():
+         dists.append(l1.start() - l2.end())
+      if any([d >= lo and (hi == None or d <= hi) for d in dists]):
+         res.append((l1, l2))
+   return orders(res)
+
+@pytest.fixture
+def tagger():
+   t = Tagger('ab x ab  x ab x  x ab\nx ab xx ab x')
+   t.tagRE('A', 'ab')
+   t.tagRE('X', 'x')
+   # locations projected on offsets 100 and 200
+   t.tag_list('P', [Loc(0, 2, 100), Loc(5, 6, 100), Loc(3, 4, 200), Loc(9, 10, 200)])
+   t.tag_list('Q', [Loc(3, 4, 100), Loc(7, 8, 100), Loc(0, 1, 200), Loc(12, 13, 300)])
+   # empty locations
+   t.tag_list('E', [Loc(0, 0), Loc(2, 2), Loc(3, 3), Loc(9, 9), Loc(2, 2, 100)])
+   return t
+
+def covered(tagger, tag):
+   # text positions covered by the locations of tag
+   return set([p for loc in tagger.get_locs(tag) 
+               for p in range(loc.offset+loc.start(), loc.offset+loc.end())])
+
+def spans(tagger, tag):
+   return spans_of(tagger.get_locs(tag))
+
+def spans_of(locs):
+   return [loc.order() for loc in locs]
+
+def test_tag_algebra():
+   t = Tagger('aa bb aabb cc')
+   t.tagRE('A', 'a+')
+   t.tagRE('B', 'b+')
+   t.tagRE('W', '[a-z]+')
+   t.tag_union('AB', ['A', 'B'])
+   # touching locations are not merged, intersecting ones are
+   assert spans(t, 'AB') == [(0, 2, 0), (3, 5, 0), (6, 8, 0), (8, 10, 0)]
+   t.tag_union('AW', ['A', 'W'])
+   assert spans(t, 'AW') == spans(t, 'W')
+   t.tag_intersect('WB', ['W', 'B'])
+   assert spans(t, 'WB') == spans(t, 'B')
+   t.tag_difference('WA', 'W', ['A'])
+   assert spans(t, 'WA') == [(3, 5, 0), (8, 10, 0), (11, 13, 0)]
+   t.tag_complement('NW', ['W'])
+   assert spans(t, 'NW') == [(2, 3, 0), (5, 6, 0), (10, 11, 0)]
+   t.tag_complement('NA', ['A'], within=(4, 9))
+   assert spans(t, 'NA') == [(4, 6, 0), (8, 9, 0)]
+   with pytest.raises(ExtractError) as err:
+      t.tag_union('AB', ['A'])
+   assert err.value.code == 110106
+
+@pytest.mark.parametrize('seed', range(5))
+def test_tag_algebra_covers_positions(seed):
+   rnd = random.Random(seed)
+   for trial in range(40):
+      n = rnd.randint(0, 30)
+      t = Tagger('x'*n)
+      for tag in 'abc':
+         for i in range(rnd.randint(0, 5)):
+            # some locations are projected on an offset
+            off = rnd.choice([0, 0, rnd.randint(0, 5)])
+            fr = rnd.randint(0, max(0, n-off))
+            to = rnd.randint(fr, max(fr, n-off))
+            if (fr, to, off) not in spans(t, tag):
+               t.tag_loc(tag, Loc(fr, to, off))
+      a, b, c = [covered(t, tag) for tag in 'abc']
+      t.tag_union('U', ['a', 'b', 'c'])
+      t.tag_intersect('I', ['a', 'b'])
+      t.tag_difference('D', 'a', ['b', 'c'])
+      within = (rnd.randint(0, n//2), rnd.randint(n//2, n))
+      t.tag_complement('C', ['a', 'b'], within)
+      assert covered(t, 'U') == a | b | c
+      assert covered(t, 'I') == a & b
+      assert covered(t, 'D') == a - b - c
+      assert covered(t, 'C') == set(range(*within)) - a - b
+      for tag in 'UIDC':
+         res = spans(t, tag)
+         assert res == sorted(res)
+         assert all([res[i][1] <= res[i+1][0] and res[i][2] == 0 for i in range(len(res)-1)])
+
+def test_not_in():
+   t = Tagger('aa bb aabb cc')
+   t.tagRE('A', 'a+')
+   t.tagRE('B', 'b+')
+   assert spans_of(t.not_in(['A', 'B'])) == [(2, 3, 0), (5, 6, 0), (10, 13, 0)]
+   assert spans_of(t.not_in(['A', 'B'], (1, 12))) == [(2, 3, 0), (5, 6, 0), (10, 12, 0)]
+   # a location is limited to each window
+   assert spans_of(t.not_in(['A'], [(0, 4), (4, 13)])) == [(2, 4, 0), (4, 6, 0), (8, 13, 0)]
+   # no windows, no locations
+   assert t.not_in(['A', 'B'], []) == []
+   with pytest.raises(ExtractError) as err:
+      t.not_in('A')
+   assert err.value.code == 110104
+
+def test_not_in_overlapping_windows():
+   t = Tagger('aa bb aabb cc')
+   t.tagRE('A', 'a+')
+   res = spans_of(t.not_in(['A'], [(0, 10), (1, 10), (8, 13), (0, 10)]))
+   assert res == [(2, 6, 0), (8, 13, 0)]
+
+@pytest.mark.parametrize('seed', range(5))
+def test_not_in_covers_positions(seed):
+   rnd = random.Random(seed)
+   for trial in range(40):
+      n = rnd.randint(1, 30)
+      t = Tagger('x'*n)
+      for tag in 'ab':
+         for i in range(rnd.randint(0, 5)):
+            fr = rnd.randint(0, n)
+            to = rnd.randint(fr, min(n, fr+8))
+            if (fr, to, 0) not in spans(t, tag):
+               t.tag_loc(tag, Loc(fr, to))
+      windows = [tuple(sorted([rnd.randint(0, n), rnd.randint(0, n)])) for i in range(rnd.randint(1, 4))]
+      res = spans_of(t.not_in(['a', 'b'], windows))
+      expected = set([p for fr, to in windows for p in range(fr, to)]) - covered(t, 'a') - covered(t, 'b')
+      assert set([p for fr, to, off in res for p in range(fr, to)]) == expected
+      assert all([res[i][1] <= res[i+1][0] for i in range(len(res)-1)])
+
+@pytest.fixture
+def text_tagger():
+   t = Tagger('total 12 foo 345 bar')
+   t.tagRE('NUM', '[0-9]+')
+   t.tagRE('W', '[a-z]+')
+   t.tagRE('T', 'total 12')
+   return t
+
+def test_replace_tag(text_tagger):
+   assert text_tagger.replace_tag('NUM', '#') == 'total # foo # bar'
+   text_tagger.tag_list('P', [Loc(0, 2, 9), Loc(1, 3, 13)])
+   # projected locations are replaced at their position in the text
+   assert text_tagger.replace_tag('P', '_') == 'total 12 _o 3_ bar'
+
+@pytest.mark.parametrize('tags, expected', [
+   (['NUM'], 'total NU foo NUM bar'),
+   (['NUM', 'W'], '~~W~~ NU ~W~ NUM ~W~'),
+   # the leftmost of overlapping locations prevails
+   (['T', 'NUM'], '~~~T~~~~ foo NUM bar'),
+   (['W', 'T'], '~~W~~~~~ ~W~ 345 ~W~'),
+])
+def test_apply_tags(text_tagger, tags, expected):
+   assert text_tagger.apply_tags(tags) == expected
+
+def test_output_to_file(text_tagger):
+   fd = io.StringIO()
+   assert text_tagger.apply_tags(['NUM', 'W'], fd) == None
+   assert fd.getvalue() == text_tagger.apply_tags(['NUM', 'W'])
+   fd = io.StringIO()
+   assert text_tagger.replace_tag('NUM', '#', fd) == None
+   assert fd.getvalue() == 'total # foo # bar'
+
+@pytest.mark.parametrize('relop, n, expected', [
+   ('<', 3, [(0, 2)]),
+   ('<', 0, []),
+   ('<=', 3, [(0, 3)]),
+   ('<=', 0, [(0, 0)]),
+   ('=', 3, [(3, 3)]),
+   ('>', 3, [(4, None)]),
+   ('>=', 3, [(3, None)]),
+   ('!=', 3, [(0, 2), (4, None)]),
+   ('!=', 0, [(1, None)]),
+])
+def test_dist_ranges(relop, n, expected):
+   assert dist_ranges(relop, n) == expected
+
+@pytest.mark.parametrize('direction', ['after', 'before', 'both'])
+@pytest.mark.parametrize('lo, hi', [(0, None), (0, 0), (1, 3), (2, 2), (4, None), (3, 1)])
+@pytest.mark.parametrize('tags', [('A', 'X'), ('X', 'A'), ('A', 'A'), ('P', 'Q'), ('Q', 'P'),
+                                  ('E', 'E'), ('A', 'E'), ('E', 'P')])
+def test_proximity_brute_force(tagger, tags, lo, hi, direction):
+   tag1, tag2 = tags
+   expected = brute_proximity(tagger, tag1, tag2, lo, hi, direction)
+   assert orders(tagger.proximity(tag1, tag2, lo, hi, direction)) == expected
+
+def test_proximity_empty_locations_both():
+   t = Tagger('ab cd')
+   t.tag_list('E', [Loc(2, 2)])
+   # an empty location is at distance 0 after and before itself, paired once
+   assert orders(t.proximity('E', 'E', direction='both')) == [((2, 2, 0), (2, 2, 0))]
+   assert orders(t.proximity('E', 'E', direction='after')) == [((2, 2, 0), (2, 2, 0))]
+   assert orders(t.proximity('E', 'E', direction='before')) == [((2, 2, 0), (2, 2, 0))]
+
+def brute_nearest(tagger, tag1, tag2, k, direction, same_offset):
+   # distances of the k nearest tag2 locations of each tag1 location
+   res = {}
+   for l1 in tagger.get_locs(tag1):
+      s1, e1 = l1.intrval if same_offset else l1.txt_order()
+      dists = []
+      for l2 in tagger.get_locs(tag2):
+         if same_offset and l1.offset != l2.offset:
+            continue
+         s2, e2 = l2.intrval if same_offset else l2.txt_order()
+         d = []
+         if direction != 'before' and s2 >= e1:
+            d.append(s2 - e1)
+         if direction != 'after' and e2 <= s1:
+            d.append(s1 - e2)
+         if d:
+            dists.append(min(d))
+      if dists:
+         res[l1.order()] = sorted(dists)[:k]
+   return res
+
+@pytest.mark.parametrize('same_offset', [True, False])
+@pytest.mark.parametrize('direction', ['after', 'before', 'both'])
+@pytest.mark.parametrize('k', [1, 2, 5])
+@pytest.mark.parametrize('tags', [('A', 'X'), ('X', 'A'), ('A', 'A'), ('P', 'Q'), ('E', 'E'), ('A', 'E')])
+def test_nearest_brute_force(tagger, tags, k, direction, same_offset):
+   res = tagger.nearest(tags[0], tags[1], k, direction, same_offset)
+   expected = brute_nearest(tagger, tags[0], tags[1], k, direction, same_offset)
+   # pairs are sorted by tag1 location, and then by distance
+   assert [l1.order() for l1, l2 in res] == sorted([l1.order() for l1, l2 in res])
+   dists = {}
+   for l1, l2 in res:
+      s1, e1 = l1.intrval if same_offset else l1.txt_order()
+      s2, e2 = l2.intrval if same_offset else l2.txt_order()
+      d = [s2 - e1] if direction != 'before' and s2 >= e1 else []
+      d += [s1 - e2] if direction != 'after' and e2 <= s1 else []
+      assert d != []
+      dists.setdefault(l1.order(), []).append(min(d))
+   assert dists == expected
+   assert len(set(orders(res))) == len(res)
+
+def test_nearest():
+   t = Tagger('a x  x\na   x')
+   t.tagRE('A', 'a')
+   t.tagRE('X', 'x')
+   res = orders(t.nearest('A', 'X'))
+   assert res == [((0, 1, 0), (2, 3, 0)), ((7, 8, 0), (11, 12, 0))]
+   res = orders(t.nearest('A', 'X', k=2))
+   assert res == [((0, 1, 0), (2, 3, 0)), ((0, 1, 0), (5, 6, 0)), ((7, 8, 0), (11, 12, 0))]
+   res = orders(t.nearest('A', 'X', direction='both'))
+   assert res == [((0, 1, 0), (2, 3, 0)), ((7, 8, 0), (5, 6, 0))]
+   # second 'a' projected on offset 7
+   t.tag_list('L', [Loc(0, 1, 7)])
+   assert orders(t.nearest('L', 'X')) == []
+   assert orders(t.nearest('L', 'X', same_offset=False)) == [((0, 1, 7), (11, 12, 0))]
+   with pytest.raises(ExtractError) as err:
+      t.nearest('A', 'X', direction='left')
+   assert err.value.code == 110107
+
+def test_between_after():
+   t = Tagger('<a> one </a> <a> two</a>')
+   t.tagRE('OPEN', '<a>')
+   t.tagRE('CLOSE', '</a>')
+   texts = [t.get_text_loc(loc) for loc in t.between('OPEN', 'CLOSE', 6)]
+   assert texts == [' one ', ' two']
+
+def test_between_before():
+   t = Tagger('[x] a [y] bb [z]')
+   t.tagRE('BR', r'\[[a-z]\]')
+   t.tagRE('W', 'a|bb')
+   res = t.between('W', 'BR', 1, 'before')
+   assert [t.get_text_loc(loc) for loc in res] == [' ', ' ']
+   assert [loc.order() for loc in res] == [(3, 4, 0), (9, 10, 0)]
+
+def test_between_end_of_list():
+   # the end tag closest to the end of text is the last one in its list
+   t = Tagger('start .. end')
+   t.tagRE('S', 'start')
+   t.tagRE('E', 'end')
+   assert [loc.order() for loc in t.between('S', 'E', 100)] == [(5, 9, 0)]
+   assert t.between('S', 'E', 3) == []
+   assert t.between('E', 'S', 100) == []
+
+def test_between_excludes_meeting_strings():
+   t = Tagger('abab')
+   t.tagRE('A', 'a')
+   t.tagRE('B', 'b')
+   assert [loc.order() for loc in t.between('A', 'B', 5)] == [(1, 3, 0)]
+
+@pytest.mark.parametrize('token, code', [(CancelToken(timeout=0), 110108), (CancelToken(), 110110)])
+def test_tagging_stopped_by_token(token, code):
+   t = Tagger('ab ' * 5000)
+   if code == 110110:
+      token.cancel()
+   with pytest.raises(ExtractError) as err:
+      t.tagRE('A', 'a', token=token)
+   assert err.value.code == code
+   assert 'regular expression' in err.value.msg
+   # the tag is not added
+   assert t.get_locs('A') == []
+
+def cache_consistent(t):
+   keys = set([key for keys in t.cache_keys.values() for key in keys])
+   return keys == set(t.cache) and t.cached_tuples == sum([len(r) for r in t.cache.values()])
+
+def test_select_cache_hits_and_invalidates_changed_tags():
+   t = Tagger('ab x ab  x ab x  x ab', cache_tuples=100)
+   t.tagRE('A', 'ab')
+   t.tagRE('X', 'x')
+   calls = []
+   def rel(args):
+      calls.append(args)
+      return before(args)
+   expected = t.select(rel, ['A', 'X'])
+   n = len(calls)
+   assert t.select(rel, ['A', 'X']) == expected
+   t.select(rel, ['A', 'A'])
+   assert len(calls) == n + 16
+   # only selections on X are removed
+   t.tag_loc('X', Loc(15, 16))
+   assert [key[1] for key in t.cache] == [('A', 'A')]
+   assert len(t.select(rel, ['A', 'X'])) == len(expected) + 3
+   assert cache_consistent(t)
+
+def test_select_cache_skips_results_of_changed_tags():
+   t = Tagger('ab x ab  x ab x  x ab', cache_tuples=100)
+   t.tagRE('A', 'ab')
+   t.tagRE('X', 'x')
+   def rel(args):
+      # X changes while the selection is evaluated
+      if t.versions['X'] == 1:
+         t.tag_loc('X', Loc(15, 16))
+      return before(args)
+   t.select(rel, ['A', 'X'])
+   assert len(t.cache) == 0
+   assert cache_consistent(t)
+   # the selection on the new version is cached
+   t.select(rel, ['A', 'X'])
+   assert len(t.cache) == 1
+   assert cache_consistent(t)
+
+def test_select_cache_evicts_least_recently_used():
+   t = Tagger('ab x ab  x ab x  x ab', cache_tuples=12)
+   t.tagRE('A', 'ab')
+   t.tagRE('X', 'x')
+   t.select(before, ['A', 'X'])   # 9 tuples
+   t.select(before, ['A', 'A'])   # 6 tuples evict ('A', 'X')
+   assert [key[1] for key in t.cache] == [('A', 'A')]
+   assert 'X' not in t.cache_keys
+   assert cache_consistent(t)
+
+def test_select_cache_from_threads():
+   t = Tagger(' '.join(['a{} x'.format(i) for i in range(30)]), cache_tuples=500)
+   t.tagRE('A', 'a[0-9]+')
+   t.tagRE('X', 'x')
+   t.tagRE('W', '[a-z][0-9]*')
+   tags = [['A', 'X'], ['X', 'A'], ['A', 'W'], ['W', 'X'], ['X', 'W']]
+   expected = [sorted([(l1.order(), l2.order()) for l1, l2 in t.select_iter(before, tt)]) 
+               for tt in tags]
+   def run(i):
+      res = t.select(before, tags[i % len(tags)])
+      return sorted([(l1.order(), l2.order()) for l1, l2 in res])
+   with ThreadPoolExecutor(8) as pool:
+      results = list(pool.map(run, range(200)))
+   assert results == [expected[i % len(tags)] for i in range(200)]
+   assert t.cached_tuples <= 500
+   assert cache_consistent(t)